@@ -1,10 +1,27 @@
 import streamlit as st
-import uuid
 import pandas as pd
+import calendar
 from spotify_funcs import *
 import plotly.express as px
 import plotly.graph_objects as go
 
+@st.fragment(run_every=3)
+def show_enrichment_status(job_key, parts_shown):
+    """
+    Polls a background enrichment job and reruns the app to swap
+    in the enriched data as each part of it finishes.
+    """
+    job = get_enrichment_job(job_key)
+    if job is None or job['status'] != 'running' or job['parts_done'] != parts_shown:
+        st.rerun()
+
+    if job['total']:
+        part = f"part {job['part']} of {job['parts']}, " if job['parts'] > 1 else ""
+        st.progress(job['done'] / job['total'],
+                    text=f"🎵 Loading genres, popularity and release dates from Spotify ({part}batch {job['done']} of {job['total']})...")
+    else:
+        st.info("🎵 Loading genres, popularity and release dates from Spotify...")
+
 def show():
     # App title
     st.header("Spotify Listening Activity")
@@ -21,85 +38,197 @@ def show():
     # Create a placeholder for the success message
     success_message = st.empty()
 
-    # 1. Check if Parquet file already exists in the user-specific path
-    parquet_exists = file_exists_in_bucket("user-data", parquet_path)
+    # 1. Check if Parquet file already exists in the user-specific path, once per user
+    if st.session_state.get("saved_data_user") != user_id:
+        st.session_state.saved_data = None
+        if file_exists_in_bucket("user-data", parquet_path):
+            saved_df = load_df_from_supabase(user_id)
+            saved_cube = load_cube_from_supabase(user_id)
+            if saved_cube is None:
+                # data saved before the rollup cube existed
+                saved_cube = build_rollup_cube(saved_df)
+                save_cube_to_supabase(user_id, saved_cube)
+            period_index = load_period_index_from_supabase(user_id)
+            if period_index is None or period_index['stop'].max() != len(saved_df):
+                # data saved before the period index existed
+                period_index = build_period_index(saved_df)
+                save_period_index_to_supabase(user_id, period_index)
+            st.session_state.saved_data = (saved_df, saved_cube, period_index)
+        st.session_state.saved_data_user = user_id
+
+    parquet_exists = st.session_state.saved_data is not None
     if parquet_exists:
         # Display the success message
         success_message.success("✅ Found existing data! Loading it...")
-        df = load_df_from_supabase(user_id)
+        df, cube, period_index = st.session_state.saved_data
         st.session_state.spotify_df = df
+
+        # Let the user add a newer export to their saved data
+        with st.expander("Add a newer Spotify export"):
+            uploaded_files = st.file_uploader(
+                "Upload your latest Spotify Extended Listening History ZIP or JSON files:",
+                type=["zip", "json"],
+                accept_multiple_files=True,
+                key="update_files"
+            )
     else:
         st.warning("⚠️ No saved Spotify data found for your ID.")
 
         # Let the user upload JSON files if no data found
         uploaded_files = st.file_uploader(
-            "Upload your Spotify Extended Listening History JSON files:",
-            type="json",
+            "Upload your Spotify Extended Listening History ZIP or JSON files:",
+            type=["zip", "json"],
             accept_multiple_files=True
         )
 
         if not uploaded_files:
             st.stop()
 
-        # 4. Progress bar for processing
-        total = len(uploaded_files)
-        progress_bar = st.progress(0)
-
-        all_json_records = []
-        for idx, f in enumerate(uploaded_files):
-            # Read and process each file
-            all_json_records.extend(read_spotify_json([f]).to_dict(orient="records"))
-            progress_bar.progress((idx + 1) / total)
-
-        # Success after all files read
-        success_message.success("✅ All files read. Processing your Spotify data...")
-
-        # 5. Build full dataframe from the JSON records
-        df = pd.DataFrame(all_json_records)
-
-        # 6. Cache the processing function
-        @st.cache_data(show_spinner="🔄 Processing your Spotify data...")
-        def generate_spotify_df(df, client_id, client_secret):
-            df = combine_raw_meta(df, client_id, client_secret)
-            df = clean_listening_data(df)
-            df = first_year_listened(df)
-            df = clean_spdata_for_analysis(df)
-            return df
-
-        df = generate_spotify_df(df, client_id=default_id, client_secret=default_secret)
-
-        if 'spotify_df' not in st.session_state:
-            st.session_state.spotify_df = df
-
-        # Fix UUID columns if needed
-        for col in df.columns:
-            if df[col].apply(lambda x: isinstance(x, uuid.UUID)).any():
-                df[col] = df[col].astype(str)
-
-        # 7. Save the final dataframe as Parquet
-        save_df_to_supabase(user_id, df)
-
-        success_message.success("🎉 Your Spotify data has been processed and saved!")
+    if uploaded_files:
+        # 2. Fingerprint the export files once per upload rather than on every rerun
+        upload_key = tuple(getattr(file, "file_id", file.name) for file in uploaded_files)
+        if st.session_state.get("upload_key") != upload_key:
+            with open_spotify_sources(uploaded_files) as sources:
+                st.session_state.upload_sources = {get_source_fingerprint(source): source.name for source in sources}
+            st.session_state.upload_key = upload_key
+
+        # Only process export files that haven't been processed before
+        fingerprints = load_fingerprints_from_supabase(user_id) if parquet_exists else {}
+        new_sources = {fingerprint: name for fingerprint, name in st.session_state.upload_sources.items()
+                       if fingerprint not in fingerprints}
+
+        if not new_sources:
+            if not parquet_exists:
+                st.error("No Spotify audio history files found in your upload.")
+                st.stop()
+            st.info("ℹ️ These files have already been added to your data.")
+        else:
+            job_key = f"{user_id}:{','.join(sorted(new_sources))}"
+            raw_key = f"raw_df:{job_key}"
+
+            if raw_key not in st.session_state:
+                # 4. Progress bar for processing
+                progress_bar = st.progress(0)
+
+                # 5. Stream the JSON records straight into the full dataframe, once per upload
+                try:
+                    raw_df = read_spotify_json(
+                        uploaded_files,
+                        streaming=True,
+                        source_names=set(new_sources.values()),
+                        progress_callback=lambda done, count: progress_bar.progress(done / count)
+                    )
+                except FileNotFoundError:
+                    # the audio history files hold no plays
+                    progress_bar.empty()
+                    st.error("No Spotify audio history found in your upload.")
+                    st.stop()
+                progress_bar.empty()
+
+                # plays already saved, e.g. from an overlapping export, don't need processing again
+                if parquet_exists:
+                    raw_df = drop_stored_plays(raw_df, df)
+                st.session_state[raw_key] = raw_df
+
+            raw_df = st.session_state[raw_key]
+
+            if raw_df.empty:
+                # every play in these files is already in the saved data
+                fingerprints.update(new_sources)
+                save_fingerprints_to_supabase(user_id, fingerprints)
+                st.session_state.pop(raw_key, None)
+                st.info("ℹ️ All plays in these files are already in your data.")
+            else:
+                # Success after all files read
+                success_message.success(f"✅ {len(new_sources)} new files read. Processing your Spotify data...")
+
+                progressive = st.toggle("Show my dashboard while details load from Spotify", value=True, key="progressive_mode")
+
+                new_df = None
+                if progressive:
+                    # 6. Enrich in the background and render from the export fields meanwhile
+                    job = start_background_enrichment(job_key, raw_df, default_id, default_secret, user_id)
+
+                    if job['status'] == 'done':
+                        new_df = job['result']
+                    elif job['status'] == 'failed':
+                        finish_enrichment_job(job_key)
+                        st.error(f"⚠️ Could not load details from Spotify: {job['error']}")
+                        st.stop()
+                    else:
+                        provisional_key = f"provisional_df:{job_key}"
+                        if provisional_key not in st.session_state:
+                            provisional_df = build_provisional_df(raw_df)
+                            if parquet_exists:
+                                provisional_df = merge_spotify_data(df, provisional_df)
+                            st.session_state[provisional_key] = provisional_df
+
+                        # swap in the parts enriched so far, combining them and rebuilding the rollups
+                        # once per redraw however many parts finished since the last one
+                        parts_done = job['parts_done']
+                        shown_key = f"shown_df:{job_key}"
+                        if st.session_state.get(shown_key, (None,))[0] != parts_done:
+                            shown_df = st.session_state[provisional_key]
+                            if parts_done:
+                                enriched_df = combine_enriched_parts(job['enriched'][:parts_done])
+                                shown_df = merge_spotify_data(enriched_df, shown_df)
+                            st.session_state[shown_key] = (parts_done, shown_df, build_rollup_cube(shown_df),
+                                                           build_period_index(shown_df))
+
+                        _, df, cube, period_index = st.session_state[shown_key]
+                        st.session_state.spotify_df = df
+                        show_enrichment_status(job_key, parts_done)
+                else:
+                    # 6. Process the data, reusing any stages cached for these files
+                    with st.spinner("🔄 Processing your Spotify data..."):
+                        new_df = enrich_spotify_data(raw_df, default_id, default_secret, user_id=user_id, fingerprint=job_key)
+
+                if new_df is not None:
+                    # Merge the new plays into any saved data
+                    saved_rows = len(df) if parquet_exists else 0
+                    df = merge_spotify_data(df, new_df) if parquet_exists else new_df
+                    st.session_state.spotify_df = df
+
+                    # add the new plays to the rollup cube, or rebuild it if some were already saved
+                    if parquet_exists and len(df) == saved_rows + len(new_df):
+                        cube = update_rollup_cube(cube, new_df)
+                    else:
+                        cube = build_rollup_cube(df)
+                    period_index = build_period_index(df)
+
+                    # 7. Save the final dataframe, its rollup cube and period offsets as Parquet, along with the processed file fingerprints
+                    save_df_to_supabase(user_id, df)
+                    save_cube_to_supabase(user_id, cube)
+                    save_period_index_to_supabase(user_id, period_index)
+                    st.session_state.saved_data = (df, cube, period_index)
+                    fingerprints.update(new_sources)
+                    save_fingerprints_to_supabase(user_id, fingerprints)
+
+                    # the upload is done, drop its intermediate results
+                    finish_enrichment_job(job_key)
+                    for key in (raw_key, f"provisional_df:{job_key}", f"shown_df:{job_key}"):
+                        st.session_state.pop(key, None)
+
+                    success_message.success("🎉 Your Spotify data has been processed and saved!")
 
     # Create columns for layout
     left_col, right_col = st.columns([1, 2])
 
-    # Extract date components
-    df['year'] = df['timestamp_listened'].dt.year
-    df['quarter'] = df['timestamp_listened'].dt.to_period('Q').astype(str)
-    df['month'] = df['timestamp_listened'].dt.month
-    df['month_name'] = df['timestamp_listened'].dt.strftime('%B')
+    # The plays are sorted by time, so each period is a slice found in the period index
+    years = period_index.loc[period_index['kind'] == 'year', 'period']
+    quarters = period_index.loc[period_index['kind'] == 'quarter', 'period']
+    months = period_index.loc[period_index['kind'] == 'month', 'period']
 
     # Required: Year dropdown
-    selected_year = st.sidebar.selectbox("Select year:", ["All"] + (sorted(df['year'].unique(), reverse=True)))
+    selected_year = st.sidebar.selectbox("Select year:", ["All"] + sorted(years.astype(int), reverse=True))
 
     # Filter to selected year
-    if selected_year == 'All':
-        filtered_df = df.copy()
-    else:
-        filtered_df = df[df['year'] == selected_year]
+    period = None
+    if selected_year != 'All':
+        period = pd.Period(year=int(selected_year), freq='Y')
+
         # Optional: Quarter dropdown
-        quarter_options = ["All"] + sorted(filtered_df['quarter'].unique())
+        quarter_options = ["All"] + sorted(quarters[quarters.str.startswith(f"{selected_year}Q")])
         selected_quarter = st.sidebar.selectbox("Select quarter (optional):", quarter_options)
 
         # Determine valid months based on quarter
@@ -111,21 +240,21 @@ def show():
         }
 
         # Default: All months in the year
-        valid_months = filtered_df['month'].unique()
+        year_months = sorted(int(month[-2:]) for month in months[months.str.startswith(f"{selected_year}-")])
+        valid_months = year_months
         if selected_quarter != "All":
-            q = selected_quarter.split("Q")[1][0]  # Get '1' from 'Q1 2025'
+            q = selected_quarter.split("Q")[1][0]  # Get '1' from '2025Q1'
             valid_months = quarter_month_map[f"Q{q}"]
 
         # Filter month options to valid months in the quarter
-        valid_month_names = filtered_df[filtered_df['month'].isin(valid_months)]['month_name'].unique()
-        valid_month_names = sorted(valid_month_names, key=lambda m: pd.to_datetime(m, format='%B').month)
+        valid_month_names = [calendar.month_name[month] for month in year_months if month in valid_months]
         month_options = ["All"] + valid_month_names
 
         # Optional: Month dropdown (dependent on quarter)
         selected_month = st.sidebar.selectbox("Select month (optional):", month_options)
 
         if selected_quarter != "All":
-            filtered_df = filtered_df[filtered_df['quarter'] == selected_quarter]
+            period = pd.Period(selected_quarter, freq='Q')
 
         if selected_month != "All":
             # Validate month is in selected quarter
@@ -133,18 +262,23 @@ def show():
             if selected_quarter != "All" and month_num not in valid_months:
                 st.warning("Selected month is not in the selected quarter. Resetting to 'All'.")
             else:
-                filtered_df = filtered_df[filtered_df['month_name'] == selected_month]
+                period = pd.Period(year=int(selected_year), month=month_num, freq='M')
 
+    filtered_df = df if period is None else slice_period(df, period_index, period)
     st.session_state["filtered_df"] = filtered_df
 
+    # the dashboards group the pre-aggregated cube rather than the plays
+    filtered_cube = cube if period is None else slice_rollup_cube(cube, period.start_time, period.end_time)
+    st.session_state["filtered_cube"] = filtered_cube
+
     # build dashboard
     with left_col:
-        sunburst_df = filtered_df.groupby(['general_genre', 'genre1', 'artist'])['track_id'].count().reset_index()
-        sunburst_df = sunburst_df.sort_values(by='track_id', ascending=False).head(25)
+        sunburst_df = filtered_cube.groupby(['general_genre', 'genre1', 'artist'], observed=True)['plays'].sum().reset_index()
+        sunburst_df = sunburst_df.sort_values(by='plays', ascending=False).head(25)
         sunburst_df.rename(columns={'general_genre': 'Genre',
                                     'genre1': 'Sub Genre',
                                     'artist': 'Artist',
-                                    'track_id': 'Listens'}, inplace=True)
+                                    'plays': 'Listens'}, inplace=True)
         fig = px.sunburst (
             sunburst_df,
             path=['Genre', 'Artist'],
@@ -158,8 +292,7 @@ def show():
         st.plotly_chart(fig)
 
     with right_col:
-        filtered_df['date_listened'] = filtered_df['timestamp_listened'].dt.date
-        daily_listens_df = filtered_df['date_listened'].value_counts().sort_index()
+        daily_listens_df = filtered_cube.groupby('date_listened')['plays'].sum()
         daily_listens_df = daily_listens_df.reset_index()
         daily_listens_df.columns = ['Date', 'Listens']
 
@@ -0,0 +1,265 @@
+"""
+A local stand-in for the Spotify Web API, used to benchmark and load-test the
+metadata enrichment in spotify_funcs.py without calling api.spotify.com.
+
+It serves /api/token, /v1/tracks and /v1/artists. Objects come from fixtures
+recorded with SPOTIFY_RECORD_DIR (tracks.jsonl and artists.jsonl), and ids
+missing from the fixtures get deterministic synthetic data. Latency, server
+errors and 429 rate limiting can be injected, and /stats reports what was served.
+
+For example:
+
+        python mock_spotify_api.py --port 8765 --fixtures fixtures/ --latency 0.05 --rate-limit-rate 0.02
+
+        SPOTIFY_API_URL=http://localhost:8765/v1 \
+        SPOTIFY_TOKEN_URL=http://localhost:8765/api/token \
+        streamlit run app.py
+
+Or from Python, e.g. in a benchmark script:
+
+        server = MockSpotifyAPI(latency=0.05, error_rate=0.01)
+        base_url = server.start()
+        client = SpotifyClient('id', 'secret', api_url=f'{base_url}/v1', token_url=f'{base_url}/api/token')
+        ...
+        print(server.stats)
+        server.stop()
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SYNTHETIC_GENRES = ['pop', 'k-pop', 'indie rock', 'classic rock', 'hip hop', 'country',
+                    'indie folk', 'electronic', 'jazz', 'punk', 'funk', 'folk-pop',
+                    'alternative rock', 'classical', 'ambient']
+
+def load_fixtures(fixtures_dir, endpoint):
+    """
+    Loads recorded objects from {fixtures_dir}/{endpoint}.jsonl into a dict keyed by id.
+    """
+    path = os.path.join(fixtures_dir, f"{endpoint}.jsonl")
+    if not os.path.exists(path):
+        return {}
+
+    objects = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                objects[item['id']] = item
+    return objects
+
+def _seed(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16)
+
+def synthetic_track(track_id, artist_count=2000):
+    """
+    Returns a deterministic fake /v1/tracks object for an id.
+    """
+    rng = random.Random(_seed(track_id))
+    artist_id = f"artist{rng.randrange(artist_count):06d}"
+    year = rng.randrange(1960, 2025)
+    release_date = rng.choice([f"{year}", f"{year}-{rng.randrange(1, 13):02d}",
+                               f"{year}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"])
+    artist = {'id': artist_id, 'name': f"Artist {artist_id[-6:]}"}
+
+    return {
+        'id': track_id,
+        'name': f"Track {track_id[:8]}",
+        'popularity': rng.randrange(101),
+        'track_number': rng.randrange(1, 15),
+        'artists': [artist],
+        'album': {
+            'name': f"Album {rng.randrange(10000)}",
+            'artists': [artist],
+            'release_date': release_date,
+            'total_tracks': rng.randrange(1, 25)
+        }
+    }
+
+def synthetic_artist(artist_id):
+    """
+    Returns a deterministic fake /v1/artists object for an id.
+    """
+    rng = random.Random(_seed(artist_id))
+    return {
+        'id': artist_id,
+        'name': f"Artist {artist_id[-6:]}",
+        'genres': rng.sample(SYNTHETIC_GENRES, rng.randrange(0, 5))
+    }
+
+class MockSpotifyAPI:
+    """
+    A threaded HTTP server imitating the Spotify endpoints used by the app.
+
+    Parameters
+    ----------
+    fixtures_dir: string
+        optional argument - a folder of recorded tracks.jsonl / artists.jsonl
+
+    latency: float
+        seconds added to every response
+
+    jitter: float
+        up to this many extra seconds of random latency
+
+    error_rate: float
+        the share of requests answered with a 503
+
+    rate_limit_rate: float
+        the share of requests answered with a 429
+
+    retry_after: float
+        the Retry-After sent with each 429
+
+    seed: int
+        optional argument - seeds the error and rate limit injection
+        so runs are reproducible
+    """
+
+    def __init__(self, fixtures_dir=None, latency=0.0, jitter=0.0, error_rate=0.0,
+                 rate_limit_rate=0.0, retry_after=1.0, seed=None):
+        self.tracks = load_fixtures(fixtures_dir, 'tracks') if fixtures_dir else {}
+        self.artists = load_fixtures(fixtures_dir, 'artists') if fixtures_dir else {}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'tokens': 0, 'tracks': 0, 'artists': 0,
+                      'ids': 0, 'rate_limited': 0, 'errors': 0}
+        self.server = None
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def _inject(self):
+        """
+        Sleeps for the configured latency and picks a failure to inject, if any.
+        """
+        with self.lock:
+            roll = self.random.random()
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        time.sleep(delay)
+
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 503
+        return None
+
+    def handle(self, method, path):
+        """
+        Returns the (status, headers, body) for a request.
+        """
+        url = urlparse(path)
+        self._count('requests')
+
+        if url.path == '/stats':
+            with self.lock:
+                return 200, {}, dict(self.stats)
+
+        failure = self._inject()
+        if failure == 429:
+            self._count('rate_limited')
+            return 429, {'Retry-After': str(self.retry_after)}, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}
+        if failure == 503:
+            self._count('errors')
+            return 503, {}, {'error': {'status': 503, 'message': 'Service unavailable'}}
+
+        if method == 'POST' and url.path == '/api/token':
+            self._count('tokens')
+            return 200, {}, {'access_token': 'mock-token', 'token_type': 'Bearer', 'expires_in': 3600}
+
+        ids = [i for i in parse_qs(url.query).get('ids', [''])[0].split(',') if i]
+        if method == 'GET' and url.path == '/v1/tracks':
+            self._count('tracks')
+            self._count('ids', len(ids))
+            return 200, {}, {'tracks': [self.tracks.get(i) or synthetic_track(i) for i in ids]}
+        if method == 'GET' and url.path == '/v1/artists':
+            self._count('artists')
+            self._count('ids', len(ids))
+            return 200, {}, {'artists': [self.artists.get(i) or synthetic_artist(i) for i in ids]}
+
+        return 404, {}, {'error': {'status': 404, 'message': 'Service not found'}}
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, method):
+                # drain any request body so keep-alive connections stay usable
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+
+                status, headers, body = api.handle(method, self.path)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+        return Handler
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Starts the server on a background thread and returns its base URL.
+        Port 0 picks a free port.
+        """
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def serve_forever(self, host='127.0.0.1', port=8765):
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        print(f"Mock Spotify API on http://{host}:{port} "
+              f"({len(self.tracks)} recorded tracks, {len(self.artists)} recorded artists)")
+        self.server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local mock of the Spotify Web API.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fixtures', help="folder of recorded tracks.jsonl / artists.jsonl")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="maximum extra random latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with a 503")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument('--retry-after', type=float, default=1.0, help="Retry-After seconds sent with a 429")
+    parser.add_argument('--seed', type=int, help="seed for reproducible failure injection")
+    args = parser.parse_args()
+
+    MockSpotifyAPI(args.fixtures, args.latency, args.jitter, args.error_rate,
+                   args.rate_limit_rate, args.retry_after, args.seed).serve_forever(args.host, args.port)
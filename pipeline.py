@@ -0,0 +1,321 @@
+"""
+A small stage-level pipeline engine with on-disk caching.
+
+Each Stage names the values it takes and the value it produces. The value
+a stage produces is cached on disk under a fingerprint of the stage (its
+name, the source of the module defining it, its version and parameters)
+and the fingerprints of its inputs.
+Changing one stage, e.g. its parameters, therefore only reruns that stage
+and the stages after it, and a stage whose result is cached never needs
+the stages before it to run at all.
+
+For example:
+
+        pipeline = Pipeline([
+            Stage('clean', clean_listening_data, inputs=['raw'], output='clean'),
+            Stage('analysis', clean_spdata_for_analysis, inputs=['clean'], output='analysis',
+                  params={'list_of_genres': ['rock', 'pop']})
+        ], cache_dir='.cache/pipeline')
+
+        df = pipeline.run({'raw': raw_df})
+        print(pipeline.timings)
+
+Stages must not modify the values they are given, which may belong to
+the caller, e.g. a frame kept in Streamlit's session state. Stages that
+add, rename or drop columns should do so on a shallow copy.
+
+With track_memory=True the peak memory of each stage is measured with
+tracemalloc.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+def fingerprint_value(value):
+    """
+    Returns a SHA-256 fingerprint of a pipeline input.
+
+    DataFrames and Series are fingerprinted from their column names,
+    dtypes and row hashes, anything else from its pickled bytes.
+
+    Parameters
+    ----------
+    value: object
+        the input value
+
+    Returns
+    -------
+    fingerprint : string
+        the hex digest
+    """
+    digest = hashlib.sha256()
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        frame = value.to_frame() if isinstance(value, pd.Series) else value
+        digest.update(repr([(str(column), str(dtype)) for column, dtype in frame.dtypes.items()]).encode('utf-8'))
+        try:
+            digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+            return digest.hexdigest()
+        except TypeError:
+            # unhashable cells, e.g. lists
+            pass
+
+    digest.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    return digest.hexdigest()
+
+def _module_source_hash(module_name):
+    """
+    Returns a SHA-256 of a module's current source, or None if it has
+    none. Not cached, as Streamlit reloads modules edited while it runs.
+    """
+    try:
+        source = inspect.getsource(sys.modules[module_name])
+    except (KeyError, OSError, TypeError):
+        return None
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+def code_fingerprint(func):
+    """
+    Returns a fingerprint of a stage function's code: its name and
+    the source of the whole module defining it, so a change to any
+    helper it calls in that module also changes the fingerprint.
+    """
+    name = getattr(func, '__qualname__', repr(func))
+    source_hash = _module_source_hash(getattr(func, '__module__', None))
+    if source_hash is None:
+        try:
+            source_hash = hashlib.sha256(inspect.getsource(func).encode('utf-8')).hexdigest()
+        except (OSError, TypeError):
+            pass
+    return f"{name}:{source_hash}"
+
+class Stage:
+    """
+    One step of a Pipeline.
+
+    Parameters
+    ----------
+    name: string
+        the stage name, used in timings and cache file names
+
+    func: callable
+        called as func(*inputs, **params, **options)
+
+    inputs: list of strings
+        the names of the values passed to func, in order
+
+    output: string
+        the name of the value func returns
+
+    params: dict
+        optional argument - keyword arguments that change the result,
+        so are part of the fingerprint
+
+    options: dict
+        optional argument - keyword arguments that don't change the
+        result (e.g. credentials or progress callbacks), so aren't
+        part of the fingerprint
+
+    version: string
+        optional argument - bump to invalidate cached results when
+        something outside func's module changes, e.g. a helper
+        module it imports. Changes anywhere in the module defining
+        func are picked up automatically.
+    """
+
+    def __init__(self, name, func, inputs, output, params=None, options=None, version=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.output = output
+        self.params = params or {}
+        self.options = options or {}
+        self.version = version
+
+        self.code = code_fingerprint(func)
+
+    def fingerprint(self, input_fingerprints):
+        """
+        Returns the fingerprint of this stage's output, given the
+        fingerprints of its inputs.
+        """
+        key = json.dumps([self.name, self.version, self.code, self.params, list(input_fingerprints)],
+                         sort_keys=True, default=repr)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def run(self, *args):
+        return self.func(*args, **self.params, **self.options)
+
+class Pipeline:
+    """
+    Runs Stages in dependency order, caching each stage's output on disk.
+
+    After a run, `timings` lists a dict for every stage that was run or
+    loaded from the cache: its 'stage' name, the 'seconds' it took,
+    whether it was 'cached' and, when tracking memory, its 'peak_mb'.
+
+    Parameters
+    ----------
+    stages: list of Stage
+        the stages, each after the stages it takes inputs from
+
+    cache_dir: string
+        the folder cached outputs are pickled to
+
+    max_bytes: int
+        the maximum total size of the cached outputs under
+        cache_root, least recently used ones are removed first
+
+    cache_root: string
+        optional argument - the folder max_bytes applies to,
+        defaults to cache_dir. Pipelines caching to subfolders of
+        one root, e.g. one per user, share its limit.
+
+    track_memory: bool
+        optional argument - record the peak memory allocated while
+        each stage ran, counting memory allocated since the run
+        started. Tracing slows the stages down.
+    """
+
+    def __init__(self, stages, cache_dir, max_bytes=1 << 30, cache_root=None, track_memory=False):
+        self.stages = stages
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.cache_root = cache_root or cache_dir
+        self.track_memory = track_memory
+        self.timings = []
+        self.producers = {stage.output: stage for stage in stages}
+
+    def _cache_path(self, stage, fingerprint):
+        return os.path.join(self.cache_dir, f"{stage.name}-{fingerprint[:32]}.pkl")
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None, False
+        except Exception as e:
+            print(f"Ignoring unreadable pipeline cache {path}: {e}")
+            return None, False
+
+        # mark as recently used
+        os.utime(path)
+        return value, True
+
+    def _save(self, path, value):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        """
+        Removes the least recently used outputs under cache_root
+        until they fit in max_bytes, never removing `keep`.
+        """
+        cached = []
+        for folder, _, names in os.walk(self.cache_root):
+            for name in names:
+                if name.endswith('.pkl'):
+                    cached_path = os.path.join(folder, name)
+                    try:
+                        stat = os.stat(cached_path)
+                    except FileNotFoundError:
+                        continue
+                    cached.append((stat.st_mtime, stat.st_size, cached_path))
+
+        total = 0
+        for _, size, cached_path in sorted(cached, reverse=True):
+            total += size
+            if total > self.max_bytes and cached_path != keep:
+                try:
+                    os.remove(cached_path)
+                except FileNotFoundError:
+                    pass
+
+    def run(self, inputs, fingerprints=None, output=None):
+        """
+        Produces a value, running only the stages whose outputs
+        aren't cached.
+
+        Parameters
+        ----------
+        inputs: dict
+            the pipeline's input values by name
+
+        fingerprints: dict
+            optional argument - fingerprints of the inputs by name, e.g.
+            hashes of the files they were read from. Inputs without one
+            are fingerprinted with fingerprint_value().
+
+        output: string
+            optional argument - the value to produce, defaults to
+            the output of the last stage
+
+        Returns
+        -------
+        value : object
+            the produced value
+        """
+        fingerprints = dict(fingerprints or {})
+        for name, value in inputs.items():
+            if not fingerprints.get(name):
+                fingerprints[name] = fingerprint_value(value)
+
+        # the fingerprint of every stage's output follows from its inputs'
+        for stage in self.stages:
+            fingerprints[stage.output] = stage.fingerprint([fingerprints[name] for name in stage.inputs])
+
+        self.timings = []
+        target = output or self.stages[-1].output
+
+        started_tracing = self.track_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        try:
+            return self._resolve(target, dict(inputs), fingerprints)
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+    def _resolve(self, name, values, fingerprints):
+        if name in values:
+            return values[name]
+
+        stage = self.producers[name]
+        path = self._cache_path(stage, fingerprints[name])
+
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        start = time.time()
+        value, cached = self._load(path)
+        if not cached:
+            args = [self._resolve(input_name, values, fingerprints) for input_name in stage.inputs]
+            if self.track_memory:
+                tracemalloc.reset_peak()
+            start = time.time()
+            value = stage.run(*args)
+            self._save(path, value)
+
+        timing = {'stage': stage.name, 'seconds': time.time() - start, 'cached': cached}
+        if self.track_memory:
+            timing['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        self.timings.append(timing)
+
+        print(f"{stage.name}: {timing['seconds']:.2f}s"
+              + (f", peak {timing['peak_mb']:.0f} MB" if self.track_memory else '')
+              + (' (cached)' if cached else ''))
+
+        # stage outputs aren't kept, each is only passed on to the stage needing it
+        return value
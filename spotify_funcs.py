@@ -29,12 +29,46 @@ import numpy as np
 import os, requests, base64
 import re
 import ast
+import calendar
+import glob
+import io
 import json
+import hashlib
+import itertools
+import multiprocessing
+import random
+import shutil
+import sqlite3
+import threading
+import time
+import posixpath
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from sklearn.metrics.pairwise import euclidean_distances
 from sklearn.preprocessing import OneHotEncoder
 import streamlit as st
 from supabase import create_client
 import tempfile
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from pipeline import Pipeline, Stage
+from streaming_history import (StreamingHistoryBuffer, disk_path, history_source, iter_json_array,
+                               read_history_source)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where saves are only serialised within a process
+    fcntl = None
+
+# the pipeline stages work on shallow copies, which only share their data under pandas
+# Copy-on-Write (the default from pandas 3), so it is enabled for any process using this
+# module, the app, notebooks and scripts alike, before any enrichment threads start
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
 
 # General Helper Functions
 
@@ -60,11 +94,63 @@ def ms_to_minutes_seconds(duration_ms):
     seconds = (duration_ms % 60000) // 1000
     return f"{minutes} min {seconds} sec"
 
+# Spotify's release_date_precision values, in order of the parts present
+RELEASE_DATE_PRECISIONS = ['year', 'month', 'day']
+
+def parse_release_dates(values):
+    """
+    Parses release dates given as 'YYYY', 'YYYY-MM' or 'YYYY-MM-DD'
+    in one vectorized pass, defaulting missing months and days to 1.
+
+    Only the unique values are parsed and the results are mapped
+    back, since there are far fewer release dates than plays.
+
+    Parameters
+    ----------
+    values : pandas.core.series.Series
+        the release date strings
+
+    Returns
+    -------
+    dates : pandas.core.series.Series
+        the parsed dates, NaT where a value is missing or invalid
+
+    precision : pandas.core.series.Series
+        a categorical of 'year', 'month' or 'day' giving the
+        parts present in each value, null where it didn't parse
+    """
+    codes, uniques = pd.factorize(values)
+
+    # split each unique value into its year, month and day parts
+    parts = pd.Series(uniques, dtype='object').astype(str).str.extract(r'^(\d{4})(?:-(\d{2}))?(?:-(\d{2}))?$')
+    present = parts.notna()
+    parsed = pd.to_datetime(pd.DataFrame({
+                                'year': pd.to_numeric(parts[0]),
+                                'month': pd.to_numeric(parts[1]).fillna(1),
+                                'day': pd.to_numeric(parts[2]).fillna(1)
+                                }), errors='coerce')
+
+    # the number of parts present, less one, indexes RELEASE_DATE_PRECISIONS
+    unique_precision = present.sum(axis=1).to_numpy() - 1
+    unique_precision[parsed.isna().to_numpy()] = -1
+
+    # map back to every row, with code -1 (a missing value) picking the trailing NaT / -1
+    unique_dates = np.append(parsed.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT'))
+    unique_precision = np.append(unique_precision, -1)
+
+    dates = pd.Series(unique_dates[codes], index=values.index)
+    precision = pd.Series(pd.Categorical.from_codes(unique_precision[codes], RELEASE_DATE_PRECISIONS), index=values.index)
+    return dates, precision
+
 def convert_to_datetime(df, column):
     """
     This is a helper function that converts a date column with
     mixed values into a datetime function.
 
+    The precision of each value is recorded in a
+    '{column}_precision' column. Columns that are already
+    datetime are left as they are.
+
     Original Author: Katy Mombourquette
 
     Parameters
@@ -82,35 +168,63 @@ def convert_to_datetime(df, column):
         date column
     """
 
-    df[column] = df[column].astype(str)
+    # already converted, e.g. by an earlier pipeline step
+    if pd.api.types.is_datetime64_any_dtype(df[column]):
+        return df
+
+    df[column], df[f'{column}_precision'] = parse_release_dates(df[column])
 
-    # fill date column with a placeholder
-    # this avoids errors when string matching
-    df[column] = df[column].fillna('NA')
+    return df
 
-    # string match different cases of values
+def track_ids_from_uris(uris):
+    """
+    Returns the track id (last part) of each 'spotify:track:<id>' URI.
 
-    # case one: 'YYYY'
-    year_only_mask = df[column].str.match(r'^\d{4}$')
+    Only the distinct URIs are split, so every play of a track shares
+    one id string instead of getting its own copy.
 
-    # case two: 'YYYY-MM'
-    year_month_mask = df[column].str.match(r'^\d{4}-\d{2}$')
+    Parameters
+    ----------
+    uris : pandas.core.series.Series
+        the track URIs
 
-    # convert identified rows to datetime with default month and day
-    # set errors to NaT with errors='coerce'
-    df.loc[year_only_mask, column] = pd.to_datetime(df.loc[year_only_mask, column].astype(str) + '-01-01', errors='coerce')
-    df.loc[year_month_mask, column] = pd.to_datetime(df.loc[year_month_mask, column] + '-01', errors='coerce')
+    Returns
+    -------
+    track_ids : numpy.ndarray
+        object array of ids, None where the URI is null
+    """
+    codes, uniques = pd.factorize(uris)
+    ids = pd.Series(uniques, dtype='object').str.split(':').str[-1].to_numpy(dtype='object')
+    return np.append(ids, None)[codes]
 
-    # convert the other rows
-    df.loc[~(year_only_mask | year_month_mask), column] = pd.to_datetime(df.loc[~(year_only_mask | year_month_mask), column], errors='coerce')
+def lowercase_pair_key(left, right, separator=' - '):
+    """
+    Returns 'left - right' lowercased for each row, e.g. the
+    'track-artist' key, built once per distinct pair and shared
+    by every row with that pair.
 
-    # convert any remaining string values
-    df[column] = pd.to_datetime(df[column], errors='coerce')
+    Parameters
+    ----------
+    left, right : pandas.core.series.Series
+        the two parts of the key
 
-    # replace placeholder with NaN
-    df[column] = df[column].replace('NA', np.nan)
+    Returns
+    -------
+    keys : numpy.ndarray
+        object array of keys, NaN where either part is null
+    """
+    left_codes, left_uniques = pd.factorize(left)
+    right_codes, right_uniques = pd.factorize(right)
 
-    return df
+    # one code per distinct (left, right) pair
+    pair_codes, pairs = pd.factorize(left_codes.astype('int64') * (len(right_uniques) + 1) + right_codes)
+    left_pairs, right_pairs = np.divmod(pairs, len(right_uniques) + 1)
+
+    left_values = pd.Series(np.append(pd.Series(left_uniques, dtype='object').str.lower().to_numpy(dtype='object'), np.nan))
+    right_values = pd.Series(np.append(pd.Series(right_uniques, dtype='object').str.lower().to_numpy(dtype='object'), np.nan))
+    keys = left_values.iloc[left_pairs].reset_index(drop=True) + separator + right_values.iloc[right_pairs].reset_index(drop=True)
+
+    return keys.to_numpy(dtype='object')[pair_codes]
 
 def rate_artist_complexity(df):
     """
@@ -129,12 +243,181 @@ def rate_artist_complexity(df):
 default_id = st.secrets["CLIENT_ID"]
 default_secret = st.secrets["CLIENT_SECRET"]
 
+# the Spotify endpoints, overridable to point the app at a local mock server
+# (see mock_spotify_api.py)
+SPOTIFY_API_URL = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+SPOTIFY_TOKEN_URL = os.environ.get('SPOTIFY_TOKEN_URL', 'https://accounts.spotify.com/api/token')
+
+# when set, every track/artist object fetched is appended to fixture files here
+SPOTIFY_RECORD_DIR = os.environ.get('SPOTIFY_RECORD_DIR')
+
+# one pooled keep-alive session per host, shared by every client
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(url, pool_size=16):
+    """
+    Returns the shared requests.Session for the host of a URL, so
+    connections (and their TLS handshakes) are reused across calls.
+    """
+    host = urlparse(url).netloc
+    with _http_sessions_lock:
+        if host not in _http_sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[host] = session
+        return _http_sessions[host]
+
+class SpotifyClient:
+    """
+    A shared client for the Spotify Web API.
+
+    The client-credentials access token is cached until shortly before
+    it expires, and requests go through the pooled per-host sessions
+    from get_http_session(). Use get_spotify_client() to share one
+    client per set of credentials.
+
+    Parameters
+    ----------
+    client_id: string
+        the user's client id
+
+    client_secret: string
+        the user's client secret
+
+    access_token: string
+        optional argument - a ready-made access token to use
+        instead of requesting one with the credentials
+
+    expiry_margin: float
+        how many seconds before expiry a token is replaced
+
+    api_url: string
+        optional argument - the base URL of the Web API,
+        defaults to SPOTIFY_API_URL
+
+    token_url: string
+        optional argument - the token endpoint, defaults
+        to SPOTIFY_TOKEN_URL
+
+    record_dir: string
+        optional argument - a folder to record every fetched
+        object into as replayable fixtures, defaults to
+        SPOTIFY_RECORD_DIR
+    """
+
+    def __init__(self, client_id=None, client_secret=None, access_token=None, expiry_margin=60,
+                 api_url=None, token_url=None, record_dir=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.expiry_margin = expiry_margin
+        self.api_url = (api_url or SPOTIFY_API_URL).rstrip('/')
+        self.token_url = token_url or SPOTIFY_TOKEN_URL
+        self.record_dir = record_dir or SPOTIFY_RECORD_DIR
+        self._token = access_token
+        self._expires_at = float('inf') if access_token else 0.0
+        self._lock = threading.Lock()
+
+    def access_token(self):
+        """
+        Returns a valid access token, requesting a new one only
+        when the cached token is missing or about to expire.
+        """
+        with self._lock:
+            if self._token and time.time() < self._expires_at - self.expiry_margin:
+                return self._token
+
+            if self.client_id is None:
+                raise ValueError("Access token expired and no client credentials to renew it.")
+
+            # Base64 encode the client_id and client_secret
+            credentials = f"{self.client_id}:{self.client_secret}"
+            base64_credentials = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
+            headers = {'Authorization': f'Basic {base64_credentials}'}
+            payload = {'grant_type': 'client_credentials'}
+
+            # Send the POST request to obtain the access token
+            response = get_http_session(self.token_url).post(self.token_url, data=payload, headers=headers, timeout=30)
+
+            # Check if the request was successful
+            response.raise_for_status()
+
+            token_data = response.json()
+            self._token = token_data.get('access_token')
+            self._expires_at = time.time() + token_data.get('expires_in', 3600)
+            return self._token
+
+    def invalidate_token(self):
+        """
+        Drops a token the API has rejected so the next call requests a new one.
+        Returns False if the token can't be renewed.
+        """
+        with self._lock:
+            if self.client_id is None:
+                return False
+            self._token = None
+            return True
+
+    def get(self, url, **kwargs):
+        """
+        Sends an authorised GET request through the shared session for the URL's host.
+        """
+        headers = {'Authorization': f'Bearer {self.access_token()}'}
+        return get_http_session(url).get(url, headers=headers, **kwargs)
+
+    def record(self, url, response_data):
+        """
+        Appends the objects of a successful batch response to
+        {record_dir}/{endpoint}.jsonl, e.g. tracks.jsonl, which
+        mock_spotify_api.py can replay.
+        """
+        if not self.record_dir:
+            return
+
+        endpoint = urlparse(url).path.rstrip('/').split('/')[-1]
+        items = response_data.get(endpoint.replace('-', '_'), [])
+
+        with self._lock:
+            os.makedirs(self.record_dir, exist_ok=True)
+            with open(os.path.join(self.record_dir, f"{endpoint}.jsonl"), 'a', encoding='utf-8') as f:
+                for item in items:
+                    if item is not None:
+                        f.write(json.dumps(item) + "\n")
+
+_spotify_clients = {}
+_spotify_clients_lock = threading.Lock()
+
+def get_spotify_client(client_id=default_id, client_secret=default_secret):
+    """
+    Returns the shared SpotifyClient for a set of credentials,
+    creating it on first use.
+    """
+    with _spotify_clients_lock:
+        key = (client_id, client_secret)
+        if key not in _spotify_clients:
+            _spotify_clients[key] = SpotifyClient(client_id, client_secret)
+        return _spotify_clients[key]
+
+def as_spotify_client(client):
+    """
+    Wraps a bare access token string in a SpotifyClient, so the fetch
+    functions accept either.
+    """
+    if isinstance(client, SpotifyClient):
+        return client
+    return SpotifyClient(access_token=client)
+
 def spotify_access(client_id_param=default_id, client_secret_param=default_secret):
     """
     Returns the access token used to make requests from the Spotify API
     Requires the user to request a client id and secret from Spotify's API
     webpage.
 
+    The token is cached by the shared SpotifyClient for these credentials
+    and only requested again shortly before it expires.
+
     Original author: David Mombourquette
 
     Parameters
@@ -150,52 +433,319 @@ def spotify_access(client_id_param=default_id, client_secret_param=default_secre
     access_token: string
         the access token used in API calls
     """
-    # Set the necessary parameters
-    token_url = 'https://accounts.spotify.com/api/token'
-    payload = {'grant_type': 'client_credentials'}
+    return get_spotify_client(client_id_param, client_secret_param).access_token()
 
-    # Base64 encode the client_id and client_secret
-    credentials = f"{client_id_param}:{client_secret_param}"
-    base64_credentials = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
-    headers = {'Authorization': f'Basic {base64_credentials}'}
+# uploads smaller than this are parsed serially, starting a worker pool costs more than it saves
+PARALLEL_INGEST_MIN_BYTES = 16 * 1024 * 1024
 
-    # Use 'requests' Session for improved performance
-    with requests.Session() as session:
-        # Send the POST request to obtain the access token
-        response = session.post(token_url, data=payload, headers=headers)
+def _file_size(file):
+    """
+    Returns the size in bytes of an uploaded or open file.
+    """
+    size = getattr(file, 'size', None)
+    if size is not None:
+        return size
 
-    # Check if the request was successful
-    response.raise_for_status()
+    position = file.tell()
+    size = file.seek(0, os.SEEK_END)
+    file.seek(position)
+    return size
 
-    # Extract the access token from the response
-    access_token = response.json().get('access_token')
+def _read_spotify_json_parallel(audio_files, workers, progress_callback=None):
+    """
+    Parses streaming history files on a process pool and concatenates
+    the results in the original file order.
 
-    return access_token
+    At most `workers` files are in flight at once. Workers open files
+    on disk themselves, so only in-memory uploads are copied to them.
+    The pool is spawned rather than forked, as the app process runs
+    threads.
+    """
+    frames = [None] * len(audio_files)
+    files = enumerate(audio_files)
+    pending = {}
+    done = 0
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        while True:
+            for idx, file in itertools.islice(files, workers - len(pending)):
+                pending[executor.submit(read_history_source, history_source(file))] = idx
+            if not pending:
+                break
+
+            # report progress as files finish, in whatever order that happens
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                frames[pending.pop(future)] = future.result()
+                done += 1
+                if progress_callback is not None:
+                    progress_callback(done, len(audio_files))
+
+    return pd.concat(frames, ignore_index=True)
+
+def _is_audio_history(name):
+    """
+    Checks whether a file name belongs to a Streaming_History_Audio JSON file.
+    ZIP member names include their folder, so only the base name is checked.
+    """
+    name = posixpath.basename(name.replace('\\', '/'))
+    return name.startswith("Streaming_History_Audio") and name.endswith(".json")
 
-def read_spotify_json(file_list):
-    print(f"Reading Spotify JSON files for.")
+def _expand_spotify_exports(file_list, opened):
+    """
+    Replaces any Spotify export ZIP archives in a list of files with the
+    audio history files they contain.
 
-    audio_data = []
+    Members are opened as streams straight from the archive, nothing is
+    extracted to disk. PDFs, video history and other members are skipped.
+
+    Parameters
+    ----------
+    file_list : list
+        file-like objects with a `name` attribute
+
+    opened : list
+        the archives and members opened are appended here,
+        for the caller to close
+
+    Returns
+    -------
+    files : list
+        the audio history files, ZIP members sorted by name
+    """
+    files = []
 
-    # Loop through each uploaded file
     for file in file_list:
-        if file.name.startswith("Streaming_History_Audio") and file.name.endswith(".json"):
-            # Read directly as a pandas DataFrame
-            try:
-                data = pd.read_json(file)
-                audio_data.append(data)
-            except ValueError:
-                # Fallback if read_json fails (e.g. non-UTF8 or unexpected structure)
-                file.seek(0)
-                data = json.load(file)
-                audio_data.append(pd.DataFrame(data))
+        if not file.name.lower().endswith('.zip'):
+            files.append(file)
+            continue
+
+        archive = zipfile.ZipFile(file)
+        opened.append(archive)
+        members = [info for info in archive.infolist()
+                   if not info.is_dir() and _is_audio_history(info.filename)]
+
+        for info in sorted(members, key=lambda info: info.filename):
+            member = archive.open(info)
+            opened.append(member)
+            # the uncompressed size, so sizing the member never decompresses it
+            member.size = info.file_size
+            # different exports contain members of the same name, so qualify it with the archive's
+            member.name = f"{file.name}/{info.filename}"
+            # parallel ingest workers reopen members of archives on disk themselves
+            if disk_path(file) is not None:
+                member.archive_path, member.member_name = disk_path(file), info.filename
+            files.append(member)
+
+    return files
+
+@contextmanager
+def open_spotify_sources(file_list, names=None):
+    """
+    Opens the audio history files in a list of uploaded files, with
+    any export ZIP archives expanded into their members, and closes
+    the archives and members again on exit. The uploaded files
+    themselves are left open.
+
+    For example:
+
+            with open_spotify_sources(uploaded_files) as sources:
+                fingerprints = {get_source_fingerprint(source): source.name for source in sources}
+
+    Parameters
+    ----------
+    file_list : list
+        file-like objects with a `name` attribute
+
+    names : collection of strings
+        optional argument - only open the sources with these
+        names, e.g. the new ones from an earlier listing
+
+    Yields
+    ------
+    sources : list
+        the Streaming_History_Audio JSON files. ZIP members are
+        named '<archive name>/<member path>'.
+    """
+    opened = []
+    try:
+        sources = [file for file in _expand_spotify_exports(file_list, opened)
+                   if _is_audio_history(file.name) and (names is None or file.name in names)]
+        yield sources
+    finally:
+        for file in reversed(opened):
+            file.close()
+
+def get_source_fingerprint(file, chunk_size=1 << 20):
+    """
+    Returns a SHA-256 fingerprint of a file's content, used to
+    recognise export files that have already been processed.
+
+    Parameters
+    ----------
+    file : file-like
+        an uploaded file or ZIP member from open_spotify_sources()
+
+    Returns
+    -------
+    fingerprint : string
+        the hex digest of the file's content
+    """
+    digest = hashlib.sha256()
+
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        digest.update(chunk)
+    file.seek(0)
+
+    return digest.hexdigest()
+
+def add_play_keys(stats_raw):
+    """
+    Adds a play_key column to raw plays: the make_play_ids() hash of
+    ts, spotify_track_uri, ms_played and platform. It identifies each
+    play in 8 bytes, for deduplicating plays from overlapping exports,
+    and becomes the play's unique_id in the analysis dataframe.
+    """
+    stats_raw['play_key'] = make_play_ids(stats_raw['ts'], stats_raw['spotify_track_uri'],
+                                          stats_raw['ms_played'], stats_raw['platform'])
+    return stats_raw
 
-    if not audio_data:
+def read_spotify_json(file_list, streaming=False, progress_callback=None, workers=None, source_names=None):
+    """
+    Reads the Streaming_History_Audio JSON files of a Spotify extended
+    streaming history export into a single DataFrame.
+
+    Parameters
+    ----------
+    file_list : list
+        file-like objects with a `name` attribute, such as
+        Streamlit uploaded files. Spotify export ZIP archives
+        are read directly without extracting them. Files that
+        are not audio history files are skipped.
+
+    streaming : bool
+        optional argument - parse the files incrementally into typed
+        column buffers instead of loading each file whole. This keeps
+        peak memory close to the size of the final DataFrame.
+
+    progress_callback : callable
+        optional argument - called as progress_callback(done, total)
+        after each file is read
+
+    workers : int
+        optional argument - the number of processes used to parse
+        files in parallel. Defaults to one per CPU. Files are read
+        serially when this is 1 or the upload is smaller than
+        PARALLEL_INGEST_MIN_BYTES. The parallel path always uses
+        the streaming parser.
+
+    source_names : collection of strings
+        optional argument - only read the audio history files with
+        these names, as given by open_spotify_sources()
+
+    Returns
+    -------
+    stats_raw : pandas.core.frame.DataFrame
+        the user's raw listening history, with a
+        play_key column from add_play_keys()
+    """
+    print(f"Reading Spotify JSON files.")
+
+    with open_spotify_sources(file_list, source_names) as audio_files:
+        if not audio_files:
+            raise FileNotFoundError("No valid Spotify audio history JSON files found.")
+
+        stats_raw = _read_audio_files(audio_files, streaming, progress_callback, workers)
+
+    # an export of empty files has no columns to build the analysis data from
+    if stats_raw.empty:
         raise FileNotFoundError("No valid Spotify audio history JSON files found.")
 
-    stats_raw = pd.concat(audio_data, ignore_index=True)
     print(f"Loaded {len(stats_raw)} records from Spotify JSON files.")
-    return stats_raw
+    return add_play_keys(stats_raw)
+
+def _read_audio_files(audio_files, streaming, progress_callback, workers):
+    """
+    Reads opened audio history files into one DataFrame, the body of
+    read_spotify_json().
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(audio_files))
+
+    if workers > 1 and sum(_file_size(file) for file in audio_files) >= PARALLEL_INGEST_MIN_BYTES:
+        print(f"Parsing {len(audio_files)} files using {workers} workers.")
+        return _read_spotify_json_parallel(audio_files, workers, progress_callback)
+
+    if streaming:
+        buffer = StreamingHistoryBuffer()
+        for idx, file in enumerate(audio_files):
+            file.seek(0)
+            buffer.extend(file)
+            if progress_callback is not None:
+                progress_callback(idx + 1, len(audio_files))
+
+        return buffer.to_frame()
+
+    audio_data = []
+
+    # Loop through each uploaded file
+    for idx, file in enumerate(audio_files):
+        # Read directly as a pandas DataFrame
+        try:
+            data = pd.read_json(file)
+            audio_data.append(data)
+        except ValueError:
+            # Fallback if read_json fails (e.g. non-UTF8 or unexpected structure)
+            file.seek(0)
+            data = json.load(file)
+            audio_data.append(pd.DataFrame(data))
+
+        if progress_callback is not None:
+            progress_callback(idx + 1, len(audio_files))
+
+    return pd.concat(audio_data, ignore_index=True)
+
+def iter_spotify_json_chunks(file_list, chunk_rows=250_000):
+    """
+    Streams the audio history in a list of uploaded files as
+    DataFrames of at most `chunk_rows` rows, so a history of any
+    length can be processed in bounded memory.
+
+    Parameters
+    ----------
+    file_list : list
+        file-like objects with a `name` attribute, as for
+        read_spotify_json()
+
+    chunk_rows : int
+        the maximum number of plays per DataFrame
+
+    Yields
+    ------
+    stats_raw : pandas.core.frame.DataFrame
+        the next batch of raw plays, with play keys
+    """
+    with open_spotify_sources(file_list) as audio_files:
+        if not audio_files:
+            raise FileNotFoundError("No valid Spotify audio history JSON files found.")
+
+        buffer = StreamingHistoryBuffer(chunk_rows)
+        chunks = 0
+        for file in audio_files:
+            file.seek(0)
+            for record in iter_json_array(file):
+                buffer.append(record)
+                if buffer.size == chunk_rows:
+                    yield add_play_keys(buffer.to_frame())
+                    buffer = StreamingHistoryBuffer(chunk_rows)
+                    chunks += 1
+
+    if buffer.size:
+        yield add_play_keys(buffer.to_frame())
+    elif not chunks:
+        raise FileNotFoundError("No valid Spotify audio history JSON files found.")
 
 
 def get_user_track_ids(user_data):
@@ -221,7 +771,7 @@ def get_user_track_ids(user_data):
         found in the user's Spotify listening data
     """
     # create track id column
-    user_data['track_id'] = user_data['spotify_track_uri'].str.split(':').str[-1]
+    user_data['track_id'] = track_ids_from_uris(user_data['spotify_track_uri'])
 
     # count tracks
     track_counts = user_data['track_id'].value_counts().reset_index()
@@ -237,76 +787,461 @@ def get_user_track_ids(user_data):
 
 from tqdm import tqdm
 
-def get_multiple_tracks_response(track_ids, access_token):
+class TokenBucket:
     """
-    Fetches metadata for multiple track IDs from Spotify API using Streamlit-friendly progress bar.
+    A thread-safe token bucket that limits how fast requests are sent.
+
+    Tokens refill at `rate` per second up to `capacity`. When the API
+    answers 429 with a Retry-After, pause() holds back every caller
+    until that time has passed.
     """
-    basic_df = pd.DataFrame()
 
-    chunk_size = 50
-    total = len(track_ids)
-    num_chunks = (total + chunk_size - 1) // chunk_size
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Stops all requests for the given number of seconds.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+def retry_after_seconds(value, default, limit):
+    """
+    Returns how long a 429's Retry-After header asks to wait, given
+    in seconds or as an HTTP date, capped at `limit`. Missing or
+    unreadable values fall back to `default`.
+    """
+    if not value:
+        return min(default, limit)
 
-    # Streamlit progress UI
-    st.write("🎵 Fetching track metadata from Spotify...")
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            seconds = default
+
+    if np.isnan(seconds):
+        seconds = default
+    return min(max(seconds, 0.0), limit)
+
+class SpotifyBatchFetcher:
+    """
+    Sends batched `?ids=` requests to the Spotify API on a thread pool.
+
+    Concurrency is bounded by `max_workers` and the request rate by a
+    TokenBucket. Rate-limited (429), server error and network failures
+    are retried with exponential backoff, honouring Retry-After.
+
+    Parameters
+    ----------
+    client: SpotifyClient or string
+        the shared API client, or a bare access token
+
+    max_workers: int
+        the number of requests in flight at once
+
+    requests_per_second: float
+        the sustained request rate
+
+    max_retries: int
+        how many times a failed batch is retried before giving up
+
+    backoff: float
+        the base delay in seconds between retries, doubled on each attempt
+
+    max_pause: float
+        the longest a Retry-After may hold back every request, in seconds
+    """
+
+    def __init__(self, client, max_workers=4, requests_per_second=10, max_retries=5, backoff=1.0,
+                 max_pause=60.0):
+        self.client = as_spotify_client(client)
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_pause = max_pause
+        self.failed_batches = 0
+
+    def _get(self, url, ids):
+        """
+        Requests one batch of ids, retrying until it succeeds or
+        max_retries is reached. Returns the decoded JSON or None.
+        """
+        params = {'ids': ",".join(ids)}
+
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+            try:
+                response = self.client.get(url, params=params, timeout=30)
+            except requests.RequestException as e:
+                print(f"Request to {url} failed: {e}")
+                time.sleep(delay)
+                continue
+
+            if response.status_code == 429:
+                # back off for as long as the API asks, for every worker
+                self.bucket.pause(retry_after_seconds(response.headers.get('Retry-After'), delay,
+                                                      self.max_pause))
+                continue
+
+            if response.status_code >= 500:
+                time.sleep(delay)
+                continue
+
+            if response.status_code == 401 and self.client.invalidate_token():
+                # the cached token expired mid-run, retry with a fresh one
+                continue
+
+            if response.status_code != 200:
+                # other client errors (bad token, bad ids) won't succeed on retry
+                print(f"Error {response.status_code} from {url}: {response.text[:500]}")
+                return None
+
+            try:
+                response_data = response.json()
+            except ValueError:
+                print(f"Failed to decode JSON response from {url}.")
+                time.sleep(delay)
+                continue
+
+            self.client.record(url, response_data)
+            return response_data
+
+        return None
+
+    def fetch(self, url, id_chunks, progress_callback=None, checkpoint=None):
+        """
+        Requests every chunk of ids and returns the decoded JSON
+        responses in chunk order. Chunks that still fail after
+        retrying are counted in failed_batches and returned as None,
+        or with only the objects saved in the checkpoint.
+
+        Parameters
+        ----------
+        url: string
+            the API endpoint, e.g. client.api_url + '/tracks'
+
+        id_chunks: list of lists
+            the ids to request, at most 50 per chunk
+
+        progress_callback: callable
+            optional argument - called as progress_callback(done, total)
+            from the calling thread as chunks complete
+
+        checkpoint: EnrichmentCheckpoint
+            optional argument - ids already saved in the checkpoint
+            are not requested again, and each newly fetched chunk is
+            saved as soon as it arrives
+
+        Returns
+        -------
+        responses: list
+            the decoded JSON response for each chunk
+        """
+        responses = [None] * len(id_chunks)
+        pending = {}
+        endpoint = api_endpoint(url)
+
+        # resume from the checkpoint of an interrupted run, requesting only the ids it lacks
+        saved = checkpoint.load_items(url) if checkpoint is not None else {}
+        for i, chunk in enumerate(id_chunks):
+            missing = [item_id for item_id in chunk if item_id not in saved]
+            if missing:
+                pending[i] = missing
+            if len(missing) < len(chunk):
+                responses[i] = {endpoint: [saved[item_id] for item_id in chunk if item_id in saved]}
+
+        done = len(id_chunks) - len(pending)
+        resumed = sum(item_id in saved for chunk in id_chunks for item_id in chunk)
+        if resumed:
+            print(f"Resumed {resumed} ids from checkpoint, {len(pending)} of {len(id_chunks)} batches left.")
+            if progress_callback is not None:
+                progress_callback(done, len(id_chunks))
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._get, url, missing): i for i, missing in pending.items()}
+
+            for future in as_completed(futures):
+                i = futures[future]
+                response_data = future.result()
+                if response_data is None:
+                    failed += 1
+                else:
+                    if checkpoint is not None:
+                        checkpoint.save(url, pending[i], response_data)
+                    if responses[i] is not None:
+                        # put the saved and fetched objects back in the chunk's order
+                        fetched = dict(zip(pending[i], response_data.get(endpoint, [])))
+                        response_data = {endpoint: [saved[item_id] if item_id in saved else fetched.get(item_id)
+                                                    for item_id in id_chunks[i]]}
+                    responses[i] = response_data
+
+                done += 1
+                if progress_callback is not None:
+                    progress_callback(done, len(id_chunks))
+
+        self.failed_batches += failed
+        return responses
+
+def api_endpoint(url):
+    """
+    Returns the last part of an API URL's path, e.g. 'tracks', which
+    is also the key of the objects in its responses.
+    """
+    return urlparse(url).path.rstrip('/').split('/')[-1]
+
+def safe_user_folder(user_id):
+    """
+    Returns a user id made safe to use as a folder name.
+    """
+    return re.sub(r'[^\w-]', '_', str(user_id))
+
+class EnrichmentCheckpoint:
+    """
+    Durable storage for the API batches of one enrichment run, so a run
+    interrupted part way (e.g. a Streamlit session dying) can resume
+    without repeating completed requests.
+
+    Each completed batch response is written to its own JSON file under
+    SPOTIFY_CACHE_DIR/checkpoints/<user_id>/<run_id>/, along with the
+    ids it was requested for. A resumed run matches the saved objects
+    by id, so it doesn't matter if its batches are split differently,
+    e.g. because the shared caches answered more of the ids.
+
+    Parameters
+    ----------
+    user_id: string
+        the user the run belongs to
+
+    run_id: string
+        identifies the run, e.g. a fingerprint of all the track ids
+        being enriched, before any are found in the shared caches,
+        so a retry of the same upload resumes it
+
+    ttl_days: float
+        runs that failed or were abandoned are kept this long for a
+        retry to resume, and swept when any later run starts
+    """
+
+    def __init__(self, user_id, run_id, ttl_days=7):
+        self.path = os.path.join(SPOTIFY_CACHE_DIR, 'checkpoints', safe_user_folder(user_id), str(run_id))
+        self.sweep(ttl_days)
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def sweep(ttl_days):
+        """
+        Removes the checkpoints of every user's runs not written to
+        for `ttl_days`, which never finished and were not retried.
+        """
+        root = os.path.join(SPOTIFY_CACHE_DIR, 'checkpoints')
+        cutoff = time.time() - ttl_days * 24 * 60 * 60
+
+        for user_dir in glob.glob(os.path.join(root, '*', '')):
+            for run_dir in glob.glob(os.path.join(user_dir, '*', '')):
+                try:
+                    # saving a batch replaces a file in the folder, updating its mtime
+                    if os.path.getmtime(run_dir) < cutoff:
+                        shutil.rmtree(run_dir, ignore_errors=True)
+                except OSError:
+                    continue
+            try:
+                os.rmdir(user_dir)
+            except OSError:
+                # the user still has runs in progress
+                pass
+
+    def _batch_path(self, url, ids):
+        key = hashlib.sha1(",".join(ids).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f"{api_endpoint(url)}_{key}.json")
+
+    def load_items(self, url):
+        """
+        Returns every object saved for an endpoint so far, keyed by the
+        id it was requested with. Ids the API answered with null map
+        to None.
+        """
+        endpoint = api_endpoint(url)
+        items = {}
+
+        for path in glob.glob(os.path.join(self.path, f"{endpoint}_*.json")):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    batch = json.load(f)
+                items.update(zip(batch['ids'], batch['response'][endpoint]))
+            except (FileNotFoundError, ValueError, KeyError, TypeError):
+                continue
+
+        return items
+
+    def save(self, url, ids, response_data):
+        """
+        Saves a completed batch response with the ids it was requested
+        for, atomically so a crash never leaves a partial file behind.
+        """
+        path = self._batch_path(url, ids)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'ids': list(ids), 'response': response_data}, f)
+        os.replace(path + '.tmp', path)
+
+    def clear(self):
+        """
+        Removes the checkpoint once its run has finished.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+# the columns pulled from each /v1/tracks object, as (column, path into the JSON, default)
+TRACK_RESPONSE_FIELDS = [
+    ('name', ('name',), 'No Name'),
+    ('artist', ('album', 'artists', 0, 'name'), None),
+    ('album_name', ('album', 'name'), None),
+    ('track_number', ('track_number',), 0),
+    ('artist_id', ('artists', 0, 'id'), None),
+    ('album_date', ('album', 'release_date'), None),
+    ('album_track_count', ('album', 'total_tracks'), None),
+    ('track_id', ('id',), None),
+    ('popularity', ('popularity',), None)
+]
+
+# the columns of each /v1/audio-features object
+AUDIO_FEATURE_FIELDS = [(field, (field,), None) for field in [
+    'danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness',
+    'instrumentalness', 'liveness', 'valence', 'tempo', 'type', 'id', 'uri',
+    'track_href', 'analysis_url', 'duration_ms', 'time_signature'
+]]
+
+def decode_response_columns(items, fields):
+    """
+    Decodes a list of JSON objects from the Spotify API into
+    per-column lists, ready to build a DataFrame from in one go.
+
+    Parameters
+    ----------
+    items : list of dict
+        the objects from one or more API responses. Null
+        entries (unknown ids) are skipped.
+
+    fields : list of tuples
+        (column, path, default) for each column, where path is the
+        sequence of keys and list indexes leading to the value and
+        default is used when the path doesn't exist
+
+    Returns
+    -------
+    columns : dict
+        a list of values for each column
+    """
+    columns = {column: [] for column, _, _ in fields}
+
+    for item in items:
+        if item is None:
+            continue
+
+        for column, path, default in fields:
+            value = item
+            try:
+                for key in path:
+                    value = value[key]
+            except (KeyError, IndexError, TypeError):
+                value = default
+            columns[column].append(value)
+
+    return columns
+
+def _streamlit_progress(message, label):
+    """
+    Returns a progress_callback(done, total) that drives a Streamlit
+    progress bar, and a function that clears it when finished.
+    """
+    st.write(message)
     progress_bar = st.progress(0)
     status_text = st.empty()
 
-    for i in range(num_chunks):
-        start_idx = i * chunk_size
-        end_idx = min(start_idx + chunk_size, total)
-        chunk = track_ids[start_idx:end_idx]
-        chunk_str = ",".join(chunk)
+    def update(done, total):
+        progress_bar.progress(done / total)
+        status_text.text(f"Processed {label} batch {done} of {total}")
 
-        api_url = 'https://api.spotify.com/v1/tracks'
-        headers = {
-            'Authorization': f'Bearer {access_token}'
-        }
-        params = {
-            'ids': chunk_str
-        }
+    def finish(success_message):
+        progress_bar.empty()
+        status_text.success(success_message)
 
-        response = requests.get(api_url, headers=headers, params=params)
+    return update, finish
 
-        try:
-            response_data = response.json()
-        except ValueError:
-            st.warning(f"⚠️ Failed to decode JSON response for chunk {i+1}.")
-            st.text(f"Status code: {response.status_code}")
-            st.text(f"Response text:\n{response.text[:500]}")
-            continue
+def get_multiple_tracks_response(track_ids, client, progress_callback=None, checkpoint=None):
+    """
+    Fetches metadata for multiple track IDs from Spotify API using Streamlit-friendly progress bar.
 
-        # Iterate through each track in the response
-        for track_data in response_data.get('tracks', []):
-            track_response = {
-                'name': track_data.get('name', 'No Name'),
-                'artist': track_data['album']['artists'][0]['name'],
-                'album_name': track_data['album']['name'],
-                'track_number': track_data.get('track_number', 0),
-                'artist_id': track_data['artists'][0]['id'],
-                'album_date': track_data['album']['release_date'],
-                'album_track_count': track_data['album']['total_tracks'],
-                'track_id': track_data['id'],
-                'popularity': track_data['popularity']
-            }
-
-            track_df = pd.DataFrame([track_response])
-            basic_df = pd.concat([basic_df, track_df])
-
-        # Update Streamlit UI
-        percent_complete = (i + 1) / num_chunks
-        progress_bar.progress(percent_complete)
-        status_text.text(f"Processed tracks {start_idx + 1}–{end_idx} of {total}")
+    `client` is the shared SpotifyClient (or a bare access token).
+    Batches of 50 ids are requested concurrently by a SpotifyBatchFetcher.
+    Pass `progress_callback(done, total)` to report progress somewhere other
+    than the Streamlit page, e.g. from a background thread, and an
+    EnrichmentCheckpoint to save batches as they complete.
+    """
+    chunk_size = 50
+    chunks = [track_ids[i:i + chunk_size] for i in range(0, len(track_ids), chunk_size)]
+
+    # Streamlit progress UI
+    finish = None
+    if progress_callback is None:
+        progress_callback, finish = _streamlit_progress("🎵 Fetching track metadata from Spotify...", "track")
+
+    client = as_spotify_client(client)
+    fetcher = SpotifyBatchFetcher(client)
+    responses = fetcher.fetch(f'{client.api_url}/tracks', chunks, progress_callback, checkpoint)
+
+    # Pull every track's fields into per-column lists and build the frame once
+    tracks = [track_data
+              for response_data in responses if response_data is not None
+              for track_data in response_data.get('tracks', [])]
+    basic_df = pd.DataFrame(decode_response_columns(tracks, TRACK_RESPONSE_FIELDS))
+
+    if fetcher.failed_batches:
+        message = f"⚠️ {fetcher.failed_batches} of {len(chunks)} track batches could not be fetched."
+        if finish is not None:
+            st.warning(message)
+        else:
+            print(message)
 
     # Final UI update
-    progress_bar.empty()
-    status_text.success("✅ Done fetching tracks!")
+    if finish is not None:
+        finish("✅ Done fetching tracks!")
 
     basic_df.set_index('track_id', inplace=True)
     return basic_df
 
 
-def get_multiple_features_response(track_ids, access_token):
+def get_multiple_features_response(track_ids, client):
     """
     Gathers the features information on the track_ids from the Spotify API.
 
@@ -314,8 +1249,8 @@ def get_multiple_features_response(track_ids, access_token):
     ----------
     track_ids : list
         List of track IDs to fetch audio features for.
-    access_token : string
-        Access token for Spotify API authentication.
+    client : SpotifyClient or string
+        The shared API client, or an access token for Spotify API authentication.
 
     Returns
     -------
@@ -323,36 +1258,27 @@ def get_multiple_features_response(track_ids, access_token):
         DataFrame containing audio features of the tracks.
     """
     chunk_size = 50
-    feature_df = pd.DataFrame()
-
-    for i in range(0, len(track_ids), chunk_size):
-        chunk = track_ids[i:i + chunk_size]
-        track_ids_str = ",".join(chunk)
-
-        api_url = f'https://api.spotify.com/v1/audio-features?ids={track_ids_str}'
-        headers = {'Authorization': f'Bearer {access_token}'}
-
-        response = requests.get(api_url, headers=headers)
+    chunks = [track_ids[i:i + chunk_size] for i in range(0, len(track_ids), chunk_size)]
+    features = []
 
+    client = as_spotify_client(client)
+    fetcher = SpotifyBatchFetcher(client)
+    for response_data in fetcher.fetch(f'{client.api_url}/audio-features', chunks):
         # Check if response is valid
-        if response.status_code != 200:
-            print(f"Error fetching audio features: {response.json()}")
+        if response_data is None:
+            print("Error fetching audio features.")
             continue
 
-        response_data = response.json()
-
         # Handle cases where 'audio_features' key is missing
         if 'audio_features' not in response_data:
             print("Warning: 'audio_features' missing in API response.")
             continue
 
-        for trk in response_data['audio_features']:
-            # Skip if a feature is None
-            if trk is None:
-                continue
+        # Skipped later if a feature is None
+        features.extend(response_data['audio_features'])
 
-            df = pd.DataFrame.from_dict([trk])
-            feature_df = pd.concat([feature_df, df], axis=0)
+    # Build the frame once from per-column lists
+    feature_df = pd.DataFrame(decode_response_columns(features, AUDIO_FEATURE_FIELDS))
 
     if feature_df.empty:
         print("Warning: No audio features could be retrieved.")
@@ -388,7 +1314,7 @@ def get_artist_ids(metadata):
     artist_ids = metadata['artist_id'].unique().tolist()
     return artist_ids
 
-def get_multiple_artist_genres(metadata, access_token):
+def get_multiple_artist_genres(metadata, client, progress_callback=None, use_cache=True, checkpoint=None):
     """
     Adds genre information to a user's Spotify metadata
 
@@ -401,9 +1327,23 @@ def get_multiple_artist_genres(metadata, access_token):
         a dataframe of clean user
         Spotify metadata
 
-    access_token: string
-        a string representing the access token needed
-        to access Spotify's API
+    client: SpotifyClient or string
+        the shared Spotify API client, or a string
+        representing the access token needed to
+        access Spotify's API
+
+    progress_callback: callable
+        optional argument - called as progress_callback(done, total)
+        as batches of artists are fetched
+
+    use_cache: bool
+        optional argument - look artists up in the shared
+        ArtistGenreCache first and only request unknown or
+        stale artists from the API
+
+    checkpoint: EnrichmentCheckpoint
+        optional argument - saves completed batches so an
+        interrupted run can resume
 
     Returns
     -------
@@ -414,73 +1354,305 @@ def get_multiple_artist_genres(metadata, access_token):
 
     artist_ids = get_artist_ids(metadata)
 
-    basic_df = pd.DataFrame()
+    # only request artists that are unknown or stale in the shared cache
+    if use_cache:
+        artist_cache = ArtistGenreCache()
+        cached_artists, artist_ids = artist_cache.get(artist_ids)
+        print(f"Artist genre cache: {artist_cache.hits} hits, {artist_cache.misses} misses.")
 
     # Process the ids in chunks
     chunk_size = 50
-    for i in range(0, len(artist_ids), chunk_size):
-        chunk = artist_ids[i:i + chunk_size]
-
-        # Convert chunk to comma-separated string
-        chunk_str = ",".join(chunk)
-
-        # Set the necessary parameters for Spotify API
-        api_url = 'https://api.spotify.com/v1/artists'
-        headers = {
-            'Authorization': f'Bearer {access_token}'
-        }
-        params = {
-            'ids': chunk_str
-        }
-
-        # Send the GET request to retrieve artist information for multiple artists
-        response = requests.get(api_url, headers=headers, params=params)
-        response_data = response.json()
-
-        if 'error' in response_data:
-            print(f"Error: {response_data['error']['message']}")
+    chunks = [artist_ids[i:i + chunk_size] for i in range(0, len(artist_ids), chunk_size)]
+
+    # Send the GET requests to retrieve artist information for multiple artists
+    client = as_spotify_client(client)
+    fetcher = SpotifyBatchFetcher(client)
+    responses = fetcher.fetch(f'{client.api_url}/artists', chunks, progress_callback, checkpoint)
+
+    if fetcher.failed_batches:
+        print(f"Warning: {fetcher.failed_batches} of {len(chunks)} artist batches could not be fetched.")
+
+    # Initialize lists to store artist IDs and genres
+    ids = []
+    genres = []
+
+    for response_data in responses:
+        if response_data is None:
             # Skip this chunk and continue with the next one
             continue
 
-        # Initialize lists to store artist IDs and genres
-        ids = []
-        genres = []
-
         # Iterate over each artist in the response data
         for artist in response_data['artists']:
+            if artist is None:
+                continue
             ids.append(artist['id'])
             genres.append(artist['genres'])
 
-        # Create a dictionary for the response
-        genre_response = {
-            'artist_id': ids,
-            'genres': genres
-        }
+    # Build the DataFrame once from every response
+    basic_df = pd.DataFrame({
+        'artist_id': ids,
+        'genres': genres
+    })
 
-        # Convert the dictionary to a DataFrame
-        genre_df = pd.DataFrame(genre_response)
-
-        # Append the DataFrame to basic_df
-        basic_df = pd.concat([basic_df, genre_df])
+    if use_cache:
+        artist_cache.put(basic_df)
+        basic_df = pd.concat([cached_artists, basic_df], ignore_index=True)
 
     return basic_df
 
-def get_metadata(track_ids, access_token):
+# where the metadata caches shared by all users are kept
+SPOTIFY_CACHE_DIR = os.environ.get('SPOTIFY_CACHE_DIR', '.cache')
+
+TRACK_CACHE_COLUMNS = ['name', 'artist', 'album_name', 'track_number', 'artist_id',
+                       'album_date', 'album_track_count', 'popularity']
+
+class TrackMetadataCache:
     """
-    Takes a list of unique track ids and retrieves
-    metadata for each track in df form
+    A persistent SQLite cache of track metadata keyed by track_id,
+    shared across users and sessions.
 
-    Original Author: Katy Mombourquette
+    Entries older than `ttl_days` count as misses so popularity and
+    other fields are refreshed. Once the cache holds more than
+    `max_entries` tracks, the least recently used ones are evicted.
+    Hit and miss counts are kept in `hits` and `misses`.
 
     Parameters
     ----------
-    track_ids : list
-        a list of unique track ids
+    path: string
+        optional argument - the SQLite file, defaults to
+        track_metadata.sqlite in SPOTIFY_CACHE_DIR
+
+    ttl_days: float
+        how long a cached track stays valid
+
+    max_entries: int
+        the maximum number of tracks kept
+    """
+
+    def __init__(self, path=None, ttl_days=30, max_entries=500_000):
+        self.path = path or os.path.join(SPOTIFY_CACHE_DIR, 'track_metadata.sqlite')
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        columns = ", ".join(f'"{col}"' for col in TRACK_CACHE_COLUMNS)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS tracks (track_id TEXT PRIMARY KEY, {columns}, "
+                         "fetched_at REAL, used_at REAL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, track_ids):
+        """
+        Looks up track ids in the cache.
+
+        Parameters
+        ----------
+        track_ids : list
+            the track ids to look up
+
+        Returns
+        -------
+        cached : pandas.core.frame.DataFrame
+            metadata for the cached tracks, indexed by track_id
+            like get_multiple_tracks_response()
+
+        missing_ids : list
+            the ids that weren't cached or have expired,
+            in their original order
+        """
+        now = time.time()
+        columns = ", ".join(f'"{col}"' for col in TRACK_CACHE_COLUMNS)
+        rows = []
+
+        with closing(self._connect()) as conn, conn:
+            # stay under SQLite's limit on query parameters
+            for i in range(0, len(track_ids), 900):
+                chunk = track_ids[i:i + 900]
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(conn.execute(
+                    f"SELECT track_id, {columns} FROM tracks "
+                    f"WHERE track_id IN ({placeholders}) AND fetched_at >= ?",
+                    [*chunk, now - self.ttl]
+                ).fetchall())
+
+            conn.executemany("UPDATE tracks SET used_at = ? WHERE track_id = ?", [(now, row[0]) for row in rows])
+
+        cached = pd.DataFrame(rows, columns=['track_id'] + TRACK_CACHE_COLUMNS).set_index('track_id')
+        missing_ids = [track_id for track_id in track_ids if track_id not in cached.index]
+
+        self.hits += len(cached)
+        self.misses += len(missing_ids)
+        return cached, missing_ids
+
+    def put(self, tracks):
+        """
+        Stores fetched track metadata, indexed by track_id, in the cache
+        and evicts the least recently used tracks if it is over capacity.
+        """
+        if tracks.empty:
+            return
+
+        now = time.time()
+        columns = ", ".join(f'"{col}"' for col in TRACK_CACHE_COLUMNS)
+        placeholders = ",".join("?" * (len(TRACK_CACHE_COLUMNS) + 3))
+        values = tracks[TRACK_CACHE_COLUMNS].astype(object).where(tracks[TRACK_CACHE_COLUMNS].notna(), None)
+        rows = [(track_id, *row, now, now) for track_id, row in zip(tracks.index, values.itertuples(index=False))]
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(f"INSERT OR REPLACE INTO tracks (track_id, {columns}, fetched_at, used_at) "
+                             f"VALUES ({placeholders})", rows)
+
+            excess = conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM tracks WHERE track_id IN "
+                             "(SELECT track_id FROM tracks ORDER BY used_at LIMIT ?)", (excess,))
+
+class ArtistGenreCache:
+    """
+    A persistent SQLite cache of artist genres keyed by artist_id,
+    shared across users and sessions.
+
+    Genres rarely change, so entries live for `ttl_days` (half a year
+    by default) before they are refetched. Popular artists are looked
+    up by most users, so once the cache holds more than `max_entries`
+    artists the least frequently used ones are evicted, oldest first
+    among equals and never the ones just stored. Hit and miss counts
+    are kept in `hits` and `misses`.
+
+    Parameters
+    ----------
+    path: string
+        optional argument - the SQLite file, defaults to
+        artist_genres.sqlite in SPOTIFY_CACHE_DIR
+
+    ttl_days: float
+        how long cached genres stay valid
+
+    max_entries: int
+        the maximum number of artists kept
+    """
+
+    def __init__(self, path=None, ttl_days=180, max_entries=200_000):
+        self.path = path or os.path.join(SPOTIFY_CACHE_DIR, 'artist_genres.sqlite')
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS artists (artist_id TEXT PRIMARY KEY, genres TEXT, "
+                         "fetched_at REAL, used_at REAL, use_count INTEGER)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, artist_ids):
+        """
+        Looks up artist ids in the cache.
+
+        Parameters
+        ----------
+        artist_ids : list
+            the artist ids to look up
+
+        Returns
+        -------
+        cached : pandas.core.frame.DataFrame
+            the artist_id and genres list of each cached artist
+
+        missing_ids : list
+            the ids that weren't cached or have expired
+        """
+        now = time.time()
+        rows = []
+
+        with closing(self._connect()) as conn, conn:
+            # stay under SQLite's limit on query parameters
+            for i in range(0, len(artist_ids), 900):
+                chunk = artist_ids[i:i + 900]
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(conn.execute(
+                    f"SELECT artist_id, genres FROM artists "
+                    f"WHERE artist_id IN ({placeholders}) AND fetched_at >= ?",
+                    [*chunk, now - self.ttl]
+                ).fetchall())
+
+            conn.executemany("UPDATE artists SET used_at = ?, use_count = use_count + 1 WHERE artist_id = ?",
+                             [(now, row[0]) for row in rows])
+
+        cached = pd.DataFrame({
+            'artist_id': [row[0] for row in rows],
+            'genres': [json.loads(row[1]) for row in rows]
+        })
+        cached_ids = set(cached['artist_id'])
+        missing_ids = [artist_id for artist_id in artist_ids if artist_id not in cached_ids]
+
+        self.hits += len(cached)
+        self.misses += len(missing_ids)
+        return cached, missing_ids
+
+    def put(self, artists):
+        """
+        Stores fetched artist genres in the cache and evicts the least
+        frequently used artists if it is over capacity.
+        """
+        if artists.empty:
+            return
+
+        now = time.time()
+        rows = [(artist_id, json.dumps(list(genres)), now, now)
+                for artist_id, genres in zip(artists['artist_id'], artists['genres'])]
+
+        with closing(self._connect()) as conn, conn:
+            # refreshed artists keep their use count
+            conn.executemany("INSERT INTO artists (artist_id, genres, fetched_at, used_at, use_count) "
+                             "VALUES (?, ?, ?, ?, 1) ON CONFLICT(artist_id) DO UPDATE SET "
+                             "genres = excluded.genres, fetched_at = excluded.fetched_at, used_at = excluded.used_at",
+                             rows)
+
+            # the artists just stored have the lowest use count, so they are never the ones evicted
+            excess = conn.execute("SELECT COUNT(*) FROM artists").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM artists WHERE artist_id IN "
+                             "(SELECT artist_id FROM artists WHERE used_at < ? "
+                             "ORDER BY use_count, used_at LIMIT ?)", (now, excess))
+
+def get_metadata(track_ids, client, use_cache=True, checkpoint=None, progress_callback=None):
+    """
+    Takes a list of unique track ids and retrieves
+    metadata for each track in df form
+
+    Original Author: Katy Mombourquette
+
+    Parameters
+    ----------
+    track_ids : list
+        a list of unique track ids
         found in the user's Spotify listening data
 
-    access_token: string
-        a string representing the access token needed
-        to access Spotify's API
+    client: SpotifyClient or string
+        the shared Spotify API client, or a string
+        representing the access token needed to
+        access Spotify's API
+
+    use_cache: bool
+        optional argument - look tracks and artists up in the
+        shared TrackMetadataCache and ArtistGenreCache first and
+        only request the misses from the API
+
+    checkpoint: EnrichmentCheckpoint
+        optional argument - saves completed track and artist
+        batches so an interrupted run can resume
+
+    progress_callback: callable
+        optional argument - called as progress_callback(done, total)
+        as track and then artist batches are fetched, instead of
+        showing Streamlit progress bars
 
     Returns
     -------
@@ -489,11 +1661,24 @@ def get_metadata(track_ids, access_token):
         about each track in track_ids
     """
 
+    # only request tracks that aren't in the shared cache
+    if use_cache:
+        track_cache = TrackMetadataCache()
+        cached_tracks, track_ids = track_cache.get(track_ids)
+        print(f"Track metadata cache: {track_cache.hits} hits, {track_cache.misses} misses.")
+
     # get track & feature information
-    track_responses = get_multiple_tracks_response(track_ids, access_token)
+    if track_ids:
+        track_responses = get_multiple_tracks_response(track_ids, client, progress_callback, checkpoint)
+    else:
+        track_responses = pd.DataFrame(columns=TRACK_CACHE_COLUMNS, index=pd.Index([], name='track_id'))
+
+    if use_cache:
+        track_cache.put(track_responses)
+        track_responses = pd.concat([cached_tracks, track_responses])
 
     # the audio-features endpoint was deprecated in Nov 2024 :-(
-    # features_responses = get_multiple_features_response(track_ids, access_token)
+    # features_responses = get_multiple_features_response(track_ids, client)
 
     # handle duplicate indices
     # if features_responses.index.is_unique == False:
@@ -502,15 +1687,16 @@ def get_metadata(track_ids, access_token):
     # concatenate track & feature information
     # metadata = pd.concat([track_responses.reset_index(drop=True), features_responses.reset_index(drop=True)], axis=1)
 
-    metadata = track_responses.copy()
+    # keep track_id as a column so plays can be joined on it
+    metadata = track_responses.reset_index()
 
     # add in genre information
-    genres_responses = get_multiple_artist_genres(track_responses, access_token)
+    genres_responses = get_multiple_artist_genres(track_responses, client, progress_callback, use_cache, checkpoint)
     metadata = pd.merge(metadata, genres_responses, on='artist_id', how='outer')
 
     return metadata
 
-def get_spotify_metadata(df, client_id=default_id, client_secret=default_secret):
+def get_spotify_metadata(df, client_id=default_id, client_secret=default_secret, user_id=None, progress_callback=None):
     """
     Requests metadata from Spotify's Web Development APIs based on
     track ids found in user's Spotify listening history.
@@ -526,6 +1712,15 @@ def get_spotify_metadata(df, client_id=default_id, client_secret=default_secret)
     client_secret: string
         a string representation of the user's API client secret
 
+    user_id: string
+        optional argument - when given, completed API batches are
+        checkpointed for this user, and a retry after an interrupted
+        run with the same tracks resumes where it left off
+
+    progress_callback: callable
+        optional argument - reports fetch progress as
+        progress_callback(done, total) instead of in Streamlit
+
     Returns
     -------
     metadata : pandas.core.frame.DataFrame
@@ -542,19 +1737,101 @@ def get_spotify_metadata(df, client_id=default_id, client_secret=default_secret)
     track_ids = get_user_track_ids(raw_data)
     print(f"Extracted {len(track_ids)} unique track IDs.")
 
-    # get access token for api
-    access_token = spotify_access(client_id, client_secret)
+    return fetch_track_metadata(track_ids, client_id, client_secret, user_id=user_id, progress_callback=progress_callback)
+
+def enrichment_run_id(track_ids):
+    """
+    Returns the EnrichmentCheckpoint run id for a set of track ids:
+    all of them, so it stays the same whichever are later found in
+    the shared caches.
+    """
+    return hashlib.sha1(",".join(sorted(track_ids)).encode('utf-8')).hexdigest()[:16]
+
+def fetch_track_metadata(track_ids, client_id=default_id, client_secret=default_secret, user_id=None, progress_callback=None):
+    """
+    Requests metadata for a list of track ids, as get_spotify_metadata()
+    does for the tracks in a listening history.
+
+    Parameters
+    ----------
+    track_ids : list
+        unique track ids, most listened to first
+
+    client_id, client_secret, user_id, progress_callback:
+        as for get_spotify_metadata()
+
+    Returns
+    -------
+    metadata : pandas.core.frame.DataFrame
+        A dataframe containing the tracks' Spotify metadata
+    """
+
+    # get the shared api client, reusing its access token if still valid
+    client = get_spotify_client(client_id, client_secret)
+    client.access_token()
     print("Access token retrieved successfully.")
 
+    # checkpoint the run, keyed by all the tracks being enriched
+    checkpoint = None
+    if user_id is not None:
+        checkpoint = EnrichmentCheckpoint(user_id, enrichment_run_id(track_ids))
+
     # get metadata for each track id
-    metadata = get_metadata(track_ids, access_token)
+    metadata = get_metadata(track_ids, client, checkpoint=checkpoint, progress_callback=progress_callback)
     print("Metadata fetched successfully.")
 
+    if checkpoint is not None:
+        checkpoint.clear()
+
     # return final df
     return metadata
 
 
-def combine_raw_meta(df, client_id=default_id, client_secret=default_secret):
+def join_track_metadata(stats_raw, metadata):
+    """
+    Left-joins track metadata onto the user's plays, adding the
+    metadata columns to `stats_raw` in place.
+
+    Track ids are dictionary-encoded against the metadata, so every
+    play gets the integer row position of its track and the metadata
+    columns are gathered by position, with no string hash join. Plays
+    without a track URI, or whose id isn't in the metadata, fall back
+    to matching on the lowercased 'track - artist' key.
+
+    Parameters
+    ----------
+    stats_raw : pandas.core.frame.DataFrame
+        the user's plays, with track_id and track-artist columns
+
+    metadata : pandas.core.frame.DataFrame
+        one row per track_id, with a track-artist column
+
+    Returns
+    -------
+    user_listening : pandas.core.frame.DataFrame
+        the plays with the metadata columns added
+    """
+    metadata = metadata.reset_index(drop=True)
+
+    # the position of each play's track in the metadata, -1 if it isn't there
+    codes = pd.Index(metadata['track_id']).get_indexer(stats_raw['track_id'])
+
+    # fall back to the name key for the rest
+    missing = codes == -1
+    if missing.any():
+        by_name = metadata.drop_duplicates(subset=['track-artist'])
+        name_codes = pd.Index(by_name['track-artist']).get_indexer(stats_raw['track-artist'][missing])
+        codes[missing] = np.where(name_codes == -1, -1, by_name.index.to_numpy()[name_codes])
+
+    # gather the metadata rows by position, -1 gives an all-null row,
+    # adding each column in place rather than concatenating whole frames
+    stats_raw.index = pd.RangeIndex(len(stats_raw))
+    for column in metadata.columns.drop(['track_id', 'track-artist']):
+        stats_raw[column] = metadata[column].reindex(codes).to_numpy()
+
+    return stats_raw
+
+def combine_raw_meta(df, client_id=default_id, client_secret=default_secret, user_id=None, progress_callback=None):
     """
     Combines the user's metadata with their raw Spotify
     listening data
@@ -569,6 +1846,14 @@ def combine_raw_meta(df, client_id=default_id, client_secret=default_secret):
     client_secret: string
         a string representation of the user's API client secret
 
+    user_id: string
+        optional argument - checkpoints the metadata requests
+        for this user so an interrupted run can resume
+
+    progress_callback: callable
+        optional argument - reports fetch progress as
+        progress_callback(done, total) instead of in Streamlit
+
     Returns
     -------
     user_listening : pandas.core.frame.DataFrame
@@ -576,25 +1861,63 @@ def combine_raw_meta(df, client_id=default_id, client_secret=default_secret):
         Spotify metadata and raw listening data
     """
 
-    # read in the user's raw stats
-    stats_raw = df
+    # read in the user's raw stats, as a shallow copy so the caller's frame keeps its columns
+    stats_raw = df.copy(deep=False)
 
     # request metadata information from Spotify API
-    metadata = get_spotify_metadata(df, client_id, client_secret)
+    metadata = prepare_track_metadata(get_spotify_metadata(stats_raw, client_id, client_secret, user_id=user_id, progress_callback=progress_callback))
+
+    add_track_keys(stats_raw)
+
+    # drop duplicates by play key, without copying the plays when there are none
+    if 'play_key' not in stats_raw.columns:
+        add_play_keys(stats_raw)
+    duplicates = stats_raw['play_key'].duplicated()
+    if duplicates.any():
+        stats_raw = stats_raw[~duplicates]
+
+    return attach_track_metadata(stats_raw, metadata)
 
+def add_track_keys(stats_raw):
+    """
+    Adds the track_id and track-artist columns raw plays are
+    joined to their metadata on, in place.
+    """
     # create track id column in one df
-    stats_raw['track_id'] = stats_raw['spotify_track_uri'].apply(lambda x: x.split(":")[2] if x is not None else None)
+    stats_raw['track_id'] = track_ids_from_uris(stats_raw['spotify_track_uri'])
 
-    # create track-artist columns to merge on
-    stats_raw['track-artist'] = stats_raw['master_metadata_track_name'].str.lower() + ' - ' + stats_raw['master_metadata_album_artist_name'].str.lower()
+    # create track-artist columns, the fallback join key
+    stats_raw['track-artist'] = lowercase_pair_key(stats_raw['master_metadata_track_name'], stats_raw['master_metadata_album_artist_name'])
+
+def prepare_track_metadata(metadata):
+    """
+    Readies fetched track metadata for attach_track_metadata(): adds
+    the track-artist fallback key and keeps one row per track_id.
+    """
     metadata['track-artist'] = metadata['name'].str.lower() + ' - ' + metadata['artist'].str.lower()
+    return metadata.dropna(subset=['track_id']).drop_duplicates(subset=['track_id'])
+
+def attach_track_metadata(stats_raw, metadata):
+    """
+    Joins prepared track metadata onto raw plays, the per-play half
+    of combine_raw_meta().
+
+    Parameters
+    ----------
+    stats_raw : pandas.core.frame.DataFrame
+        raw plays from read_spotify_json(), with the
+        columns from add_track_keys()
 
-    # drop duplicates
-    stats_raw = stats_raw.drop_duplicates()
-    metadata = metadata.drop_duplicates(subset=['track-artist'])
+    metadata : pandas.core.frame.DataFrame
+        metadata from prepare_track_metadata()
 
-    # Merge the dataframes on the track-artist column
-    user_listening = pd.merge(stats_raw, metadata, on='track-artist', how='left') # only keep rows in the user's listening stats
+    Returns
+    -------
+    user_listening : pandas.core.frame.DataFrame
+        the plays with their metadata
+    """
+    # Join the metadata on track_id, only keep rows in the user's listening stats
+    user_listening = join_track_metadata(stats_raw, metadata)
 
     # simple cleaning
     if '0' in user_listening.columns:
@@ -626,8 +1949,11 @@ def clean_listening_data(user_listening):
         metadata and raw data
     """
 
+    # work on a shallow copy, so renaming and dropping columns doesn't change the caller's frame
+    user_listening = user_listening.copy(deep=False)
+
     # rename columns
-    user_listening = user_listening.rename(columns={
+    user_listening.rename(inplace=True, columns={
                                                 'ts': 'timestamp_listened',
                                                 'ms_played': 'ms_listened',
                                                 #'duration_ms': 'song_duration_ms',
@@ -654,7 +1980,7 @@ def clean_listening_data(user_listening):
                         'type',
                         'uri']
 
-    user_listening = user_listening.drop([col for col in irrelevant_columns if col in user_listening.columns], axis=1)
+    user_listening.drop([col for col in irrelevant_columns if col in user_listening.columns], axis=1, inplace=True)
 
     # convert date columns
     user_listening['timestamp_listened'] = pd.to_datetime(user_listening['timestamp_listened'])
@@ -662,14 +1988,11 @@ def clean_listening_data(user_listening):
     user_listening = convert_to_datetime(user_listening, 'album_release_date')
 
     # create album-artist column
-    user_listening['album-artist'] = user_listening['album'].str.lower() + " - " + user_listening['artist'].str.lower()
+    user_listening['album-artist'] = lowercase_pair_key(user_listening['album'], user_listening['artist'])
 
-    # drop nulls in track column
-    user_listening = user_listening.dropna(subset=['track'])
-
-    # cast column types
-    user_listening['track_number'] = user_listening['track_number'].astype('int')
-    user_listening['album_track_count'] = user_listening['album_track_count'].astype('int')
+    # drop nulls in track column and cast column types, on the new frame dropna() returns
+    user_listening = user_listening.dropna(subset=['track']).astype({'track_number': 'int',
+                                                                     'album_track_count': 'int'})
     # user_listening.loc[user_listening['time_signature'].notnull(), 'time_signature'] = user_listening.loc[user_listening['time_signature'].notnull(), 'time_signature'].astype('int')
     #user_listening['username'] = user_listening['username'].astype('str')
     # user_listening['time_signature'] = user_listening['time_signature'].apply(lambda x: int(x) if pd.notnull(x) else x)
@@ -678,324 +2001,1560 @@ def clean_listening_data(user_listening):
     #user_listening = rate_artist_complexity(user_listening)
 
 
-    # reorder columns
+    # reorder columns
+
+    # old, when audio-features was available
+    # user_listening = user_listening[['username', 'track', 'track_id', 'artist', 'artist_id', 'track-artist',
+    #                                 'album', 'album-artist', 'album_release_date', 'album_track_count', 'track_number', 'song_duration_ms',
+    #                                 'song_duration_formatted', 'timestamp_listened', 'platform', 'conn_country', 'ip_addr',
+    #                                 'ms_listened', 'reason_start', 'reason_end', 'shuffle', 'offline', 'offline_timestamp_listened',
+    #                                 'incognito_mode', 'popularity', 'danceability', 'energy', 'loudness', 'speechiness', 'acousticness',
+    #                                 'instrumentalness', 'liveness', 'valence', 'key', 'mode', 'tempo', 'time_signature', 'genres']]
+
+
+    user_listening = user_listening[['track', 'track_id', 'artist', 'artist_id', 'track-artist',
+                                    'album', 'album-artist', 'album_release_date', 'album_release_date_precision', 'album_track_count', 'track_number', 'timestamp_listened', 'platform', 'conn_country', 'ip_addr',
+                                    'ms_listened', 'reason_start', 'reason_end', 'shuffle', 'offline', 'offline_timestamp_listened',
+                                    'incognito_mode', 'popularity', 'genres']
+                                    + (['play_key'] if 'play_key' in user_listening.columns else [])]
+
+    return user_listening
+
+# the first year columns and the key each is the first year of
+FIRST_YEAR_KEYS = {
+    'first_year_listened': 'track-artist',
+    'first_year_artist_listened': 'artist'
+}
+
+def _lookup_by_key(keys, table):
+    """
+    Looks up each value of `keys` in a Series indexed by key. Only the
+    distinct keys are looked up, the results are gathered by code.
+    """
+    codes, uniques = pd.factorize(keys, use_na_sentinel=False)
+    return table.reindex(uniques).to_numpy()[codes]
+
+def first_year_listened(df):
+    """
+    Adds the first year each track-artist (first_year_listened) and
+    each artist (first_year_artist_listened) was listened to.
+
+    The keys are dictionary-encoded and the minimum year of each code
+    is gathered back onto the plays, without merges. Plays with a
+    null key get a null first year.
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        the plays, with timestamp_listened, track-artist and artist columns
+
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        the plays with the first year columns
+    """
+    # add the columns to a shallow copy, leaving the caller's frame as it was
+    df = df.copy(deep=False)
+
+    # Extract year from timestamp_listened
+    df['timestamp_listened'] = pd.to_datetime(df['timestamp_listened'])
+    years = pd.Series(df['timestamp_listened'].dt.year.to_numpy())
+
+    for column, key in FIRST_YEAR_KEYS.items():
+        # plays without a key, e.g. without metadata, get no first year rather than a shared one
+        codes = pd.factorize(df[key])[0]
+        keyed = codes >= 0
+        first_years = np.full(len(df), np.nan)
+        first_years[keyed] = years[keyed].groupby(codes[keyed]).min().to_numpy()[codes[keyed]]
+        df[column] = first_years
+
+    return df
+
+def first_year_minimums(df):
+    """
+    Returns the stored first year of each key in an analysis dataframe,
+    for update_first_year_listened().
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        an analysis dataframe with the first year columns
+
+    Returns
+    -------
+    minimums: dict
+        first year column -> Series of the first year, indexed by key
+    """
+    return {column: df.groupby(key, observed=True, dropna=False)[column].min()
+            for column, key in FIRST_YEAR_KEYS.items()}
+
+def update_first_year_listened(df, minimums):
+    """
+    Incremental first_year_listened(): sets the first year columns of
+    newly appended plays from the new plays themselves and the stored
+    per-key minimums of the plays before them.
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        only the new plays
+
+    minimums: dict
+        the stored minimums from first_year_minimums()
+
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        the new plays with the first year columns
+
+    minimums: dict
+        the minimums updated with the new plays, to apply to the
+        earlier plays and store for the next update
+    """
+    df = first_year_listened(df)
+
+    updated = {}
+    for column, key in FIRST_YEAR_KEYS.items():
+        df[column] = np.fmin(df[column].to_numpy(dtype='float'),
+                             _lookup_by_key(df[key], minimums[column]).astype('float'))
+
+        new_minimums = df.groupby(key, observed=True, dropna=False)[column].min()
+        updated[column] = pd.concat([minimums[column].astype('float'), new_minimums]).groupby(level=0, observed=True, dropna=False).min()
+
+    return df, updated
+
+def get_spotify_data(df, client_id=default_id, client_secret=default_secret):
+    """
+    Returns an expanded and cleaned version of a user's Spotify json streaming history.
+
+    The function scans the working directory for json files beginning with
+    "Streaming_History_Audio", requests metadata information from the Spotify API,
+    and combines it with the raw data.
+
+    Original Author: Katy Mombourquette
+
+    Parameters
+    ----------
+    client_id: string
+        a string representation of the user's API client id
+
+    client_secret: string
+        a string representation of the user's API client secret
+
+    Returns
+    -------
+    df : pandas.core.frame.DataFrame
+        A dataframe containing the user's cleaned Spotify
+        metadata and raw data
+    """
+    print(f"Starting `get_spotify_data`")
+    data = df
+    print("Combined raw data and metadata.")
+    data = clean_listening_data(data)
+    print("Cleaned listening data.")
+    data = first_year_listened(data)
+    print("Added first year listened columns.")
+
+    return data
+
+# More functions for cleaning purposes
+
+def get_general_genre(specific_genre, list_of_genres=['k-pop', 'pop', 'rock', 'classical', 'hip hop',
+                                                    'country', 'indie','electronic', 'jazz', 'punk',
+                                                    'funk', 'folk', 'alternative']):
+
+    """
+    Returns the general genre for a given specific genre
+
+    Original Author: Katy Mombourquette
+
+    Parameters
+    ----------
+    specific_genre: string
+        a string representation of a genre
+
+    list_of_genres: list of strings
+        optional argument - a list of general genres to extract
+        from the specific spotify-assigned genres.
+        General genres should be key words that exist in the
+        specific genres.
+
+    Original Author: Katy Mombourquette
+
+    Returns
+    -------
+    genre : string
+        A a string representation of a general
+        genre that best describes the specific genre
+    """
+
+    specific_genre_lower = specific_genre.lower()
+
+    for genre in list_of_genres:
+        if specific_genre == 'unknown genre':
+            return 'unknown genre'
+        elif specific_genre == 'folk-pop':
+            return 'folk'
+        elif genre in specific_genre_lower:
+            return genre
+
+    return 'unique genre'
+
+class GeneralGenreLookup:
+    """
+    A persistent table of specific genre -> general genre, kept as
+    JSON in SPOTIFY_CACHE_DIR and grown as new genres are seen.
+
+    Each list of general genres has its own table, so a custom
+    list_of_genres never reuses results from a different one.
+
+    Parameters
+    ----------
+    path: string
+        optional argument - the JSON file, defaults to
+        general_genres.json in SPOTIFY_CACHE_DIR
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(SPOTIFY_CACHE_DIR, 'general_genres.json')
+        self.lock = threading.Lock()
+        self.tables = None
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @contextmanager
+    def _file_lock(self):
+        # self.lock only covers this process, other app or worker processes share the file
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _save(self):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+
+        with self._file_lock():
+            # keep the genres other processes added since this one loaded the file
+            for key, saved_table in self._load().items():
+                table = self.tables.setdefault(key, {})
+                for genre, general_genre in saved_table.items():
+                    table.setdefault(genre, general_genre)
+
+            # a temporary file of its own, so concurrent writers never share one
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=folder, suffix='.tmp',
+                                             delete=False) as f:
+                json.dump(self.tables, f)
+            try:
+                os.replace(f.name, self.path)
+            except OSError:
+                os.remove(f.name)
+                raise
+
+    def classify(self, specific_genres, list_of_genres):
+        """
+        Returns the general genre of each distinct specific genre,
+        classifying only the ones not already in the table.
+
+        Parameters
+        ----------
+        specific_genres : list of strings
+            distinct specific genres
+
+        list_of_genres : list of strings
+            the general genres, in priority order
+
+        Returns
+        -------
+        general_genres : dict
+            specific genre -> general genre
+        """
+        key = '|'.join(list_of_genres)
+
+        with self.lock:
+            if self.tables is None:
+                self.tables = self._load()
+            table = self.tables.setdefault(key, {})
+
+            new_genres = [genre for genre in specific_genres if genre not in table]
+            if new_genres:
+                table.update(classify_general_genres(new_genres, list_of_genres))
+                self._save()
+
+            return {genre: table[genre] for genre in specific_genres}
+
+_general_genre_lookup = None
+
+def classify_general_genres(specific_genres, list_of_genres):
+    """
+    Vectorized get_general_genre() over distinct specific genres.
+
+    Each general genre keyword is matched against all the specific
+    genres at once, in priority order, and a genre takes the first
+    keyword it contains, e.g. 'k-pop' before 'pop'.
+
+    Parameters
+    ----------
+    specific_genres : list of strings
+        distinct specific genres
+
+    list_of_genres : list of strings
+        the general genres, in priority order
+
+    Returns
+    -------
+    general_genres : dict
+        specific genre -> general genre
+    """
+    genres = pd.Series(specific_genres, dtype='object')
+    lowered = genres.str.lower()
+    general = pd.Series('unique genre', index=genres.index, dtype='object')
+    unmatched = pd.Series(True, index=genres.index)
+
+    for genre in list_of_genres:
+        matches = unmatched & lowered.str.contains(genre, regex=False)
+        general[matches] = genre
+        unmatched &= ~matches
+
+    # special cases take precedence over any keyword
+    general[genres == 'folk-pop'] = 'folk'
+    general[genres == 'unknown genre'] = 'unknown genre'
+
+    return dict(zip(genres, general))
+
+def map_general_genres(specific_genre, list_of_genres):
+    """
+    Maps a column of specific genres to their general genres.
+
+    The column is dictionary-encoded, each distinct genre is looked
+    up in the persistent GeneralGenreLookup table (classifying any
+    new ones) and the result is applied to the codes.
+
+    Parameters
+    ----------
+    specific_genre : pandas.core.series.Series
+        the specific genres, e.g. the genre1 column
+
+    list_of_genres : list of strings
+        the general genres, in priority order
+
+    Returns
+    -------
+    general_genre : pandas.core.series.Series
+        a categorical of the general genres, null where
+        the specific genre is null
+    """
+    global _general_genre_lookup
+    if _general_genre_lookup is None:
+        _general_genre_lookup = GeneralGenreLookup()
+
+    codes, uniques = pd.factorize(specific_genre)
+    lookup = _general_genre_lookup.classify(list(uniques), list(list_of_genres))
+
+    general_codes, categories = pd.factorize(pd.Series([lookup[genre] for genre in uniques], dtype='object'))
+    general_codes = np.append(general_codes, -1)
+
+    return pd.Series(pd.Categorical.from_codes(general_codes[codes], categories),
+                     index=specific_genre.index)
+
+def genre_columns(df):
+    """
+    Returns the genre1..genreN columns of a dataframe, in order.
+    """
+    columns = [column for column in df.columns if re.fullmatch(r'genre\d+', str(column))]
+    return sorted(columns, key=lambda column: int(column[5:]))
+
+def genres_as_lists(genres):
+    """
+    Returns a genres column with every value as a list.
+
+    Frames saved before genres were lists hold their string repr,
+    e.g. "['pop', 'rock']", which is parsed once per distinct string.
+    Arrays read back from Parquet become lists and nulls become
+    empty lists, so the column can be written to Parquet again.
+
+    Parameters
+    ----------
+    genres: pandas.core.series.Series
+        the genres column
+
+    Returns
+    -------
+    genres: pandas.core.series.Series
+        the genres column as lists
+    """
+    values = genres.to_numpy(dtype='object').copy()
+    is_string = np.fromiter((isinstance(value, str) for value in values), dtype=bool, count=len(values))
+
+    if is_string.any():
+        codes, uniques = pd.factorize(values[is_string])
+        parsed = [list(ast.literal_eval(value)) if value.startswith('[') else [] for value in uniques]
+        string_rows = np.flatnonzero(is_string)
+        for row, code in zip(string_rows, codes):
+            values[row] = parsed[code]
+
+    for row in np.flatnonzero(~is_string):
+        value = values[row]
+        if not isinstance(value, list):
+            values[row] = list(value) if isinstance(value, (np.ndarray, tuple)) else []
+
+    return pd.Series(values, index=genres.index, dtype='object', name=genres.name)
+
+def build_artist_genres(df, list_of_genres):
+    """
+    Builds an artist-level genre table from the plays, so genres
+    are split and classified once per artist rather than per play.
+
+    Plays without an artist id share one row with no genres.
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        the plays, with artist_id and genres (list) columns
+
+    list_of_genres: list of strings
+        the general genres, in priority order
+
+    Returns
+    -------
+    artists: pandas.core.frame.DataFrame
+        one row per artist with artist_id, genres, genre1..genreN
+        (as many as the artist with the most genres, at least one)
+        and general_genre
+
+    codes: numpy.ndarray
+        the row in `artists` of each play
+    """
+    codes, artist_ids = pd.factorize(df['artist_id'], use_na_sentinel=False)
+
+    # genres are the same on every play of an artist, take the first
+    first_rows = np.unique(codes, return_index=True)[1]
+    genres = np.empty(len(artist_ids), dtype='object')
+    for i, artist_genres in enumerate(df['genres'].iloc[first_rows]):
+        genres[i] = list(artist_genres) if isinstance(artist_genres, (list, np.ndarray)) else []
+
+    artists = pd.DataFrame({'artist_id': artist_ids, 'genres': genres})
+
+    # one column per genre position, padded with nulls
+    split_genres = pd.DataFrame(genres.tolist(), index=artists.index, dtype='object')
+    split_genres.columns = [f'genre{i+1}' for i in range(split_genres.shape[1])]
+    if 'genre1' not in split_genres:
+        split_genres['genre1'] = None
+
+    # assign 'unknown genre' to artists without genres
+    split_genres['genre1'] = split_genres['genre1'].fillna('unknown genre')
+    artists = pd.concat([artists, split_genres], axis=1)
+
+    artists['general_genre'] = map_general_genres(artists['genre1'], list_of_genres)
+
+    return artists, codes
+
+def join_artist_genres(df, list_of_genres):
+    """
+    Adds the genres, genre1..genreN and general_genre columns to the
+    plays from build_artist_genres(), joined by the artist_id codes.
+
+    The genre columns come out as categoricals. Each play's genres
+    list is the artist's list itself rather than a copy.
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        the plays, with artist_id and genres (list) columns
+
+    list_of_genres: list of strings
+        the general genres, in priority order
+
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        the plays with the genre columns
+    """
+    artists, codes = build_artist_genres(df, list_of_genres)
+
+    columns = {'genres': pd.Series(artists['genres'].to_numpy()[codes], index=df.index, dtype='object')}
+    for column in genre_columns(artists) + ['general_genre']:
+        column_codes, categories = pd.factorize(artists[column])
+        columns[column] = pd.Series(pd.Categorical.from_codes(column_codes[codes], categories), index=df.index)
+
+    # add the columns in place rather than concatenating whole frames
+    df.drop(columns=[column for column in columns if column in df.columns] + genre_columns(df), inplace=True)
+    for column, values in columns.items():
+        df[column] = values
+
+    return df
+
+
+def convert_key_names(df):
+    """
+    Returns the given name for numeric representations
+    of musical keys
+
+    Original Author: Katy Mombourquette
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        a dataframe including a column with
+        numerical keys
+
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        a dataframe including a column with
+        the converted names of numerical keys
+    """
+
+    df['key_name'] = df['key']
+
+    key_map = {
+        0:'C',
+        1:'C#/Db',
+        2:'D',
+        3:'D#/Eb',
+        4:'E',
+        5:'F',
+        6:'F#/Gb',
+        7:'G',
+        8:'G#/Ab',
+        9:'A',
+        10:'A#/Bb',
+        11: 'B'
+    }
+
+    df = df.replace({"key_name": key_map})
+
+    return df
+
+def convert_mode_names(df):
+    """
+    Returns the given name for numeric representations
+    of musical modes
+
+    Original Author: Katy Mombourquette
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        a dataframe including a column with
+        numerical modes
+
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        a dataframe including a column with
+        the converted names of numerical modes
+    """
+    df['mode_name'] = df['mode']
+
+    mode_map = {
+        0:'Minor',
+        1: 'Major'
+    }
+
+    df = df.replace({"mode_name": mode_map})
+
+    return df
+
+def clean_spdata_for_analysis(df, list_of_genres=['k-pop', 'pop', 'rock', 'classical', 'hip hop',
+                                                    'country', 'indie','electronic', 'jazz', 'punk',
+                                                    'funk', 'folk', 'alternative']):
+    """
+    Cleans spotify data for the purpose of analysis.
+
+    Original Author: Katy Mombourquette
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        a dataframe spotify data information, ideally
+        from the get_spotify_data() function
+
+    list_of_genres: list of strings
+        optional argument - a list of general genres to extract
+        from the specific spotify-assigned genres.
+        General genres should be key words that exist in the
+        specific genres.
+
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        a dataframe of cleaned data for analysis
+    """
+
+    # add the columns to a shallow copy, leaving the caller's frame as it was
+    df = df.copy(deep=False)
+
+    # create unique id, the same for a play every time it is processed
+    if 'play_key' in df.columns:
+        df['unique_id'] = df['play_key']
+    else:
+        df['unique_id'] = make_play_ids(df['timestamp_listened'], df['track_id'], df['ms_listened'], df['platform'])
+
+    # derive the genre columns once per artist and join them onto the plays
+    df = join_artist_genres(df, list_of_genres)
+
+    # re-cast album datetime types
+    df = convert_to_datetime(df, 'album_release_date')
+
+    # convert numerical keys and modes to their names
+    #df = convert_key_names(df)
+    #df = convert_mode_names(df)
+
+    # create categorical versions of feature measures (danceability, etc.)
+
+    # def category_conversion(x, column, q1, q3):
+    #     if x <= q1:
+    #         x = f'Low {column}'
+    #     elif x >= q3:
+    #         x = f'High {column}'
+    #     else:
+    #         x = f'Medium {column}'
+    #     return x
+
+    # feat_cols = ['danceability', 'energy', 'loudness', 'speechiness',
+    #                 'acousticness', 'instrumentalness', 'liveness', 'valence']
+
+    # # apply category_conversion to feature columns
+    # for column in feat_cols:
+    #     q1 = df[column].quantile(0.25)
+    #     q3 = df[column].quantile(0.75)
+    #     df[f'{column}_category'] = df[f'{column}'].apply(category_conversion, column=f'{column}'.capitalize(), q1=q1, q3=q3)
+
+    # # reorder columns
+
+
+    # old version, several of these are no longer valid after audio-features was deprecated
+    # df = df[[
+
+    # 'unique_id', 'username','track','track_id','artist','artist_id','track-artist','album','album-artist','album_release_date',
+    # 'album_track_count','track_number','song_duration_ms','song_duration_formatted','timestamp_listened','platform',
+    # 'conn_country','ip_addr_decrypted','ms_listened','reason_start','reason_end','shuffle','offline',
+    # 'offline_timestamp_listened','incognito_mode','popularity','danceability', 'danceability_category','energy','energy_category','loudness','loudness_category',
+    # 'speechiness','speechiness_category','acousticness','acousticness_category','instrumentalness','instrumentalness_category','liveness','liveness_category','valence',
+    # 'valence_category','key','key_name','mode','mode_name','tempo','time_signature','genres','genre1','genre2','genre3','genre4','genre5','genre6','genre7','genre8',
+    # 'genre9','genre10','genre11','general_genre'
+
+    #     ]]
+
+    # # rename ip addr for new file
+    # df = df.rename(columns={'ip_addr_decrypted': 'ip_addr'})
+
+    desired_cols = [
+
+    'unique_id','track','track_id','artist','artist_id','track-artist','album','album-artist','album_release_date',
+    'album_release_date_precision','album_track_count','track_number','timestamp_listened','platform',
+    'conn_country','ip_addr','ms_listened','reason_start','reason_end','shuffle','offline',
+    'offline_timestamp_listened','incognito_mode','popularity','genres',*genre_columns(df),'general_genre',
+    'first_year_listened', 'first_year_artist_listened'
+
+        ]
+
+    columns = [col for col in desired_cols if col in df.columns]
+
+    df = df.reindex(columns=columns)
+
+    # sort by time and derive the year, quarter and month once, for the sidebar filters
+    df = add_calendar_columns(df)
+
+    # store low-cardinality columns as categoricals and downcast numerics
+    df = apply_analysis_schema(df)
+
+    return df
+
+
+# Compact dtypes for the analysis dataframe, applied at the end of clean_spdata_for_analysis().
+# Low-cardinality string columns become categoricals, which pyarrow writes to Parquet as
+# dictionary-encoded columns and reads back as categoricals. The genre1..genreN columns
+# are matched by name in apply_analysis_schema().
+ANALYSIS_SCHEMA = {
+    'track-artist': 'category',
+    'artist': 'category',
+    'album': 'category',
+    'platform': 'category',
+    'conn_country': 'category',
+    'reason_start': 'category',
+    'reason_end': 'category',
+    'general_genre': 'category',
+    'album_release_date_precision': 'category',
+    'quarter': 'category',
+    'month_name': 'category',
+    'year': 'int16',
+    'month': 'int8',
+    'track_number': 'int16',
+    'album_track_count': 'int16',
+    'popularity': 'int8',
+    'ms_listened': 'int32',
+    'first_year_listened': 'int16',
+    'first_year_artist_listened': 'int16'
+}
+
+def apply_analysis_schema(df):
+    """
+    Casts the columns of an analysis dataframe to the compact
+    dtypes declared in ANALYSIS_SCHEMA. Columns that already
+    have their schema dtype are left untouched, so this is cheap
+    to re-apply after loading a saved Parquet file.
+
+    Integer columns containing nulls are cast to the matching
+    pandas nullable integer type (e.g. Int16).
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        a dataframe of cleaned data for analysis
+
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        the dataframe with compact column types
+    """
+
+    for column in df.columns:
+        dtype = ANALYSIS_SCHEMA.get(column)
+        if dtype is None and re.fullmatch(r'genre\d+', str(column)):
+            dtype = 'category'
+        if dtype is None:
+            continue
+
+        if dtype == 'category':
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype('category')
+            continue
+
+        if df[column].dtype in (dtype, dtype.capitalize()):
+            continue
+
+        values = pd.to_numeric(df[column], errors='coerce')
+        if values.isna().any():
+            dtype = dtype.capitalize()
+        df[column] = values.astype(dtype)
+
+    return df
+
+# calendar columns derived from timestamp_listened by add_calendar_columns()
+CALENDAR_COLUMNS = ['year', 'quarter', 'month', 'month_name']
+
+def add_calendar_columns(df):
+    """
+    Sorts an analysis dataframe by timestamp_listened, if it isn't
+    already, and adds the calendar columns the period filters use:
+    year, quarter (e.g. '2023Q1'), month and month_name.
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        a dataframe with a timestamp_listened column
+
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        the sorted dataframe with the calendar columns
+    """
+    if not df['timestamp_listened'].is_monotonic_increasing:
+        df = df.sort_values(by='timestamp_listened', kind='stable').reset_index(drop=True)
+
+    timestamps = df['timestamp_listened']
+    year = timestamps.dt.year
+    month = timestamps.dt.month
+
+    # quarter and month names are built from the distinct values, not per row
+    quarters = year * 10 + (month - 1) // 3 + 1
+    codes, uniques = pd.factorize(quarters, sort=True)
+    quarter_labels = [f"{int(key) // 10}Q{int(key) % 10}" for key in uniques]
+
+    df['year'] = year
+    df['quarter'] = pd.Categorical.from_codes(codes, quarter_labels)
+    df['month'] = month
+    df['month_name'] = pd.Categorical.from_codes((month - 1).fillna(-1).astype('int8'), calendar.month_name[1:])
+    return df
+
+def build_period_index(df):
+    """
+    Returns the row offsets of every year, quarter and month in an
+    analysis dataframe sorted by timestamp_listened, so a period can
+    be selected with slice_period() instead of a boolean mask.
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        an analysis dataframe from add_calendar_columns()
+
+    Returns
+    -------
+    period_index: pandas.core.frame.DataFrame
+        one row per period with data: its 'period' label as
+        str(pd.Period) gives it ('2023', '2023Q1' or '2023-01'),
+        its 'kind' ('year', 'quarter' or 'month') and the 'start'
+        and 'stop' row offsets of its plays
+    """
+    # months since year 0, nondecreasing because the plays are sorted
+    months = (df['year'] * 12 + df['month'] - 1).dropna().to_numpy(dtype='int64')
+    keys = np.unique(months)
+    bounds = pd.DataFrame({
+        'start': months.searchsorted(keys, side='left'),
+        'stop': months.searchsorted(keys, side='right')
+    })
+
+    levels = {
+        'year': [f"{key // 12}" for key in keys],
+        'quarter': [f"{key // 12}Q{key % 12 // 3 + 1}" for key in keys],
+        'month': [f"{key // 12}-{key % 12 + 1:02d}" for key in keys]
+    }
+    period_index = pd.concat([
+        bounds.groupby(pd.Index(labels, name='period'), sort=False)
+        .agg(start=('start', 'min'), stop=('stop', 'max'))
+        .reset_index()
+        .assign(kind=kind)
+        for kind, labels in levels.items()
+    ], ignore_index=True)
+
+    return period_index[['period', 'kind', 'start', 'stop']]
+
+def slice_period(df, period_index, period):
+    """
+    Returns the plays in a period as a positional slice of the sorted
+    analysis dataframe, which doesn't copy the data.
+
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        the analysis dataframe the period index was built from
+
+    period_index: pandas.core.frame.DataFrame
+        the output of build_period_index()
+
+    period: pandas.Period or string
+        the year, quarter or month to select
+
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        the plays in the period, empty if there are none
+    """
+    match = np.flatnonzero(period_index['period'].to_numpy() == str(period))
+    if len(match) == 0:
+        return df.iloc[0:0]
+
+    row = period_index.iloc[match[0]]
+    return df.iloc[row['start']:row['stop']]
+
+def make_play_ids(timestamps, tracks, ms_played, platforms):
+    """
+    Returns a deterministic 64-bit id for each play, hashed from
+    the fields that identify it, so reprocessing the same export
+    gives the same ids.
+
+    The fields are normalized first, so raw export columns (ts,
+    spotify_track_uri, ms_played) and analysis columns
+    (timestamp_listened, track_id, ms_listened) give the same ids.
+
+    Parameters
+    ----------
+    timestamps : pandas.core.series.Series
+        when each play ended, as datetimes or ISO strings
+
+    tracks : pandas.core.series.Series
+        the track URIs or ids
+
+    ms_played : pandas.core.series.Series
+        how long each track was played for
+
+    platforms : pandas.core.series.Series
+        the platform each play was on
+
+    Returns
+    -------
+    play_ids : numpy.ndarray
+        uint64 ids
+    """
+    keys = pd.DataFrame({
+        'timestamp': pd.to_datetime(timestamps, utc=True).to_numpy(dtype='datetime64[ns]').view('int64'),
+        'track': _encode_play_field(tracks, lambda uris: uris.str.rsplit(':', n=1).str[-1]),
+        'ms_played': pd.Series(ms_played, dtype='Int64').fillna(-1).to_numpy(dtype='int64'),
+        'platform': _encode_play_field(platforms)
+    })
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+def _encode_play_field(values, normalize=None):
+    """
+    Dictionary-encodes a string field for make_play_ids(), normalizing
+    only the distinct values. Nulls become ''. Categoricals hash like
+    their values, so only the categories are hashed.
+    """
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype='object')
+    if normalize is not None:
+        uniques = normalize(uniques)
+
+    # normalizing can map several values to one, so encode again
+    unique_codes, categories = pd.factorize(pd.concat([uniques, pd.Series([''])], ignore_index=True))
+    return pd.Categorical.from_codes(unique_codes[codes], categories)
+
+# columns that identify a single play, used to drop overlapping plays when merging exports
+PLAY_KEY_COLUMNS = ['timestamp_listened', 'track_id', 'ms_listened', 'platform']
+
+def drop_stored_plays(stats_raw, existing_df):
+    """
+    Drops the raw plays whose play_key is already a unique_id in the
+    user's saved analysis dataframe, e.g. from an overlapping export,
+    so they aren't processed again.
+
+    Parameters
+    ----------
+    stats_raw: pandas.core.frame.DataFrame
+        raw plays from read_spotify_json()
+
+    existing_df: pandas.core.frame.DataFrame
+        the user's saved analysis dataframe
 
-    # old, when audio-features was available
-    # user_listening = user_listening[['username', 'track', 'track_id', 'artist', 'artist_id', 'track-artist',
-    #                                 'album', 'album-artist', 'album_release_date', 'album_track_count', 'track_number', 'song_duration_ms',
-    #                                 'song_duration_formatted', 'timestamp_listened', 'platform', 'conn_country', 'ip_addr',
-    #                                 'ms_listened', 'reason_start', 'reason_end', 'shuffle', 'offline', 'offline_timestamp_listened',
-    #                                 'incognito_mode', 'popularity', 'danceability', 'energy', 'loudness', 'speechiness', 'acousticness',
-    #                                 'instrumentalness', 'liveness', 'valence', 'key', 'mode', 'tempo', 'time_signature', 'genres']]
+    Returns
+    -------
+    stats_raw: pandas.core.frame.DataFrame
+        the plays not saved yet
+    """
+    if 'unique_id' not in existing_df.columns or existing_df['unique_id'].dtype != 'uint64':
+        return stats_raw
 
+    stored = stats_raw['play_key'].isin(existing_df['unique_id'])
+    if stored.any():
+        stats_raw = stats_raw[~stored].reset_index(drop=True)
+    return stats_raw
 
-    user_listening = user_listening[['track', 'track_id', 'artist', 'artist_id', 'track-artist',
-                                    'album', 'album-artist', 'album_release_date', 'album_track_count', 'track_number', 'timestamp_listened', 'platform', 'conn_country', 'ip_addr',
-                                    'ms_listened', 'reason_start', 'reason_end', 'shuffle', 'offline', 'offline_timestamp_listened',
-                                    'incognito_mode', 'popularity', 'genres']]
+def merge_spotify_data(existing_df, new_df):
+    """
+    Merges newly processed listening data into a user's existing
+    analysis dataframe. Plays present in both are kept once and
+    the first year listened columns are updated from the new plays
+    and the per-key minimums of the saved ones.
 
-    return user_listening
+    Parameters
+    ----------
+    existing_df: pandas.core.frame.DataFrame
+        the user's saved analysis dataframe
 
-def first_year_listened(df):
-    # Extract year from timestamp_listened
-    df['timestamp_listened'] = pd.to_datetime(df['timestamp_listened'])
-    print(df['timestamp_listened'].dtype)
+    new_df: pandas.core.frame.DataFrame
+        analysis data processed from the new export files
 
-    df["Year_Listened"] = df['timestamp_listened'].dt.year
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        the combined analysis dataframe, sorted by timestamp_listened
+    """
 
-    # Group by track-artist & aggregate unique years
-    years_listened = df.groupby('track-artist')['Year_Listened'].agg(list).reset_index()
-    years_listened['Year_Listened'] = years_listened['Year_Listened'].apply(lambda x: list(set(x)))
+    # new plays may come from earlier years than the saved ones
+    if all(column in existing_df.columns for column in FIRST_YEAR_KEYS):
+        new_df, minimums = update_first_year_listened(new_df, first_year_minimums(existing_df))
 
-    # Create a new column with the first year listened
-    years_listened["first_year_listened"] = years_listened["Year_Listened"].apply(lambda x: min(x))
+        existing_df = existing_df.copy()
+        for column, key in FIRST_YEAR_KEYS.items():
+            existing_df[column] = _lookup_by_key(existing_df[key], minimums[column])
 
-    # Merge years_listened back into df
-    df = pd.merge(df, years_listened[['track-artist', 'first_year_listened']], on='track-artist', how='left')
+    # data saved before play ids were deterministic has random uuid strings
+    if 'unique_id' in existing_df.columns and existing_df['unique_id'].dtype != 'uint64':
+        existing_df = existing_df.copy()
+        existing_df['unique_id'] = make_play_ids(existing_df['timestamp_listened'], existing_df['track_id'],
+                                                 existing_df['ms_listened'], existing_df['platform'])
 
-    # Repeat for artists
-    artists_first_listen = df.groupby('artist')['Year_Listened'].agg(list).reset_index()
-    artists_first_listen['Year_Listened'] = artists_first_listen['Year_Listened'].apply(lambda x: list(set(x)))
-    artists_first_listen["first_year_artist_listened"] = artists_first_listen["Year_Listened"].apply(lambda x: min(x))
+    df = pd.concat([existing_df, new_df], ignore_index=True)
 
-    # Merge artists_first_listen back into df
-    df = pd.merge(df, artists_first_listen[['artist', 'first_year_artist_listened']], on='artist', how='left')
+    # overlapping exports contain the same plays
+    if 'unique_id' in df.columns:
+        df = df.drop_duplicates(subset=['unique_id'], keep='first')
+    else:
+        df = df.drop_duplicates(subset=[col for col in PLAY_KEY_COLUMNS if col in df.columns], keep='first')
 
-    # Drop unnecessary columns
-    df.drop(columns=['Year_Listened'], inplace=True)
+    df = df.sort_values(by='timestamp_listened').reset_index(drop=True)
 
-    return df
+    # saved plays may hold genres as strings or arrays, new ones as lists
+    if 'genres' in df.columns:
+        df['genres'] = genres_as_lists(df['genres'])
 
-def get_spotify_data(df, client_id=default_id, client_secret=default_secret):
-    """
-    Returns an expanded and cleaned version of a user's Spotify json streaming history.
+    # concatenating categoricals with different categories falls back to object columns
+    return apply_analysis_schema(df)
 
-    The function scans the working directory for json files beginning with
-    "Streaming_History_Audio", requests metadata information from the Spotify API,
-    and combines it with the raw data.
+# the dimensions of the rollup cube, from coarsest to finest
+CUBE_DIMENSIONS = ['date_listened', 'general_genre', 'genre1', 'artist', 'track']
 
-    Original Author: Katy Mombourquette
+def build_rollup_cube(df):
+    """
+    Pre-aggregates the plays into a rollup cube: the number of plays
+    and ms listened for every day × general_genre × genre1 × artist
+    × track combination that occurs. Dashboards can group the cube
+    rather than the plays, so they stay fast however long the
+    history is.
 
     Parameters
     ----------
-    client_id: string
-        a string representation of the user's API client id
-
-    client_secret: string
-        a string representation of the user's API client secret
+    df: pandas.core.frame.DataFrame
+        an analysis dataframe
 
     Returns
     -------
-    df : pandas.core.frame.DataFrame
-        A dataframe containing the user's cleaned Spotify
-        metadata and raw data
+    cube: pandas.core.frame.DataFrame
+        one row per combination, with the CUBE_DIMENSIONS columns
+        (date_listened as a naive UTC date), plays and ms_listened,
+        sorted by date_listened
     """
-    print(f"Starting `get_spotify_data`")
-    data = df
-    print("Combined raw data and metadata.")
-    data = clean_listening_data(data)
-    print("Cleaned listening data.")
-    data = first_year_listened(data)
-    print("Added first year listened columns.")
+    timestamps = df['timestamp_listened']
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_convert('UTC').dt.tz_localize(None)
 
-    return data
+    keys = {'date_listened': timestamps.dt.normalize()}
+    keys.update({column: df[column] for column in CUBE_DIMENSIONS[1:]})
 
-# More functions for cleaning purposes
+    cube = (
+        pd.DataFrame({'ms_listened': df['ms_listened'].astype('int64')})
+        .groupby(list(keys.values()), observed=True, dropna=False, sort=False)
+        .agg(plays=('ms_listened', 'size'), ms_listened=('ms_listened', 'sum'))
+        .reset_index()
+    )
+    cube.columns = CUBE_DIMENSIONS + ['plays', 'ms_listened']
 
-def get_general_genre(specific_genre, list_of_genres=['k-pop', 'pop', 'rock', 'classical', 'hip hop',
-                                                    'country', 'indie','electronic', 'jazz', 'punk',
-                                                    'funk', 'folk', 'alternative']):
+    return _compact_rollup_cube(cube)
 
+def update_rollup_cube(cube, new_df):
     """
-    Returns the general genre for a given specific genre
-
-    Original Author: Katy Mombourquette
+    Adds newly appended plays to a rollup cube, aggregating only
+    the new plays and summing them into the matching cells.
 
     Parameters
     ----------
-    specific_genre: string
-        a string representation of a genre
-
-    list_of_genres: list of strings
-        optional argument - a list of general genres to extract
-        from the specific spotify-assigned genres.
-        General genres should be key words that exist in the
-        specific genres.
+    cube: pandas.core.frame.DataFrame
+        the cube of the plays saved so far
 
-    Original Author: Katy Mombourquette
+    new_df: pandas.core.frame.DataFrame
+        only the new plays, none of which are in the cube yet
 
     Returns
     -------
-    genre : string
-        A a string representation of a general
-        genre that best describes the specific genre
+    cube: pandas.core.frame.DataFrame
+        the updated cube
+    """
+    cube = pd.concat([cube, build_rollup_cube(new_df)], ignore_index=True)
+    cube = (
+        cube
+        .groupby(CUBE_DIMENSIONS, observed=True, dropna=False, sort=False)[['plays', 'ms_listened']]
+        .sum()
+        .reset_index()
+    )
+    return _compact_rollup_cube(cube)
+
+def slice_rollup_cube(cube, start, end):
+    """
+    Returns the rows of a rollup cube dated from `start` to `end`
+    inclusive, found by binary search on the sorted dates.
+    """
+    dates = cube['date_listened'].to_numpy()
+    lo = dates.searchsorted(np.datetime64(pd.Timestamp(start).normalize()), side='left')
+    hi = dates.searchsorted(np.datetime64(pd.Timestamp(end)), side='right')
+    return cube.iloc[lo:hi]
+
+def _compact_rollup_cube(cube):
+    for column in CUBE_DIMENSIONS[1:]:
+        cube[column] = cube[column].astype('category')
+    cube['plays'] = cube['plays'].astype('int32')
+    cube['ms_listened'] = cube['ms_listened'].astype('int64')
+    return cube.sort_values(by='date_listened', kind='stable').reset_index(drop=True)
+
+# the total size of the cached pipeline results kept for all users
+PIPELINE_CACHE_BYTES = int(os.environ.get('SPOTIFY_PIPELINE_CACHE_BYTES', 2 << 30))
+
+def build_spotify_pipeline(client_id=default_id, client_secret=default_secret, user_id=None,
+                           progress_callback=None, list_of_genres=None, cache_dir=None,
+                           track_memory=False):
     """
+    Returns the Pipeline from raw listening data to the analysis
+    dataframe: combine_raw_meta(), clean_listening_data(),
+    first_year_listened() and clean_spdata_for_analysis().
 
-    specific_genre_lower = specific_genre.lower()
+    Each stage's result is cached in SPOTIFY_CACHE_DIR/pipeline/<user_id>,
+    so e.g. a new list_of_genres only reruns clean_spdata_for_analysis().
+    The users' caches share a limit of PIPELINE_CACHE_BYTES.
 
-    for genre in list_of_genres:
-        if specific_genre == 'unknown genre':
-            return 'unknown genre'
-        elif specific_genre == 'folk-pop':
-            return 'folk'
-        elif genre in specific_genre_lower:
-            return genre
+    Parameters
+    ----------
+    client_id, client_secret, user_id, progress_callback:
+        passed on to combine_raw_meta()
 
-    return 'unique genre'
+    list_of_genres: list of strings
+        optional argument - passed on to clean_spdata_for_analysis()
 
+    cache_dir: string
+        optional argument - where stage results are cached,
+        instead of the user's folder
 
-def convert_key_names(df):
-    """
-    Returns the given name for numeric representations
-    of musical keys
+    track_memory: bool
+        optional argument - record each stage's peak memory in the
+        pipeline's timings
 
-    Original Author: Katy Mombourquette
+    Returns
+    -------
+    pipeline: Pipeline
+        a pipeline taking the raw dataframe as 'raw' and
+        producing the analysis dataframe as 'analysis'
+    """
+    # one cache folder per user, sharing one size limit
+    cache_root = os.path.join(SPOTIFY_CACHE_DIR, 'pipeline')
+    if cache_dir is None:
+        cache_dir = os.path.join(cache_root, safe_user_folder(user_id or '_shared'))
+    else:
+        cache_root = cache_dir
+
+    return Pipeline([
+        Stage('combine_raw_meta', combine_raw_meta, inputs=['raw'], output='combined',
+              options={'client_id': client_id, 'client_secret': client_secret,
+                       'user_id': user_id, 'progress_callback': progress_callback}),
+        Stage('clean_listening_data', clean_listening_data, inputs=['combined'], output='listening'),
+        Stage('first_year_listened', first_year_listened, inputs=['listening'], output='first_years'),
+        Stage('clean_spdata_for_analysis', clean_spdata_for_analysis, inputs=['first_years'], output='analysis',
+              params={'list_of_genres': list_of_genres} if list_of_genres else None)
+    ], cache_dir, max_bytes=PIPELINE_CACHE_BYTES, cache_root=cache_root, track_memory=track_memory)
+
+def enrich_spotify_data(df, client_id=default_id, client_secret=default_secret, user_id=None,
+                        progress_callback=None, fingerprint=None):
+    """
+    Runs the full chain from raw listening data to the analysis
+    dataframe through build_spotify_pipeline(), reusing any cached
+    stage results.
 
     Parameters
     ----------
     df: pandas.core.frame.DataFrame
-        a dataframe including a column with
-        numerical keys
+        the user's raw listening history from read_spotify_json()
+
+    client_id, client_secret, user_id, progress_callback:
+        passed on to combine_raw_meta()
+
+    fingerprint: string
+        optional argument - identifies the files the raw data was read
+        from, to save hashing the whole frame. The play keys left after
+        drop_stored_plays() are folded in, so the same files against a
+        different saved dataframe don't share cached results
 
     Returns
     -------
     df: pandas.core.frame.DataFrame
-        a dataframe including a column with
-        the converted names of numerical keys
+        a dataframe of cleaned data for analysis
     """
+    if fingerprint is not None and 'play_key' in df.columns:
+        fingerprint = raw_plays_fingerprint(fingerprint, df)
+    pipeline = build_spotify_pipeline(client_id, client_secret, user_id=user_id, progress_callback=progress_callback)
+    return pipeline.run({'raw': df}, fingerprints={'raw': fingerprint})
 
-    df['key_name'] = df['key']
-
-    key_map = {
-        0:'C',
-        1:'C#/Db',
-        2:'D',
-        3:'D#/Eb',
-        4:'E',
-        5:'F',
-        6:'F#/Gb',
-        7:'G',
-        8:'G#/Ab',
-        9:'A',
-        10:'A#/Bb',
-        11: 'B'
-    }
+def raw_plays_fingerprint(source_fingerprint, stats_raw):
+    """
+    Combines the fingerprint of the files raw plays were read from
+    with their play keys. The files fix every play except those
+    drop_stored_plays() removed, and hashing the keys is much cheaper
+    than hashing the whole frame.
 
-    df = df.replace({"key_name": key_map})
+    Parameters
+    ----------
+    source_fingerprint: string
+        identifies the files the plays were read from
 
-    return df
+    stats_raw: pandas.core.frame.DataFrame
+        raw plays with the play_key column from add_play_keys()
 
-def convert_mode_names(df):
+    Returns
+    -------
+    fingerprint: string
+        a hex digest identifying the plays
     """
-    Returns the given name for numeric representations
-    of musical modes
+    digest = hashlib.sha256(source_fingerprint.encode('utf-8'))
+    digest.update(np.ascontiguousarray(stats_raw['play_key'].to_numpy()).tobytes())
+    return digest.hexdigest()
 
-    Original Author: Katy Mombourquette
+def process_spotify_exports_chunked(file_list, out_dir, client_id=default_id, client_secret=default_secret,
+                                    user_id=None, chunk_rows=250_000, list_of_genres=None, progress_callback=None):
+    """
+    Out-of-core version of read_spotify_json() followed by
+    enrich_spotify_data(), for histories too large to process
+    in memory.
+
+    The files are streamed twice in batches of `chunk_rows` plays.
+    The first pass collects the track ids (with play counts) to fetch
+    metadata for. The second runs the row-wise stages on each batch
+    and spills the results to Parquet partitioned by year, as
+    out_dir/year=YYYY/part-NNNNN.parquet, with plays without a
+    timestamp in out_dir/year=__HIVE_DEFAULT_PARTITION__. Only
+    key-level state is kept between batches: the first year of each
+    track-artist and artist, and the ids of the plays seen so far, to
+    drop duplicates. A play's id covers its timestamp, so repeats of
+    it are always from the same year, and the seen ids are spilled to
+    disk per year with only the years in the current batch loaded.
+    A final pass fixes the first years of plays written before an
+    earlier play of the same key turned up.
 
     Parameters
     ----------
-    df: pandas.core.frame.DataFrame
-        a dataframe including a column with
-        numerical modes
+    file_list : list
+        file-like objects with a `name` attribute, as for
+        read_spotify_json()
+
+    out_dir : string
+        the output folder, any earlier output in it is replaced
+
+    client_id, client_secret, user_id:
+        as for combine_raw_meta()
+
+    chunk_rows : int
+        the number of plays processed at a time, which bounds memory
+
+    list_of_genres : list of strings
+        optional argument - passed on to clean_spdata_for_analysis()
+
+    progress_callback : callable
+        optional argument - called as progress_callback(done, total)
+        after each batch
 
     Returns
     -------
-    df: pandas.core.frame.DataFrame
-        a dataframe including a column with
-        the converted names of numerical modes
+    paths : list of strings
+        the Parquet files written, read them back with
+        load_chunked_spotify_data()
     """
-    df['mode_name'] = df['mode']
+    genre_kwargs = {'list_of_genres': list_of_genres} if list_of_genres else {}
+
+    # pass 1: the tracks to fetch metadata for, most played first
+    track_counts = pd.Series(dtype='float')
+    total_rows = 0
+    for stats_raw in iter_spotify_json_chunks(file_list, chunk_rows):
+        total_rows += len(stats_raw)
+        counts = stats_raw['spotify_track_uri'].str.split(':').str[-1].value_counts()
+        track_counts = track_counts.add(counts, fill_value=0)
+
+    track_ids = track_counts.sort_values(ascending=False).index.tolist()
+    total_chunks = -(-total_rows // chunk_rows)
+    print(f"Extracted {len(track_ids)} unique track IDs from {total_rows} plays.")
+
+    metadata = prepare_track_metadata(fetch_track_metadata(track_ids, client_id, client_secret, user_id=user_id))
+    max_genres = max(1, metadata['genres'].map(lambda genres: len(genres) if isinstance(genres, list) else 0).max())
+
+    for old_partition in glob.glob(os.path.join(out_dir, 'year=*')):
+        shutil.rmtree(old_partition)
+
+    # pass 2: the row-wise stages, batch by batch
+    os.makedirs(out_dir, exist_ok=True)
+    seen_dir = tempfile.TemporaryDirectory(prefix='seen-', dir=out_dir)
+    minimums = {column: pd.Series(dtype='float') for column in FIRST_YEAR_KEYS}
+    paths = []
+
+    for idx, stats_raw in enumerate(iter_spotify_json_chunks(file_list, chunk_rows)):
+        # drop plays already seen in this or an earlier batch
+        stats_raw = stats_raw[_unseen_plays(stats_raw, seen_dir.name)].reset_index(drop=True)
+        add_track_keys(stats_raw)
+        df = attach_track_metadata(stats_raw, metadata)
+        df = clean_listening_data(df)
+        df, minimums = update_first_year_listened(df, minimums)
+        df = clean_spdata_for_analysis(df, **genre_kwargs)
+
+        # every batch has the same genre columns, however many its own artists need
+        for i in range(max_genres):
+            if f'genre{i+1}' not in df.columns:
+                df[f'genre{i+1}'] = pd.Categorical([None] * len(df))
+
+        # plays without a timestamp have no year, but the in-memory data keeps them too
+        for year, part in df.groupby('year', dropna=False):
+            partition = NULL_YEAR_PARTITION if pd.isna(year) else year
+            path = os.path.join(out_dir, f"year={partition}", f"part-{idx:05d}.parquet")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part.to_parquet(path, index=False)
+            paths.append(path)
+
+        print(f"Processed batch {idx + 1} of {total_chunks}.")
+        if progress_callback is not None:
+            progress_callback(idx + 1, total_chunks)
+
+    seen_dir.cleanup()
+
+    # pass 3: later batches may have moved first years earlier
+    for path in paths:
+        df = pd.read_parquet(path)
+        changed = False
+        for column, key in FIRST_YEAR_KEYS.items():
+            first_years = _lookup_by_key(df[key], minimums[column])
+            if not np.array_equal(df[column].to_numpy(dtype='float'), first_years, equal_nan=True):
+                df[column] = first_years
+                changed = True
+        if changed:
+            apply_analysis_schema(df).to_parquet(path, index=False)
+
+    return paths
+
+def _unseen_plays(stats_raw, seen_dir):
+    """
+    Returns a mask of the raw plays in a batch not seen earlier in it
+    or in an earlier batch, adding them to the sorted arrays of seen
+    play ids kept in seen_dir per year.
+    """
+    play_ids = stats_raw['play_key'].to_numpy()
+    keep = ~pd.Series(play_ids).duplicated().to_numpy()
 
-    mode_map = {
-        0:'Minor',
-        1: 'Major'
-    }
+    # repeats of a play have the same timestamp, so the same year
+    years = stats_raw['ts'].str[:4].fillna('none').to_numpy(dtype='object')
+    for year in pd.unique(years):
+        rows = np.flatnonzero(years == year)
+        path = os.path.join(seen_dir, f"{year}.npy")
+        seen_ids = np.load(path) if os.path.exists(path) else np.array([], dtype='uint64')
 
-    df = df.replace({"mode_name": mode_map})
+        if len(seen_ids):
+            ids = play_ids[rows]
+            positions = np.minimum(np.searchsorted(seen_ids, ids), len(seen_ids) - 1)
+            keep[rows] &= seen_ids[positions] != ids
+        np.save(path, np.union1d(seen_ids, play_ids[rows[keep[rows]]]))
 
-    return df
+    return keep
 
-def clean_spdata_for_analysis(df, list_of_genres=['k-pop', 'pop', 'rock', 'classical', 'hip hop',
-                                                    'country', 'indie','electronic', 'jazz', 'punk',
-                                                    'funk', 'folk', 'alternative']):
-    """
-    Cleans spotify data for the purpose of analysis.
+# the partition of plays without a year, named as Hive and pyarrow name null partitions
+NULL_YEAR_PARTITION = '__HIVE_DEFAULT_PARTITION__'
 
-    Original Author: Katy Mombourquette
+def load_chunked_spotify_data(out_dir, columns=None, years=None):
+    """
+    Reads the output of process_spotify_exports_chunked() back
+    into one analysis dataframe.
 
     Parameters
     ----------
-    df: pandas.core.frame.DataFrame
-        a dataframe spotify data information, ideally
-        from the get_spotify_data() function
+    out_dir : string
+        the folder the output was written to
 
-    list_of_genres: list of strings
-        optional argument - a list of general genres to extract
-        from the specific spotify-assigned genres.
-        General genres should be key words that exist in the
-        specific genres.
+    columns : list of strings
+        optional argument - only read these columns
+
+    years : list of ints
+        optional argument - only read plays from these years
 
     Returns
     -------
-    df: pandas.core.frame.DataFrame
-        a dataframe of cleaned data for analysis
+    df : pandas.core.frame.DataFrame
+        the analysis dataframe, sorted by timestamp_listened
     """
+    paths = sorted(glob.glob(os.path.join(out_dir, 'year=*', '*.parquet')))
+    if years is not None:
+        partitions = {f"year={year}" for year in years}
+        paths = [path for path in paths if os.path.basename(os.path.dirname(path)) in partitions]
 
-    import uuid
-
-    
-    # create unique id
-    df['unique_id'] = [uuid.uuid4() for _ in range(len(df))]
+    if not paths:
+        return pd.DataFrame(columns=columns)
 
-    # create individual genre columns
+    df = pd.concat([pd.read_parquet(path, columns=columns) for path in paths], ignore_index=True)
+    if 'timestamp_listened' in df.columns:
+        df = df.sort_values(by='timestamp_listened').reset_index(drop=True)
 
-    df['genres'] = df['genres'].astype(str)
+    # batches have their own categories, which concatenate to object columns
+    return apply_analysis_schema(df)
 
-    # Determine the maximum number of genres present in any row
-    max_genres = df['genres'].str.count(',') + 1
-    max_genres = max_genres.max()
+def build_provisional_df(df):
+    """
+    Builds an analysis dataframe from the fields already in the
+    export (track, album artist and album names), without calling
+    the Spotify API, so the dashboard can be shown right away.
 
-    # split the 'genres' column into multiple columns
-    df_genres = df['genres'].str.strip("[]").str.split(", ", expand=True)
+    Metadata only the API provides is left empty: genres come out
+    as 'unknown genre', popularity and release dates as nulls, and
+    artist ids as None. The export's album artist stands in for
+    the artist.
 
-    # rename the columns to genre1, genre2, ...
-    df_genres.columns = [f'genre{i+1}' for i in range(max_genres)]
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        the user's raw listening history from read_spotify_json()
 
-    # concatenate the original DataFrame and the new genres DataFrame
-    df = pd.concat([df, df_genres], axis=1)
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        a dataframe shaped like the output of enrich_spotify_data()
+    """
+    stats_raw = df.copy()
+
+    # stand in for the metadata columns combine_raw_meta() would add
+    stats_raw['track_id'] = track_ids_from_uris(stats_raw['spotify_track_uri'])
+    stats_raw['name'] = stats_raw['master_metadata_track_name']
+    stats_raw['artist'] = stats_raw['master_metadata_album_artist_name']
+    stats_raw['album_name'] = stats_raw['master_metadata_album_album_name']
+    stats_raw['track-artist'] = lowercase_pair_key(stats_raw['name'], stats_raw['artist'])
+    stats_raw['artist_id'] = None
+    stats_raw['album_date'] = None
+    stats_raw['track_number'] = 0
+    stats_raw['album_track_count'] = 0
+    stats_raw['popularity'] = np.nan
+    stats_raw['genres'] = [[] for _ in range(len(stats_raw))]
+
+    df = clean_listening_data(stats_raw)
+    df = first_year_listened(df)
+    df = clean_spdata_for_analysis(df)
+    return df
 
-    # strip quotes from genres
-    for column in [f'genre{i+1}' for i in range(max_genres)]:
-        df[column] = df[column].str.strip("'")
+# background enrichment jobs, kept at module level so they survive Streamlit reruns
+_enrichment_jobs = {}
+_enrichment_jobs_lock = threading.Lock()
 
-    # assign 'unknown genre' to empty genres
-    df['genre1'] = df['genre1'].apply(lambda x: 'unknown genre' if x == '' else x)
+# the number of tracks enriched per part of a background job, most played first
+ENRICHMENT_PART_TRACKS = 1000
 
-    # create general genre cols
-    df['general_genre'] = df['genre1'].apply(lambda specific_genre: get_general_genre(specific_genre, list_of_genres))
+# jobs nobody has polled for this many seconds, e.g. from a closed tab, are forgotten
+ENRICHMENT_JOB_TTL = 15 * 60
 
-    # re-cast album datetime types
-    df = convert_to_datetime(df, 'album_release_date')
+def _sweep_enrichment_jobs(now):
+    # called with _enrichment_jobs_lock held
+    for job_key in [job_key for job_key, job in _enrichment_jobs.items()
+                    if now - job['polled'] > ENRICHMENT_JOB_TTL]:
+        del _enrichment_jobs[job_key]
 
-    # convert numerical keys and modes to their names
-    #df = convert_key_names(df)
-    #df = convert_mode_names(df)
+def split_plays_by_track(df, part_tracks=ENRICHMENT_PART_TRACKS):
+    """
+    Splits raw plays into parts of at most `part_tracks` tracks each,
+    most played tracks first, keeping every play of a track in the
+    same part.
 
-    # create categorical versions of feature measures (danceability, etc.)
+    Parameters
+    ----------
+    df: pandas.core.frame.DataFrame
+        the user's raw listening history from read_spotify_json()
 
-    # def category_conversion(x, column, q1, q3):
-    #     if x <= q1:
-    #         x = f'Low {column}'
-    #     elif x >= q3:
-    #         x = f'High {column}'
-    #     else:
-    #         x = f'Medium {column}'
-    #     return x
+    part_tracks: int
+        the number of tracks per part
 
-    # feat_cols = ['danceability', 'energy', 'loudness', 'speechiness',
-    #                 'acousticness', 'instrumentalness', 'liveness', 'valence']
+    Returns
+    -------
+    parts: list
+        a dataframe of plays per part. Plays without a track id go in
+        the first part. A history that fits one part is returned as is.
+    """
+    track_ids = track_ids_from_uris(df['spotify_track_uri'])
+    order = pd.Series(track_ids).value_counts().index
+    if len(order) <= part_tracks:
+        return [df]
 
-    # # apply category_conversion to feature columns
-    # for column in feat_cols:
-    #     q1 = df[column].quantile(0.25)
-    #     q3 = df[column].quantile(0.75)
-    #     df[f'{column}_category'] = df[f'{column}'].apply(category_conversion, column=f'{column}'.capitalize(), q1=q1, q3=q3)
+    part_of_track = pd.Series(np.arange(len(order)) // part_tracks, index=order)
+    part = pd.Series(track_ids).map(part_of_track).fillna(0).to_numpy()
+    return [df[part == i].reset_index(drop=True) for i in range(int(part.max()) + 1)]
 
-    # # reorder columns
+def start_background_enrichment(job_key, df, client_id=default_id, client_secret=default_secret, user_id=None,
+                                part_tracks=ENRICHMENT_PART_TRACKS):
+    """
+    Starts enrich_spotify_data() on a background thread, or returns
+    the job already running under `job_key`.
 
+    The plays are enriched in parts from split_plays_by_track(), most
+    played tracks first. Each finished part is appended to the job's
+    'enriched' list, so the dashboard can fill in genres and release
+    dates before the whole job is done, combining the parts with
+    combine_enriched_parts() when it redraws.
 
-    # old version, several of these are no longer valid after audio-features was deprecated
-    # df = df[[
+    Jobs not polled through this function or get_enrichment_job()
+    for ENRICHMENT_JOB_TTL seconds are forgotten, so an abandoned
+    session doesn't keep its results in memory.
 
-    # 'unique_id', 'username','track','track_id','artist','artist_id','track-artist','album','album-artist','album_release_date',
-    # 'album_track_count','track_number','song_duration_ms','song_duration_formatted','timestamp_listened','platform',
-    # 'conn_country','ip_addr_decrypted','ms_listened','reason_start','reason_end','shuffle','offline',
-    # 'offline_timestamp_listened','incognito_mode','popularity','danceability', 'danceability_category','energy','energy_category','loudness','loudness_category',
-    # 'speechiness','speechiness_category','acousticness','acousticness_category','instrumentalness','instrumentalness_category','liveness','liveness_category','valence',
-    # 'valence_category','key','key_name','mode','mode_name','tempo','time_signature','genres','genre1','genre2','genre3','genre4','genre5','genre6','genre7','genre8',
-    # 'genre9','genre10','genre11','general_genre'
+    Parameters
+    ----------
+    job_key: string
+        identifies the job across reruns, e.g. the user id
+        and the fingerprints of the files being processed
 
-    #     ]]
+    df: pandas.core.frame.DataFrame
+        the user's raw listening history from read_spotify_json()
 
-    # # rename ip addr for new file
-    # df = df.rename(columns={'ip_addr_decrypted': 'ip_addr'})
+    part_tracks: int
+        optional argument - the number of tracks enriched per part
 
-    desired_cols = [
+    Returns
+    -------
+    job: dict
+        'status' ('running', 'done' or 'failed'), the 'done' and
+        'total' batch counts of the part being enriched, the 'part'
+        and 'parts' counts, the 'parts_done' so far and their
+        'enriched' dataframes, the 'result' dataframe once done and
+        the 'error' message if it failed
+    """
+    with _enrichment_jobs_lock:
+        now = time.monotonic()
+        _sweep_enrichment_jobs(now)
+        if job_key in _enrichment_jobs:
+            job = _enrichment_jobs[job_key]
+            job['polled'] = now
+            return job
+        job = {'status': 'running', 'done': 0, 'total': 0, 'part': 0, 'parts': 0, 'parts_done': 0,
+               'enriched': [], 'result': None, 'error': None, 'polled': now}
+        _enrichment_jobs[job_key] = job
+
+    def progress(done, total):
+        job['done'], job['total'] = done, total
+
+    def run():
+        try:
+            parts = split_plays_by_track(df, part_tracks)
+            job['parts'] = len(parts)
+
+            for part, plays in enumerate(parts, start=1):
+                job['part'] = part
+                # the job key identifies the files, enrich_spotify_data() adds the plays in this part
+                job['enriched'].append(enrich_spotify_data(plays, client_id, client_secret, user_id, progress,
+                                                           fingerprint=job_key))
+                job['parts_done'] = part
+
+            # keep the combined frame only, not the parts as well
+            job['result'] = combine_enriched_parts(job['enriched'])
+            job['enriched'] = [job['result']]
+            job['status'] = 'done'
+        except Exception as e:
+            job['error'] = str(e)
+            job['status'] = 'failed'
+
+    threading.Thread(target=run, daemon=True).start()
+    return job
+
+def get_enrichment_job(job_key):
+    """Returns the background enrichment job for a key, or None."""
+    with _enrichment_jobs_lock:
+        now = time.monotonic()
+        _sweep_enrichment_jobs(now)
+        job = _enrichment_jobs.get(job_key)
+        if job is not None:
+            job['polled'] = now
+        return job
+
+def combine_enriched_parts(parts):
+    """
+    Combines the analysis dataframes of the parts of a background
+    enrichment job, concatenating them once rather than merging
+    each part into the ones before it.
 
-    'unique_id','track','track_id','artist','artist_id','track-artist','album','album-artist','album_release_date',
-    'album_track_count','track_number','timestamp_listened','platform',
-    'conn_country','ip_addr','ms_listened','reason_start','reason_end','shuffle','offline',
-    'offline_timestamp_listened','incognito_mode','popularity','genres','genre1','genre2','genre3','genre4','genre5','genre6','genre7','genre8',
-    'genre9','genre10','genre11','general_genre', 'first_year_listened', 'first_year_artist_listened'
+    The parts come from split_plays_by_track(), so no play is in two
+    of them, but an artist may be, and the first year columns are
+    computed again across all the plays.
 
-        ]
+    Parameters
+    ----------
+    parts: list
+        the analysis dataframes of the parts
 
-    columns = [col for col in desired_cols if col in df.columns]
+    Returns
+    -------
+    df: pandas.core.frame.DataFrame
+        one analysis dataframe, sorted by timestamp_listened
+    """
+    if len(parts) == 1:
+        return parts[0]
 
-    df = df[columns]
+    df = pd.concat(parts, ignore_index=True)
+    df = df.sort_values(by='timestamp_listened', kind='stable').reset_index(drop=True)
+    df = first_year_listened(df)
 
-    return df
+    # concatenating categoricals with different categories falls back to object columns
+    return apply_analysis_schema(df)
 
+def finish_enrichment_job(job_key):
+    """Forgets a finished background enrichment job once its result is saved."""
+    with _enrichment_jobs_lock:
+        _enrichment_jobs.pop(job_key, None)
 
 def pivot_features(df, id_vars =  ['unique_id','timestamp_listened',
                                     'key','key_name','mode','mode_name',
@@ -1250,7 +3809,43 @@ def load_df_from_supabase(user_id: str) -> pd.DataFrame:
     with tempfile.NamedTemporaryFile(delete=False, suffix=".parquet") as tmp:
         tmp.write(raw_bytes)
         tmp.seek(0)
-        return pd.read_parquet(tmp.name)
+        df = pd.read_parquet(tmp.name)
+
+    # files saved before the calendar columns, list genres or the compact schema existed are converted on load
+    if (not all(column in df.columns for column in CALENDAR_COLUMNS)
+            or not df['timestamp_listened'].is_monotonic_increasing):
+        df = add_calendar_columns(df)
+    if 'genres' in df.columns:
+        df['genres'] = genres_as_lists(df['genres'])
+    return apply_analysis_schema(df)
+
+def _save_table_to_supabase(user_id: str, name: str, df: pd.DataFrame):
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False)
+    upload_file_to_supabase("user-data", f"{user_id}/{name}.parquet", buffer.getvalue())
+
+def _load_table_from_supabase(user_id: str, name: str):
+    try:
+        raw_bytes = download_file_from_supabase("user-data", f"{user_id}/{name}.parquet")
+    except Exception:
+        return None
+    return pd.read_parquet(io.BytesIO(raw_bytes))
+
+def save_cube_to_supabase(user_id: str, cube: pd.DataFrame):
+    """Saves the rollup cube from build_rollup_cube() next to final_df.parquet."""
+    _save_table_to_supabase(user_id, "rollup_cube", cube)
+
+def load_cube_from_supabase(user_id: str):
+    """Loads the saved rollup cube, or None if none was saved."""
+    return _load_table_from_supabase(user_id, "rollup_cube")
+
+def save_period_index_to_supabase(user_id: str, period_index: pd.DataFrame):
+    """Saves the period offsets from build_period_index() next to final_df.parquet."""
+    _save_table_to_supabase(user_id, "period_index", period_index)
+
+def load_period_index_from_supabase(user_id: str):
+    """Loads the saved period offsets, or None if none were saved."""
+    return _load_table_from_supabase(user_id, "period_index")
 
 def save_raw_json_to_supabase(user_id: str, json_str: str):
     upload_file_to_supabase("user-data", f"{user_id}/spotify_raw.json", json_str.encode("utf-8"))
@@ -1259,9 +3854,22 @@ def load_raw_json_from_supabase(user_id: str) -> pd.DataFrame:
     raw_bytes = download_file_from_supabase("user-data", f"{user_id}/spotify_raw.json")
     return pd.read_json(raw_bytes)
 
+def save_fingerprints_to_supabase(user_id: str, fingerprints: dict):
+    """Saves the {fingerprint: file name} record of processed export files next to final_df.parquet."""
+    upload_file_to_supabase("user-data", f"{user_id}/source_fingerprints.json", json.dumps(fingerprints).encode("utf-8"))
+
+def load_fingerprints_from_supabase(user_id: str) -> dict:
+    """Loads the processed export file fingerprints, or an empty dict if none were saved."""
+    try:
+        raw_bytes = download_file_from_supabase("user-data", f"{user_id}/source_fingerprints.json")
+    except Exception:
+        return {}
+    return json.loads(raw_bytes)
+
 def delete_user_files(user_id: str):
     bucket = "user-data"
-    paths = [f"{user_id}/spotify_raw.json", f"{user_id}/final_df.parquet"]
+    paths = [f"{user_id}/spotify_raw.json", f"{user_id}/final_df.parquet", f"{user_id}/source_fingerprints.json",
+             f"{user_id}/rollup_cube.parquet", f"{user_id}/period_index.parquet"]
     for path in paths:
         try:
             supabase.storage.from_(bucket).remove([path])
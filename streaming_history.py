@@ -0,0 +1,299 @@
+"""
+Parsing of the Streaming_History_Audio JSON files in a Spotify extended
+streaming history export.
+
+This is kept apart from spotify_funcs.py so the worker processes of the
+parallel ingest only import this module and pandas, not Streamlit and
+the API clients.
+"""
+
+import codecs
+import io
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+# Column types of the Streaming_History_Audio export files. Older exports use the
+# *_decrypted and username fields, newer ones add the audiobook fields.
+SPOTIFY_HISTORY_COLUMNS = {
+    'ts': 'string',
+    'username': 'string',
+    'platform': 'string',
+    'ms_played': 'int',
+    'conn_country': 'string',
+    'ip_addr': 'string',
+    'ip_addr_decrypted': 'string',
+    'user_agent_decrypted': 'string',
+    'master_metadata_track_name': 'string',
+    'master_metadata_album_artist_name': 'string',
+    'master_metadata_album_album_name': 'string',
+    'spotify_track_uri': 'string',
+    'episode_name': 'string',
+    'episode_show_name': 'string',
+    'spotify_episode_uri': 'string',
+    'audiobook_title': 'string',
+    'audiobook_uri': 'string',
+    'audiobook_chapter_uri': 'string',
+    'audiobook_chapter_title': 'string',
+    'reason_start': 'string',
+    'reason_end': 'string',
+    'shuffle': 'bool',
+    'skipped': 'bool',
+    'offline': 'bool',
+    'offline_timestamp': 'int',
+    'incognito_mode': 'bool'
+}
+
+# String columns whose values repeat across plays and are worth storing once.
+# Timestamps and IP addresses are close to unique, so interning them would
+# only keep a second reference to every value while parsing.
+INTERNED_COLUMNS = {
+    'username',
+    'platform',
+    'conn_country',
+    'user_agent_decrypted',
+    'master_metadata_track_name',
+    'master_metadata_album_artist_name',
+    'master_metadata_album_album_name',
+    'spotify_track_uri',
+    'episode_name',
+    'episode_show_name',
+    'spotify_episode_uri',
+    'audiobook_title',
+    'audiobook_uri',
+    'audiobook_chapter_uri',
+    'audiobook_chapter_title',
+    'reason_start',
+    'reason_end'
+}
+
+def iter_json_array(file, chunk_size=1 << 20):
+    """
+    Yields the records of a JSON array one at a time, reading the
+    file in chunks instead of loading the whole document.
+
+    Parameters
+    ----------
+    file : file-like
+        a binary or text file containing a JSON array of objects
+
+    chunk_size : int
+        the number of bytes to read from the file at a time
+
+    Returns
+    -------
+    records : generator of dict
+        the decoded records, in file order
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer = ''
+    pos = 0
+    eof = False
+    opened = False
+
+    while True:
+        # skip whitespace and the separators between records
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+
+        if pos < len(buffer):
+            if not opened:
+                if buffer[pos] != '[':
+                    raise ValueError("Expected a JSON array of streaming history records.")
+                opened = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the record continues past the end of the buffer
+                if eof:
+                    raise ValueError("Malformed record in streaming history JSON.")
+            else:
+                yield record
+                continue
+        elif eof:
+            raise ValueError("Unexpected end of streaming history JSON.")
+
+        # read the next chunk, keeping any partial record
+        chunk = file.read(chunk_size)
+        if isinstance(chunk, bytes):
+            chunk = text_decoder.decode(chunk, final=not chunk)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+class StreamingHistoryBuffer:
+    """
+    Typed column buffers that streaming history records are written into
+    directly, so no intermediate list of records is kept in memory.
+
+    Buffers are preallocated and grow by doubling. Repeated strings
+    (platforms, countries, track names...) are stored once per column,
+    see INTERNED_COLUMNS.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.capacity = max(int(capacity), 1)
+        self.columns = {}
+        self.masks = {}
+        self.strings = {}
+
+    def _add_column(self, name):
+        kind = SPOTIFY_HISTORY_COLUMNS.get(name, 'object')
+        if kind == 'int':
+            self.columns[name] = np.zeros(self.capacity, dtype=np.int64)
+        elif kind == 'bool':
+            self.columns[name] = np.zeros(self.capacity, dtype=bool)
+        else:
+            self.columns[name] = np.full(self.capacity, None, dtype=object)
+            if name in INTERNED_COLUMNS:
+                self.strings[name] = {}
+
+        # a True mask value marks a missing entry
+        if kind in ('int', 'bool'):
+            self.masks[name] = np.ones(self.capacity, dtype=bool)
+
+    def reserve(self, capacity):
+        """
+        Grows every column buffer to hold at least `capacity` records.
+        """
+        if capacity <= self.capacity:
+            return
+
+        new_capacity = max(capacity, self.capacity * 2)
+        for name, values in self.columns.items():
+            fill = None if values.dtype == object else 0
+            grown = np.full(new_capacity, fill, dtype=values.dtype)
+            grown[:self.size] = values[:self.size]
+            self.columns[name] = grown
+        for name, mask in self.masks.items():
+            grown = np.ones(new_capacity, dtype=bool)
+            grown[:self.size] = mask[:self.size]
+            self.masks[name] = grown
+        self.capacity = new_capacity
+
+    def append(self, record):
+        """
+        Writes a single streaming history record into the column buffers.
+        """
+        if self.size == self.capacity:
+            self.reserve(self.size + 1)
+
+        row = self.size
+        for name, value in record.items():
+            if name not in self.columns:
+                self._add_column(name)
+            if value is None:
+                continue
+
+            if name in self.masks:
+                self.columns[name][row] = value
+                self.masks[name][row] = False
+            elif name in self.strings and isinstance(value, str):
+                self.columns[name][row] = self.strings[name].setdefault(value, value)
+            else:
+                self.columns[name][row] = value
+
+        self.size += 1
+
+    def extend(self, file):
+        """
+        Streams every record of a JSON array file into the buffers.
+        """
+        # estimate the number of records from the file size to avoid regrowing
+        size = getattr(file, 'size', None)
+        if size:
+            self.reserve(self.size + size // 250)
+
+        for record in iter_json_array(file):
+            self.append(record)
+
+    def to_frame(self):
+        """
+        Returns the buffered records as a DataFrame, emptying the buffer.
+
+        Each column is trimmed and its buffer freed before the next one
+        is built, so memory peaks at the buffers plus one column instead
+        of twice the parsed data.
+        """
+        n = self.size
+        data = {}
+        for name in list(self.columns):
+            values = self.columns.pop(name)
+            if n < len(values):
+                values = values[:n].copy()
+            if name in self.masks:
+                mask = self.masks.pop(name)
+                if n < len(mask):
+                    mask = mask[:n].copy()
+                if values.dtype == bool:
+                    values = pd.arrays.BooleanArray(values, mask)
+                else:
+                    values = pd.arrays.IntegerArray(values, mask)
+            data[name] = values
+
+        self.strings = {}
+        self.size = 0
+        # copy=False keeps the trimmed columns instead of consolidating them into new blocks
+        return pd.DataFrame(data, index=pd.RangeIndex(n), copy=False)
+
+
+def disk_path(file):
+    """
+    Returns the path of an open file that is on disk, or None for
+    in-memory files such as Streamlit uploads.
+    """
+    if isinstance(file, (io.BufferedReader, io.FileIO)) and os.path.isfile(file.name):
+        return file.name
+    return None
+
+def history_source(file):
+    """
+    Describes an open audio history file for read_history_source(), so
+    it can be parsed in another process. Files on disk, and members of
+    archives on disk, are described by path and opened by the worker.
+    In-memory files are described by their content.
+    """
+    archive_path = getattr(file, 'archive_path', None)
+    if archive_path is not None:
+        return ('zip', archive_path, file.member_name)
+
+    path = disk_path(file)
+    if path is not None:
+        return ('path', path)
+
+    file.seek(0)
+    return ('bytes', file.read())
+
+def read_history_source(source):
+    """
+    Parses one audio history file described by history_source() into
+    a DataFrame. Runs in the worker processes of the parallel ingest.
+    """
+    kind = source[0]
+    if kind == 'bytes':
+        data = source[1]
+        buffer = StreamingHistoryBuffer(len(data) // 250 + 1)
+        buffer.extend(io.BytesIO(data))
+        return buffer.to_frame()
+
+    if kind == 'zip':
+        with zipfile.ZipFile(source[1]) as archive, archive.open(source[2]) as file:
+            buffer = StreamingHistoryBuffer(archive.getinfo(source[2]).file_size // 250 + 1)
+            buffer.extend(file)
+            return buffer.to_frame()
+
+    with open(source[1], 'rb') as file:
+        buffer = StreamingHistoryBuffer(os.fstat(file.fileno()).st_size // 250 + 1)
+        buffer.extend(file)
+        return buffer.to_frame()
@@ -0,0 +1,115 @@
+"""
+Shared fixtures: small synthetic Spotify exports and the local mock
+Spotify API from mock_spotify_api.py.
+
+spotify_funcs reads its credentials and creates its Supabase client
+from st.secrets when it is imported, so placeholder secrets are set
+first, and its caches are pointed at a temporary folder.
+"""
+
+import io
+import json
+import os
+import random
+import tempfile
+
+import pandas as pd
+import pytest
+import streamlit as st
+
+os.environ.setdefault('SPOTIFY_CACHE_DIR', tempfile.mkdtemp(prefix='spotify-tests-'))
+st.secrets = {
+    'CLIENT_ID': 'test-id',
+    'CLIENT_SECRET': 'test-secret',
+    'SUPABASE_URL': 'http://localhost:54321',
+    'SUPABASE_KEY': 'test.test.test'
+}
+
+import spotify_funcs as sf
+from mock_spotify_api import MockSpotifyAPI, synthetic_track
+
+def make_history(count, seed=0, tracks=200, years=range(2015, 2024), episodes=0.0):
+    """
+    Returns `count` Streaming_History_Audio records for tracks the
+    mock API knows, spread over the given years. About `episodes` of
+    them are podcast plays, without track fields.
+    """
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        track_id = f"track{rng.randrange(tracks):04d}"
+        track = synthetic_track(track_id)
+        records.append({
+            'ts': f"{rng.choice(years)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}T"
+                  f"{rng.randrange(24):02d}:{rng.randrange(60):02d}:{i % 60:02d}Z",
+            'platform': rng.choice(['ios', 'android', 'web_player']),
+            'ms_played': rng.randrange(1, 300000),
+            'conn_country': 'CA',
+            'ip_addr': '127.0.0.1',
+            'master_metadata_track_name': track['name'],
+            'master_metadata_album_artist_name': track['album']['artists'][0]['name'],
+            'master_metadata_album_album_name': track['album']['name'],
+            'spotify_track_uri': f"spotify:track:{track_id}",
+            'reason_start': 'fwdbtn',
+            'reason_end': 'trackdone',
+            'shuffle': rng.random() < 0.5,
+            'skipped': False,
+            'offline': False,
+            'offline_timestamp': None,
+            'incognito_mode': False
+        })
+        if rng.random() < episodes:
+            records[-1].update({'master_metadata_track_name': None, 'master_metadata_album_artist_name': None,
+                                'master_metadata_album_album_name': None, 'spotify_track_uri': None,
+                                'episode_name': 'An episode', 'spotify_episode_uri': 'spotify:episode:0'})
+    return records
+
+def export_file(records, name='Streaming_History_Audio_2021.json'):
+    """
+    Returns an in-memory export file, named like a Streamlit upload.
+    """
+    file = io.BytesIO(json.dumps(records).encode('utf-8'))
+    file.name = name
+    return file
+
+def comparable(df):
+    """
+    Returns an analysis dataframe in a form assert_frame_equal() can
+    compare regardless of row order and categories.
+    """
+    df = df.sort_values('unique_id').reset_index(drop=True)
+    df['genres'] = df['genres'].map(list)
+    return df.astype({column: 'object' for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)})
+
+@pytest.fixture(scope='session')
+def mock_api():
+    """
+    Points the Spotify endpoints at a local MockSpotifyAPI for the session.
+    """
+    server = MockSpotifyAPI()
+    base_url = server.start()
+    api_url, token_url = sf.SPOTIFY_API_URL, sf.SPOTIFY_TOKEN_URL
+    sf.SPOTIFY_API_URL, sf.SPOTIFY_TOKEN_URL = f"{base_url}/v1", f"{base_url}/api/token"
+    yield server
+    sf.SPOTIFY_API_URL, sf.SPOTIFY_TOKEN_URL = api_url, token_url
+    server.stop()
+
+@pytest.fixture
+def pipeline_cache(tmp_path, monkeypatch):
+    """
+    Gives each test its own pipeline cache folder.
+    """
+    monkeypatch.setattr(sf, 'SPOTIFY_CACHE_DIR', str(tmp_path))
+    return tmp_path
+
+@pytest.fixture(scope='session')
+def analysis_df(mock_api, tmp_path_factory):
+    """
+    An analysis dataframe enriched from a synthetic export, shared by
+    the tests that only read it.
+    """
+    cache = pytest.MonkeyPatch()
+    cache.setattr(sf, 'SPOTIFY_CACHE_DIR', str(tmp_path_factory.mktemp('cache')))
+    raw = sf.read_spotify_json([export_file(make_history(2000, seed=5))], streaming=True)
+    yield sf.enrich_spotify_data(raw, 'id', 'secret')
+    cache.undo()
@@ -0,0 +1,44 @@
+import time
+
+import pandas as pd
+
+import spotify_funcs as sf
+from tests.conftest import comparable, export_file, make_history
+
+def wait_for(job, timeout=60):
+    deadline = time.monotonic() + timeout
+    while job['status'] == 'running' and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return job
+
+def test_split_plays_by_track_keeps_tracks_together():
+    raw = sf.read_spotify_json([export_file(make_history(1000, tracks=120))], streaming=True)
+    parts = sf.split_plays_by_track(raw, part_tracks=50)
+
+    track_ids = [set(sf.track_ids_from_uris(part['spotify_track_uri'])) for part in parts]
+    assert len(parts) == 3 and sum(len(part) for part in parts) == len(raw)
+    assert not track_ids[0] & track_ids[1] and not track_ids[1] & track_ids[2]
+    # the most played tracks come first
+    assert len(parts[0]) / len(track_ids[0]) >= len(parts[2]) / len(track_ids[2])
+
+def test_background_parts_match_a_single_run(mock_api, pipeline_cache):
+    raw = sf.read_spotify_json([export_file(make_history(1000, tracks=120))], streaming=True)
+
+    job = wait_for(sf.start_background_enrichment('parts', raw, 'id', 'secret', part_tracks=50))
+    sf.finish_enrichment_job('parts')
+    assert job['status'] == 'done', job['error']
+    assert job['parts'] == job['parts_done'] == 3 and job['enriched'] == [job['result']]
+
+    single = sf.enrich_spotify_data(raw, 'id', 'secret')
+    pd.testing.assert_frame_equal(comparable(job['result']), comparable(single), check_like=True)
+
+def test_abandoned_jobs_are_forgotten(mock_api, pipeline_cache, monkeypatch):
+    raw = sf.read_spotify_json([export_file(make_history(200))], streaming=True)
+    job = wait_for(sf.start_background_enrichment('abandoned', raw, 'id', 'secret'))
+    assert job['status'] == 'done'
+
+    # nobody polled it for longer than the ttl, e.g. the tab was closed
+    monkeypatch.setattr(sf, 'ENRICHMENT_JOB_TTL', 60)
+    job['polled'] -= 61
+    assert sf.get_enrichment_job('another') is None
+    assert sf.get_enrichment_job('abandoned') is None
@@ -0,0 +1,103 @@
+import time
+
+import pandas as pd
+import pytest
+
+import spotify_funcs as sf
+from mock_spotify_api import synthetic_track
+
+DAY = 24 * 60 * 60
+
+class Clock:
+    """A time.time() stand-in the tests move forward by hand."""
+
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    return clock
+
+def tracks(*track_ids):
+    columns = sf.decode_response_columns([synthetic_track(track_id) for track_id in track_ids],
+                                         sf.TRACK_RESPONSE_FIELDS)
+    return pd.DataFrame(columns).set_index('track_id')
+
+def test_track_cache_counts_hits_and_misses(tmp_path, clock):
+    cache = sf.TrackMetadataCache(tmp_path / 'tracks.sqlite')
+    cache.put(tracks('a', 'b'))
+
+    cached, missing = cache.get(['a', 'x', 'b', 'y'])
+    assert sorted(cached.index) == ['a', 'b'] and missing == ['x', 'y']
+    cache.get(['a'])
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    pd.testing.assert_frame_equal(cached.loc[['a', 'b']], tracks('a', 'b')[sf.TRACK_CACHE_COLUMNS],
+                                  check_dtype=False)
+
+def test_track_cache_expires_entries(tmp_path, clock):
+    cache = sf.TrackMetadataCache(tmp_path / 'tracks.sqlite', ttl_days=30)
+    cache.put(tracks('old'))
+    clock.now += 20 * DAY
+    cache.put(tracks('new'))
+
+    clock.now += 11 * DAY
+    cached, missing = cache.get(['old', 'new'])
+    assert list(cached.index) == ['new'] and missing == ['old']
+
+def test_track_cache_evicts_least_recently_used(tmp_path, clock):
+    assert sf.TrackMetadataCache(tmp_path / 'default.sqlite').max_entries == 500_000
+
+    cache = sf.TrackMetadataCache(tmp_path / 'tracks.sqlite', max_entries=3)
+    for track_id in ['a', 'b', 'c']:
+        cache.put(tracks(track_id))
+        clock.now += 1
+
+    # reading 'a' makes 'b' the least recently used
+    cache.get(['a'])
+    clock.now += 1
+    cache.put(tracks('d'))
+
+    cached, missing = cache.get(['a', 'b', 'c', 'd'])
+    assert sorted(cached.index) == ['a', 'c', 'd'] and missing == ['b']
+
+def artist_requests(mock_api, artist_ids):
+    before = dict(mock_api.stats)
+    metadata = pd.DataFrame({'artist_id': artist_ids})
+    genres = sf.get_multiple_artist_genres(metadata, 'mock-token', progress_callback=lambda *_: None)
+    assert sorted(genres['artist_id']) == sorted(artist_ids)
+    return mock_api.stats['artists'] - before['artists'], mock_api.stats['ids'] - before['ids']
+
+def test_artist_cache_refetches_only_stale_artists(mock_api, pipeline_cache, clock):
+    old = [f"stale{i:03d}" for i in range(60)]
+    new = [f"fresh{i:03d}" for i in range(60)]
+    assert artist_requests(mock_api, old) == (2, 60)
+    clock.now += 100 * DAY
+    assert artist_requests(mock_api, new) == (2, 60)
+
+    # a warm cache sends no requests at all
+    assert artist_requests(mock_api, old + new) == (0, 0)
+
+    # past 180 days only the artists fetched first are requested again
+    clock.now += 81 * DAY
+    assert artist_requests(mock_api, old + new) == (2, 60)
+
+def test_artist_cache_evicts_least_frequently_used(tmp_path, clock):
+    cache = sf.ArtistGenreCache(tmp_path / 'artists.sqlite', max_entries=3)
+    cache.put(pd.DataFrame({'artist_id': ['a', 'b', 'c'], 'genres': [['pop'], ['rock'], ['jazz']]}))
+    for artist_id in ['a', 'a', 'a', 'b', 'c', 'c']:
+        clock.now += 1
+        cache.get([artist_id])
+
+    # 'a' is the least recently used but 'b' the least frequently, so 'b' goes
+    clock.now += 1
+    cache.put(pd.DataFrame({'artist_id': ['d'], 'genres': [['funk']]}))
+
+    cached, missing = cache.get(['a', 'b', 'c', 'd'])
+    assert sorted(cached['artist_id']) == ['a', 'c', 'd'] and missing == ['b']
+    assert dict(zip(cached['artist_id'], cached['genres']))['a'] == ['pop']
@@ -0,0 +1,87 @@
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+
+import spotify_funcs as sf
+from mock_spotify_api import MockSpotifyAPI
+
+TRACK_IDS = [f"resume{i:05d}" for i in range(500)]
+
+class RecordingAPI(MockSpotifyAPI):
+    """A mock API that also records the track ids requested."""
+
+    def __init__(self):
+        super().__init__()
+        self.requested = []
+
+    def handle(self, method, path):
+        url = urlparse(path)
+        if url.path == '/v1/tracks':
+            self.requested.extend(parse_qs(url.query)['ids'][0].split(','))
+        return super().handle(method, path)
+
+class Interrupted(Exception):
+    pass
+
+def interrupt_after(batches):
+    def progress(done, total):
+        if done == batches:
+            raise Interrupted
+    return progress
+
+@pytest.fixture
+def api(pipeline_cache, monkeypatch):
+    server = RecordingAPI()
+    base_url = server.start()
+    monkeypatch.setattr(sf, 'SPOTIFY_API_URL', f"{base_url}/v1")
+    monkeypatch.setattr(sf, 'SPOTIFY_TOKEN_URL', f"{base_url}/api/token")
+    monkeypatch.setattr(sf, '_spotify_clients', {})
+    yield server
+    server.stop()
+
+def comparable_metadata(metadata):
+    metadata = metadata.sort_values('track_id').reset_index(drop=True)
+    metadata['genres'] = metadata['genres'].map(list)
+    return metadata
+
+def saved_track_ids(user_id, track_ids):
+    checkpoint = sf.EnrichmentCheckpoint(user_id, sf.enrichment_run_id(track_ids))
+    return set(checkpoint.load_items(f"{sf.SPOTIFY_API_URL}/tracks"))
+
+def uninterrupted(tmp_path, monkeypatch):
+    monkeypatch.setattr(sf, 'SPOTIFY_CACHE_DIR', str(tmp_path / 'clean'))
+    metadata = sf.fetch_track_metadata(TRACK_IDS, 'id', 'secret', user_id='clean', progress_callback=lambda *_: None)
+    monkeypatch.undo()
+    return metadata
+
+def test_interrupted_fetch_resumes(api, pipeline_cache, tmp_path, monkeypatch):
+    with pytest.raises(Interrupted):
+        sf.fetch_track_metadata(TRACK_IDS, 'id', 'secret', user_id='user1', progress_callback=interrupt_after(3))
+    saved = saved_track_ids('user1', TRACK_IDS)
+    assert len(saved) >= 150
+
+    api.requested.clear()
+    resumed = sf.fetch_track_metadata(TRACK_IDS, 'id', 'secret', user_id='user1', progress_callback=lambda *_: None)
+
+    # only the batches not saved before the interruption are requested again
+    assert sorted(api.requested) == sorted(set(TRACK_IDS) - saved)
+    assert not list((pipeline_cache / 'checkpoints' / 'user1').glob('*'))
+
+    expected = uninterrupted(tmp_path, monkeypatch)
+    pd.testing.assert_frame_equal(comparable_metadata(resumed), comparable_metadata(expected))
+
+def test_resume_survives_the_shared_cache_changing(api, pipeline_cache):
+    with pytest.raises(Interrupted):
+        sf.fetch_track_metadata(TRACK_IDS, 'id', 'secret', user_id='user1', progress_callback=interrupt_after(3))
+    saved = saved_track_ids('user1', TRACK_IDS)
+
+    # another user's run caches every fourth track in the meantime
+    others = TRACK_IDS[::4]
+    sf.fetch_track_metadata(others, 'id', 'secret', user_id='user2', progress_callback=lambda *_: None)
+
+    api.requested.clear()
+    resumed = sf.fetch_track_metadata(TRACK_IDS, 'id', 'secret', user_id='user1', progress_callback=lambda *_: None)
+
+    assert sorted(api.requested) == sorted(set(TRACK_IDS) - saved - set(others))
+    assert set(resumed['track_id']) == set(TRACK_IDS)
@@ -0,0 +1,43 @@
+import warnings
+
+import pandas as pd
+import pytest
+
+import spotify_funcs as sf
+from tests.conftest import comparable, export_file, make_history
+
+@pytest.fixture
+def exports():
+    records = make_history(1500, seed=3, episodes=0.05)
+    # a few plays without a timestamp, which have no year
+    for record in records[100:1400:300]:
+        record['ts'] = None
+    # the second file overlaps the first, as consecutive exports do
+    return [export_file(records[:1000], 'Streaming_History_Audio_2015-2019.json'),
+            export_file(records[800:], 'Streaming_History_Audio_2019-2023.json')]
+
+def test_chunked_matches_in_memory(exports, mock_api, pipeline_cache, tmp_path):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', pd.errors.SettingWithCopyWarning)
+        sf.process_spotify_exports_chunked(exports, tmp_path / 'out', 'id', 'secret', chunk_rows=400)
+    chunked = sf.load_chunked_spotify_data(tmp_path / 'out')
+
+    in_memory = sf.enrich_spotify_data(sf.read_spotify_json(exports, streaming=True), 'id', 'secret')
+
+    assert len(chunked) == len(in_memory) > 1300
+    assert chunked['timestamp_listened'].isna().sum() == in_memory['timestamp_listened'].isna().sum() == 5
+    assert not list((tmp_path / 'out').glob('seen-*'))
+    pd.testing.assert_frame_equal(comparable(chunked), comparable(in_memory), check_like=True)
+
+def test_chunked_years_filter(exports, mock_api, pipeline_cache, tmp_path):
+    sf.process_spotify_exports_chunked(exports, tmp_path / 'out', 'id', 'secret', chunk_rows=400)
+    df = sf.load_chunked_spotify_data(tmp_path / 'out', columns=['unique_id', 'timestamp_listened'], years=[2016])
+
+    assert len(df) and (df['timestamp_listened'].dt.year == 2016).all()
+
+def test_provisional_frame_without_warnings(exports):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', pd.errors.SettingWithCopyWarning)
+        df = sf.build_provisional_df(sf.read_spotify_json(exports, streaming=True))
+
+    assert (df['general_genre'] == 'unknown genre').all()
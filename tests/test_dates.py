@@ -0,0 +1,49 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import spotify_funcs as sf
+
+def baseline_convert_to_datetime(df, column):
+    # convert_to_datetime() before it used parse_release_dates()
+    df[column] = df[column].astype(str)
+    df[column] = df[column].fillna('NA')
+    year_only_mask = df[column].str.match(r'^\d{4}$')
+    year_month_mask = df[column].str.match(r'^\d{4}-\d{2}$')
+    df.loc[year_only_mask, column] = pd.to_datetime(df.loc[year_only_mask, column].astype(str) + '-01-01', errors='coerce')
+    df.loc[year_month_mask, column] = pd.to_datetime(df.loc[year_month_mask, column] + '-01', errors='coerce')
+    df.loc[~(year_only_mask | year_month_mask), column] = pd.to_datetime(df.loc[~(year_only_mask | year_month_mask), column], errors='coerce')
+    df[column] = pd.to_datetime(df[column], errors='coerce')
+    df[column] = df[column].replace('NA', np.nan)
+    return df
+
+@pytest.mark.parametrize('values', [
+    ['1999', '1999-07', '2010-03-15', '1999', '2010-03-15', '1965-12'],
+    ['2001', None, '2020-13', '2021-02-30', 'not a date', '0000', np.nan, '2003-04-05'],
+    [None, np.nan, None],
+])
+def test_release_dates_match_the_baseline(values):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = baseline_convert_to_datetime(pd.DataFrame({'date': pd.Series(values, dtype='object')}), 'date')
+
+    dates, _ = sf.parse_release_dates(pd.Series(values, dtype='object'))
+    pd.testing.assert_series_equal(dates, expected['date'], check_names=False, check_dtype=False)
+
+@pytest.mark.parametrize('value, date, precision', [
+    ('1999', '1999-01-01', 'year'),
+    ('1999-07', '1999-07-01', 'month'),
+    ('2010-03-15', '2010-03-15', 'day'),
+    ('2021-02-30', None, None),
+    ('2020-13', None, None),
+    ('March 2010', None, None),
+    (None, None, None),
+])
+def test_release_date_precision(value, date, precision):
+    dates, precisions = sf.parse_release_dates(pd.Series([value, '2000'], dtype='object'))
+
+    assert (dates[0] == pd.Timestamp(date)) if date else pd.isna(dates[0])
+    assert (precisions[0] == precision) if precision else pd.isna(precisions[0])
+    assert list(precisions.cat.categories) == sf.RELEASE_DATE_PRECISIONS
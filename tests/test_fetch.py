@@ -0,0 +1,73 @@
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import spotify_funcs as sf
+from mock_spotify_api import MockSpotifyAPI
+
+TRACK_IDS = [f"fetch{i:05d}" for i in range(500)]
+CHUNKS = [TRACK_IDS[i:i + 50] for i in range(0, len(TRACK_IDS), 50)]
+
+@pytest.fixture
+def flaky_api():
+    server = MockSpotifyAPI(rate_limit_rate=0.2, error_rate=0.2, retry_after=0.01, seed=7)
+    base_url = server.start()
+    yield server, sf.SpotifyClient('id', 'secret', api_url=f"{base_url}/v1", token_url=f"{base_url}/api/token")
+    server.stop()
+
+def fetch_tracks(client, **options):
+    fetcher = sf.SpotifyBatchFetcher(client, requests_per_second=1000, backoff=0.01, **options)
+    return fetcher, fetcher.fetch(f"{client.api_url}/tracks", CHUNKS)
+
+def test_fetch_retries_rate_limits_and_errors(flaky_api, mock_api):
+    server, client = flaky_api
+    clean_url = sf.SPOTIFY_API_URL
+    clean = sf.SpotifyClient('id', 'secret', api_url=clean_url, token_url=sf.SPOTIFY_TOKEN_URL)
+    _, expected = fetch_tracks(clean)
+
+    fetcher, responses = fetch_tracks(client, max_retries=20)
+
+    assert responses == expected
+    assert fetcher.failed_batches == 0
+    assert server.stats['rate_limited'] > 0 and server.stats['errors'] > 0
+    # every id was served once its batch got through
+    assert server.stats['ids'] == len(TRACK_IDS)
+
+def test_fetch_gives_up_after_max_retries():
+    server = MockSpotifyAPI(error_rate=1.0)
+    base_url = server.start()
+    try:
+        client = sf.SpotifyClient(access_token='mock-token', api_url=f"{base_url}/v1")
+        fetcher, responses = fetch_tracks(client, max_retries=2)
+    finally:
+        server.stop()
+
+    assert responses == [None] * len(CHUNKS)
+    assert fetcher.failed_batches == len(CHUNKS)
+    assert server.stats['errors'] == len(CHUNKS) * 3
+
+def test_token_bucket_limits_the_request_rate():
+    bucket = sf.TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(26):
+        bucket.acquire()
+
+    assert time.monotonic() - start >= 0.45
+
+@pytest.mark.parametrize('value, expected', [
+    ('2', 2.0),
+    ('0.5', 0.5),
+    (None, 3.0),
+    ('soon', 3.0),
+    ('nan', 3.0),
+    ('-4', 0.0),
+    ('86400', 60.0),
+])
+def test_retry_after_seconds(value, expected):
+    assert sf.retry_after_seconds(value, 3.0, 60.0) == expected
+
+def test_retry_after_as_an_http_date():
+    value = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= sf.retry_after_seconds(value, 3.0, 60.0) <= 30
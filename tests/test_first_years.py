@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+import spotify_funcs as sf
+
+def baseline_first_year_listened(df):
+    # first_year_listened() before it was vectorized
+    df['timestamp_listened'] = pd.to_datetime(df['timestamp_listened'])
+    df["Year_Listened"] = df['timestamp_listened'].dt.year
+    years_listened = df.groupby('track-artist')['Year_Listened'].agg(list).reset_index()
+    years_listened["first_year_listened"] = years_listened["Year_Listened"].apply(min)
+    df = pd.merge(df, years_listened[['track-artist', 'first_year_listened']], on='track-artist', how='left')
+    artists_first_listen = df.groupby('artist')['Year_Listened'].agg(list).reset_index()
+    artists_first_listen["first_year_artist_listened"] = artists_first_listen["Year_Listened"].apply(min)
+    df = pd.merge(df, artists_first_listen[['artist', 'first_year_artist_listened']], on='artist', how='left')
+    return df.drop(columns=['Year_Listened'])
+
+def test_first_years_match_the_baseline_with_missing_keys():
+    df = pd.DataFrame({
+        'timestamp_listened': ['2019-05-01', '2016-01-01', '2021-07-01', '2015-03-01', '2018-02-01', '2020-09-09'],
+        'track-artist': ['a - x', 'a - x', None, 'b - x', None, 'c - y'],
+        'artist': ['x', 'x', None, 'x', 'y', None]
+    })
+    expected = baseline_first_year_listened(df.copy())
+
+    result = sf.first_year_listened(df)
+
+    for column in sf.FIRST_YEAR_KEYS:
+        np.testing.assert_array_equal(result[column].to_numpy(dtype='float'),
+                                      expected[column].to_numpy(dtype='float'))
+    # rows without a key got a null first year, not one shared between them
+    assert result['first_year_listened'].isna().tolist() == [False, False, True, False, True, False]
+    assert result['first_year_artist_listened'].isna().tolist() == [False, False, True, False, False, True]
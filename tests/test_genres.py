@@ -0,0 +1,51 @@
+import json
+import threading
+
+import pytest
+
+import spotify_funcs as sf
+
+GENRES = ['k-pop', 'pop', 'Pop Rock', 'folk-pop', 'indie folk', 'unknown genre', 'k-pop boy group',
+          'classic rock', 'hip hop', 'alternative hip hop', 'dance pop', 'polka', 'bossa nova']
+
+@pytest.mark.parametrize('list_of_genres', [
+    None,
+    ['rock', 'pop', 'folk'],
+    ['hip hop', 'indie', 'k-pop', 'pop'],
+])
+def test_classifier_matches_get_general_genre(list_of_genres):
+    if list_of_genres is None:
+        expected = {genre: sf.get_general_genre(genre) for genre in GENRES}
+        list_of_genres = sf.get_general_genre.__defaults__[0]
+    else:
+        expected = {genre: sf.get_general_genre(genre, list_of_genres) for genre in GENRES}
+
+    assert sf.classify_general_genres(GENRES, list_of_genres) == expected
+
+def test_classifier_priority_cases():
+    general = sf.classify_general_genres(GENRES, sf.get_general_genre.__defaults__[0])
+
+    assert general['k-pop'] == general['k-pop boy group'] == 'k-pop'
+    assert general['folk-pop'] == 'folk'
+    assert general['Pop Rock'] == 'pop'
+    assert general['bossa nova'] == 'unique genre'
+
+def test_concurrent_lookups_keep_every_genre(tmp_path):
+    path = str(tmp_path / 'general_genres.json')
+
+    # separate lookups stand in for separate processes sharing the file
+    def classify(worker):
+        lookup = sf.GeneralGenreLookup(path)
+        for i in range(20):
+            lookup.classify([f"genre {worker} {i} pop"], ['pop'])
+
+    threads = [threading.Thread(target=classify, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(path, encoding='utf-8') as f:
+        table = json.load(f)['pop']
+    assert len(table) == 8 * 20 and set(table.values()) == {'pop'}
+    assert not list(tmp_path.glob('*.tmp'))
@@ -0,0 +1,90 @@
+import io
+import zipfile
+
+import pandas as pd
+import pytest
+
+import spotify_funcs as sf
+from streaming_history import StreamingHistoryBuffer
+from tests.conftest import export_file, make_history
+
+def export_zip(files, name='my_spotify_data.zip'):
+    """A Spotify export archive holding the given export files."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for file in files:
+            archive.writestr(f"Spotify Extended Streaming History/{file.name}", file.getvalue())
+        archive.writestr("Spotify Extended Streaming History/ReadMeFirst.pdf", b"%PDF")
+    buffer.seek(0)
+    buffer.name = name
+    return buffer
+
+def test_sources_are_closed_after_use():
+    upload = export_zip([export_file(make_history(10), 'Streaming_History_Audio_2020.json')])
+
+    with sf.open_spotify_sources([upload]) as sources:
+        names = [source.name for source in sources]
+        fingerprints = {sf.get_source_fingerprint(source) for source in sources}
+
+    assert names == ['my_spotify_data.zip/Spotify Extended Streaming History/Streaming_History_Audio_2020.json']
+    assert len(fingerprints) == 1
+    assert all(source.closed for source in sources)
+    assert not upload.closed
+
+def test_reading_only_named_sources():
+    first = export_file(make_history(50, seed=1), 'Streaming_History_Audio_2020.json')
+    second = export_file(make_history(70, seed=2), 'Streaming_History_Audio_2021.json')
+    upload = export_zip([first, second])
+
+    stats_raw = sf.read_spotify_json([upload], streaming=True,
+                                     source_names={'my_spotify_data.zip/Spotify Extended Streaming History/Streaming_History_Audio_2021.json'})
+    assert len(stats_raw) == 70
+
+def test_buffer_interns_only_repeated_columns():
+    records = make_history(300, seed=3)
+    buffer = StreamingHistoryBuffer(64)
+    for record in records:
+        buffer.append(record)
+
+    assert 'platform' in buffer.strings
+    assert 'master_metadata_track_name' in buffer.strings
+    assert 'ts' not in buffer.strings
+    assert 'ip_addr' not in buffer.strings
+
+    frame = buffer.to_frame()
+    assert buffer.columns == {} and buffer.strings == {}
+    pd.testing.assert_frame_equal(frame, pd.DataFrame(records), check_dtype=False)
+
+def test_parallel_ingest_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.setattr(sf, 'PARALLEL_INGEST_MIN_BYTES', 0)
+    files = [export_file(make_history(200 + i * 50, seed=i), f'Streaming_History_Audio_{2018 + i}.json')
+             for i in range(4)]
+
+    # one export ZIP on disk, whose members the workers open themselves, and one JSON upload in memory
+    archive_path = tmp_path / 'my_spotify_data.zip'
+    archive_path.write_bytes(export_zip(files[:3]).getvalue())
+
+    with open(archive_path, 'rb') as archive:
+        serial = sf.read_spotify_json([archive, files[3]], streaming=True, workers=1)
+        parallel = sf.read_spotify_json([archive, files[3]], workers=2)
+
+    pd.testing.assert_frame_equal(serial, parallel)
+    assert len(serial) == 200 + 250 + 300 + 350
+
+def test_zip_ingest_matches_json_files():
+    files = [export_file(make_history(100, seed=i), f'Streaming_History_Audio_{2018 + i}.json') for i in range(2)]
+
+    from_json = sf.read_spotify_json(files, streaming=True, workers=1)
+    from_zip = sf.read_spotify_json([export_zip(files)], streaming=True, workers=1)
+
+    pd.testing.assert_frame_equal(from_json, from_zip)
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_empty_export_raises(streaming):
+    files = [export_file([]), export_file([], 'Streaming_History_Audio_2022.json')]
+    with pytest.raises(FileNotFoundError, match='No valid Spotify audio history'):
+        sf.read_spotify_json(files, streaming=streaming)
+
+def test_empty_export_raises_when_chunked():
+    with pytest.raises(FileNotFoundError, match='No valid Spotify audio history'):
+        list(sf.iter_spotify_json_chunks([export_file([])]))
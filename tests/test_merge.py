@@ -0,0 +1,37 @@
+import io
+
+import pandas as pd
+
+import spotify_funcs as sf
+from tests.conftest import export_file, make_history
+
+def analysis_frame(records):
+    return sf.build_provisional_df(sf.read_spotify_json([export_file(records)], streaming=True))
+
+def legacy_frame(records):
+    """An analysis frame as saved before genres were lists."""
+    df = analysis_frame(records)
+    df['genres'] = ["['pop', 'indie rock']" if i % 2 else '[]' for i in range(len(df))]
+    return df
+
+def test_merge_gives_one_genres_representation():
+    records = make_history(300)
+    merged = sf.merge_spotify_data(legacy_frame(records[:200]), analysis_frame(records[150:]))
+
+    assert merged['genres'].map(type).eq(list).all()
+    assert ['pop', 'indie rock'] in merged['genres'].tolist()
+    assert merged['unique_id'].is_unique and len(merged) == 300
+
+    # mixing lists and strings used to fail here
+    merged.to_parquet(io.BytesIO())
+
+def test_load_converts_legacy_genres(monkeypatch):
+    buffer = io.BytesIO()
+    legacy_frame(make_history(100)).to_parquet(buffer)
+    monkeypatch.setattr(sf, 'download_file_from_supabase', lambda bucket, path: buffer.getvalue())
+
+    df = sf.load_df_from_supabase('someone')
+
+    assert df['genres'].map(type).eq(list).all()
+    assert df['timestamp_listened'].is_monotonic_increasing
+    assert all(column in df.columns for column in sf.CALENDAR_COLUMNS)
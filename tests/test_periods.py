@@ -0,0 +1,25 @@
+import pandas as pd
+
+import spotify_funcs as sf
+
+def test_slice_period_matches_a_boolean_mask(analysis_df):
+    period_index = sf.build_period_index(analysis_df)
+    assert set(period_index['kind']) == {'year', 'quarter', 'month'}
+
+    for label, kind in zip(period_index['period'], period_index['kind']):
+        period = pd.Period(label, freq={'year': 'Y', 'quarter': 'Q', 'month': 'M'}[kind])
+        # the sidebar used to filter on the calendar columns
+        mask = analysis_df['year'] == period.year
+        if kind == 'quarter':
+            mask &= analysis_df['quarter'] == label
+        elif kind == 'month':
+            mask &= analysis_df['month'] == period.month
+        masked = analysis_df[mask]
+
+        pd.testing.assert_frame_equal(sf.slice_period(analysis_df, period_index, period), masked)
+
+def test_slice_period_without_plays(analysis_df):
+    period_index = sf.build_period_index(analysis_df)
+    empty = sf.slice_period(analysis_df, period_index, pd.Period('1999', freq='Y'))
+
+    assert empty.empty and list(empty.columns) == list(analysis_df.columns)
@@ -0,0 +1,94 @@
+import shutil
+
+import pandas as pd
+
+import spotify_funcs as sf
+from tests.conftest import export_file, make_history
+
+def test_enrichment_leaves_the_raw_frame_unchanged(mock_api, pipeline_cache):
+    raw = sf.read_spotify_json([export_file(make_history(400))], streaming=True)
+    before = raw.copy()
+
+    first = sf.enrich_spotify_data(raw, 'id', 'secret')
+    pd.testing.assert_frame_equal(raw, before)
+
+    # a retry of the same upload reruns every stage on the same frame
+    shutil.rmtree(pipeline_cache / 'pipeline')
+    second = sf.enrich_spotify_data(raw, 'id', 'secret')
+    pd.testing.assert_frame_equal(first, second)
+
+def test_same_files_against_different_saved_data(mock_api, pipeline_cache):
+    history = make_history(400)
+    raw = sf.read_spotify_json([export_file(history)], streaming=True)
+    saved = sf.enrich_spotify_data(raw.iloc[:150], 'id', 'secret')
+
+    # one upload, filtered against an empty and a partial saved dataframe
+    everything = sf.enrich_spotify_data(raw, 'id', 'secret', fingerprint='upload')
+    remaining = sf.drop_stored_plays(raw, saved)
+    unsaved = sf.enrich_spotify_data(remaining, 'id', 'secret', fingerprint='upload')
+
+    assert len(unsaved) < len(everything)
+    assert not unsaved['unique_id'].isin(saved['unique_id']).any()
+
+def double(df):
+    return df * 2
+
+def test_pipeline_cache_is_capped_by_bytes(tmp_path):
+    from pipeline import Pipeline, Stage
+
+    # four users' results of ~8 kB each under a limit fitting two
+    for user in range(4):
+        frame = pd.DataFrame({'x': range(user * 1000, (user + 1) * 1000)})
+        pipeline = Pipeline([Stage('double', double, inputs=['raw'], output='doubled')],
+                            tmp_path / f"user{user}", max_bytes=20_000, cache_root=tmp_path)
+        pipeline.run({'raw': frame})
+
+    cached = sorted(path.parent.name for path in tmp_path.rglob('*.pkl'))
+    assert cached == ['user2', 'user3']
+
+def test_stage_fingerprint_covers_helpers(tmp_path, monkeypatch):
+    import importlib
+    from pipeline import Stage
+
+    module = tmp_path / 'stage_module.py'
+    module.write_text("def helper(df):\n    return df + 1\n\ndef stage(df):\n    return helper(df)\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import stage_module
+    before = Stage('stage', stage_module.stage, inputs=['raw'], output='out').fingerprint(['raw'])
+
+    # only the helper changes
+    module.write_text("def helper(df):\n    return df + 2\n\ndef stage(df):\n    return helper(df)\n")
+    importlib.reload(stage_module)
+    after = Stage('stage', stage_module.stage, inputs=['raw'], output='out').fingerprint(['raw'])
+
+    assert before != after
+
+def test_stale_checkpoints_are_swept(pipeline_cache):
+    import os
+    import time
+
+    stale = sf.EnrichmentCheckpoint('user1', 'abandoned')
+    stale.save('https://api/v1/tracks', ['a'], {'tracks': []})
+    week_ago = time.time() - 8 * 24 * 60 * 60
+    os.utime(stale.path, (week_ago, week_ago))
+    recent = sf.EnrichmentCheckpoint('user2', 'interrupted')
+
+    # starting any run sweeps every user's runs older than the ttl
+    sf.EnrichmentCheckpoint('user3', 'new')
+    runs = sorted(path.name for path in (pipeline_cache / 'checkpoints').glob('*/*'))
+    assert runs == ['interrupted', 'new']
+    assert not (pipeline_cache / 'checkpoints' / 'user1').exists()
+    assert os.path.isdir(recent.path)
+
+def test_stage_memory_stays_within_budget(mock_api, pipeline_cache):
+    raw = sf.read_spotify_json([export_file(make_history(50_000))], streaming=True)
+    raw_mb = raw.memory_usage(deep=True).sum() / 2 ** 20
+
+    pipeline = sf.build_spotify_pipeline('id', 'secret', progress_callback=lambda *_: None, track_memory=True)
+    pipeline.run({'raw': raw})
+
+    # the stages share their input's columns rather than copying them, so none
+    # allocates as much as the raw frame (about double without Copy-on-Write)
+    assert int(pd.__version__.split('.')[0]) >= 3 or pd.get_option('mode.copy_on_write') is True
+    peaks = {timing['stage']: timing['peak_mb'] for timing in pipeline.timings}
+    assert max(peaks.values()) < 0.75 * raw_mb, peaks
@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+import spotify_funcs as sf
+
+PLAYS = {
+    'ts': ['2021-03-04T05:06:07Z', '2021-03-04T05:06:07Z', '2021-03-04T05:06:07Z'],
+    'spotify_track_uri': ['spotify:track:abc'] * 3,
+    'ms_played': [1000, 1001, 1000],
+    'platform': ['ios', 'ios', 'android']
+}
+
+# the ids persisted in saved data, which must never change
+KNOWN_IDS = [7782425435623065939, 16935266692438409527, 6700794362380408119]
+
+def play_ids(plays):
+    plays = pd.DataFrame(plays)
+    return sf.make_play_ids(plays['ts'], plays['spotify_track_uri'], plays['ms_played'], plays['platform'])
+
+def test_play_ids_are_known_values():
+    ids = play_ids(PLAYS)
+    assert ids.dtype == 'uint64' and ids.tolist() == KNOWN_IDS
+    assert play_ids(PLAYS).tolist() == KNOWN_IDS
+
+def test_play_ids_differ_in_ms_played_and_platform():
+    # the plays differ only in ms_played, and only in platform
+    assert len(set(play_ids(PLAYS).tolist())) == 3
+
+def test_raw_and_analysis_columns_give_the_same_ids():
+    ids = sf.make_play_ids(pd.to_datetime(pd.Series(PLAYS['ts'])), pd.Series(['abc'] * 3),
+                           pd.Series(PLAYS['ms_played'], dtype='int32'), pd.Series(PLAYS['platform'], dtype='category'))
+    assert ids.tolist() == KNOWN_IDS
+
+def test_play_ids_are_stable_across_processes():
+    script = ("import json, sys; sys.path[:0] = json.loads(sys.argv[1]); import tests.conftest; "
+              "from tests.test_play_ids import PLAYS, play_ids; print(json.dumps(play_ids(PLAYS).tolist()))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    for seed in ('1', '2'):
+        output = subprocess.run([sys.executable, '-c', script, json.dumps(sys.path)], cwd=root, check=True,
+                                capture_output=True, text=True, env={**os.environ, 'PYTHONHASHSEED': seed}).stdout
+        assert json.loads(output.strip().splitlines()[-1]) == KNOWN_IDS
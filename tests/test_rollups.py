@@ -0,0 +1,43 @@
+import pandas as pd
+
+import spotify_funcs as sf
+
+def play_dates(df):
+    return df['timestamp_listened'].dt.tz_convert('UTC').dt.tz_localize(None).dt.normalize()
+
+def test_cube_matches_play_level_aggregates(analysis_df):
+    cube = sf.build_rollup_cube(analysis_df)
+    assert cube['plays'].sum() == len(analysis_df)
+    assert cube['ms_listened'].sum() == analysis_df['ms_listened'].sum()
+
+    # the genre and sunburst charts
+    for dimensions in (['general_genre'], ['general_genre', 'genre1', 'artist']):
+        from_cube = cube.groupby(dimensions, observed=True)['plays'].sum()
+        from_plays = analysis_df.groupby(dimensions, observed=True).size()
+        pd.testing.assert_series_equal(from_cube, from_plays, check_names=False, check_dtype=False)
+
+    # the daily listening chart
+    from_cube = cube.groupby('date_listened')['plays'].sum()
+    from_plays = analysis_df.groupby(play_dates(analysis_df)).size()
+    pd.testing.assert_series_equal(from_cube, from_plays, check_names=False, check_dtype=False)
+
+def test_updated_cube_matches_a_rebuilt_one(analysis_df):
+    saved, new = analysis_df.iloc[:1200], analysis_df.iloc[1200:]
+    updated = sf.update_rollup_cube(sf.build_rollup_cube(saved), new)
+
+    def cells(cube):
+        return cube.astype({column: 'object' for column in sf.CUBE_DIMENSIONS[1:]}) \
+                   .sort_values(sf.CUBE_DIMENSIONS).reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(cells(updated), cells(sf.build_rollup_cube(analysis_df)))
+
+def test_sliced_cube_matches_the_sliced_plays(analysis_df):
+    cube = sf.build_rollup_cube(analysis_df)
+    period_index = sf.build_period_index(analysis_df)
+
+    for period in (pd.Period('2019', freq='Y'), pd.Period('2021Q3', freq='Q'), pd.Period('2017-02', freq='M')):
+        plays = sf.slice_period(analysis_df, period_index, period)
+        sliced = sf.slice_rollup_cube(cube, period.start_time, period.end_time)
+
+        assert sliced['plays'].sum() == len(plays) > 0
+        assert sliced['ms_listened'].sum() == plays['ms_listened'].sum()
@@ -0,0 +1,42 @@
+import io
+
+import pandas as pd
+
+import spotify_funcs as sf
+
+def schema_dtypes(df):
+    return {column: str(df[column].dtype) for column in df.columns
+            if column in sf.ANALYSIS_SCHEMA or column in sf.genre_columns(df)}
+
+def parquet_round_trip(df):
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False)
+    buffer.seek(0)
+    return pd.read_parquet(buffer)
+
+def test_schema_survives_parquet(analysis_df):
+    dtypes = schema_dtypes(analysis_df)
+    assert dtypes['artist'] == 'category' and dtypes['year'] == 'int16' and dtypes['ms_listened'] == 'int32'
+
+    loaded = parquet_round_trip(analysis_df)
+    assert schema_dtypes(loaded) == dtypes
+
+    # the rollup cube and period index are built from the loaded data on later visits
+    pd.testing.assert_frame_equal(sf.build_period_index(loaded), sf.build_period_index(analysis_df))
+    pd.testing.assert_frame_equal(sf.build_rollup_cube(loaded), sf.build_rollup_cube(analysis_df))
+
+def test_load_converts_a_legacy_object_file(analysis_df, monkeypatch):
+    # saved before the compact schema: object strings and 64-bit numbers
+    legacy = analysis_df.astype({column: 'object' for column, dtype in schema_dtypes(analysis_df).items()
+                                 if dtype == 'category'})
+    legacy = legacy.astype({column: 'int64' for column, dtype in schema_dtypes(analysis_df).items()
+                            if dtype in ('int8', 'int16', 'int32')})
+    buffer = io.BytesIO()
+    legacy.to_parquet(buffer, index=False)
+    monkeypatch.setattr(sf, 'download_file_from_supabase', lambda bucket, path: buffer.getvalue())
+
+    loaded = sf.load_df_from_supabase('someone')
+
+    assert schema_dtypes(loaded) == schema_dtypes(analysis_df)
+    assert loaded.memory_usage(deep=True).sum() < legacy.memory_usage(deep=True).sum()
+    pd.testing.assert_frame_equal(sf.build_period_index(loaded), sf.build_period_index(analysis_df))
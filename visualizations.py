@@ -17,11 +17,12 @@ def show():
     st.title("📊 Visualize Your Spotify Data")
     sub_tabs = st.tabs(["Top Artists", "Timeline", "Genres"])
 
-    if 'filtered_df' not in st.session_state:
+    if 'filtered_df' not in st.session_state or 'filtered_cube' not in st.session_state:
         st.warning("⚠️ No data found. Please upload data on the home page!")
         st.stop()
     else:
         filtered_df = st.session_state.filtered_df
+        filtered_cube = st.session_state.filtered_cube
 
     # === Visualizations ===
 
@@ -33,7 +34,7 @@ def show():
         tooltip_attrs = {attr: True for attr in tooltip_attrs if attr != y_axis_attr}  # Exclude the y-axis attribute
         agg_df_multi = (
             filtered_df
-            .groupby(y_axis_attr, as_index=False)
+            .groupby(y_axis_attr, as_index=False, observed=True)
             .agg(
                 count  = ("artist", "size"),
                 genres = ("general_genre", lambda x: ", ".join(x.unique())),
@@ -60,19 +61,18 @@ def show():
         
         # Only show genre selection if the checkbox is checked
         if show_genre_marks:
-            selected_genre = st.selectbox("Choose a genre to highlight:", filtered_df['general_genre'].unique())
+            selected_genre = st.selectbox("Choose a genre to highlight:", filtered_cube['general_genre'].unique())
             
-            filtered_df['date_listened'] = filtered_df['timestamp_listened'].dt.date
             total_plays = (
-                filtered_df
-                .groupby('date_listened')
-                .size()
+                filtered_cube
+                .groupby('date_listened')['plays']
+                .sum()
                 .reset_index(name='TotalPlays')
             )
             genre_plays = (
-                filtered_df[filtered_df['general_genre'] == selected_genre]
-                .groupby('date_listened')
-                .size()
+                filtered_cube[filtered_cube['general_genre'] == selected_genre]
+                .groupby('date_listened')['plays']
+                .sum()
                 .reset_index(name='GenrePlays')
             )
             daily = pd.merge(total_plays, genre_plays, on='date_listened', how='left')
@@ -108,11 +108,10 @@ def show():
             st.plotly_chart(fig)
         else:
 
-            filtered_df['date_listened'] = filtered_df['timestamp_listened'].dt.date
             total_plays = (
-                filtered_df
-                .groupby('date_listened')
-                .size()
+                filtered_cube
+                .groupby('date_listened')['plays']
+                .sum()
                 .reset_index(name='TotalPlays')
             )
             
@@ -138,6 +137,7 @@ def show():
 
     with sub_tabs[2]:
         st.subheader("Top Genres")
-        top_genres = filtered_df['general_genre'].value_counts().head(10).sort_values(ascending=False)
+        top_genres = filtered_cube.groupby('general_genre', observed=True)['plays'].sum().rename('count')
+        top_genres = top_genres.sort_values(ascending=False).head(10)
         top_genres_chart = px.bar(top_genres)
         st.plotly_chart(top_genres_chart)
\ No newline at end of file